@@ -0,0 +1,142 @@
+'''
+apdu build microbenchmark, str.format + toBytes against the compiled templates
+time per debit worth of pdus, and the bytes allocated while building them beyond the pdus themselves
+
+    python benchmarks/bench_apdu.py [--number 20000]
+'''
+import argparse
+import binascii
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smartcard.util import toBytes, toHexString, toASCIIBytes, PACK
+
+from brizzi import BrizziProcessor
+
+CARD_NUMBER = "6013500100001234"
+CARD_UID = "04A1B2C3D4E5F6"
+CARD_KEY = "0102030405060708"
+SAM_RANDOM = "00112233445566778899AABBCCDDEEFF"
+CARD_RANDOM = "0011223344556677"
+MID = "1122334455667788"
+TID = "aabbccddeeff0000"
+
+
+def string_builders():
+    # every pdu of one debit, built the way BrizziProcessor did before the templates
+    P = BrizziProcessor
+    date, clock = time.strftime("%y%m%d"), time.strftime("%H%M%S")
+    return [
+        lambda: toBytes(P.SAMCARD_SELECT),
+        lambda: toBytes(P.PICC_SELECT_AID1),
+        lambda: toBytes(P.PICC_GET_CARD_NUMBER),
+        lambda: toBytes(P.PICC_GET_CARD_STATUS),
+        lambda: toBytes(P.PICC_SELECT_AID3),
+        lambda: toBytes(P.PICC_REQUEST_KEY_CARD),
+        lambda: toBytes(P.PICC_GET_CARD_UID),
+        lambda: toBytes(P.SAMCARD_AUTH_KEY.format(card_number=CARD_NUMBER, card_uid=CARD_UID, key_card=CARD_KEY)),
+        lambda: toBytes(P.PDU_GET_MORE_DATA.format(0x18)),
+        lambda: toBytes(P.PICC_CARD_AUTH.format(SAM_RANDOM)),
+        lambda: toBytes(P.PICC_GET_LAST_TRANSACTION_DATE),
+        lambda: toBytes(P.PICC_GET_BALANCE),
+        lambda: toBytes(P.PICC_DEBET_BALANCE.format(binascii.hexlify((1).to_bytes(3, 'little')).decode())),
+        lambda: toBytes(P.SAMCARD_CREATE_HASH.format(CARD_NUMBER, CARD_UID, CARD_RANDOM,
+                                                     toHexString(toASCIIBytes(CARD_NUMBER), PACK),
+                                                     toHexString(toASCIIBytes("{:0<10}".format(100)), PACK),
+                                                     toHexString(toASCIIBytes("{:0<12}".format(date)), PACK),
+                                                     toHexString(toASCIIBytes("{:0<12}".format(clock)), PACK),
+                                                     toHexString(toASCIIBytes("{:0>6d}".format(808117)), PACK),
+                                                     toHexString(toASCIIBytes("{:0>6d}".format(1)), PACK),
+                                                     toHexString(toASCIIBytes("{:0>2d}".format(1)), PACK))),
+        lambda: toBytes(P.PDU_GET_MORE_DATA.format(0x08)),
+        lambda: toBytes(P.PICC_WRITE_LOG.format(MID, TID, date, clock,
+                                                binascii.hexlify((1).to_bytes(3, 'little')).decode(),
+                                                binascii.hexlify((100).to_bytes(3, 'little')).decode(),
+                                                binascii.hexlify((99).to_bytes(3, 'little')).decode())),
+        lambda: toBytes(P.PICC_WRITE_LAST_TRANSACTION.format(date, binascii.hexlify((1).to_bytes(4, 'big')).decode())),
+        lambda: toBytes(P.PICC_COMMIT_TRANSACTION),
+    ]
+
+
+def template_builders():
+    t = dict((name, template.copy()) for name, template in BrizziProcessor.APDU_TEMPLATES.items())
+    date, clock = time.strftime("%y%m%d"), time.strftime("%H%M%S")
+    # list() is the copy send_apdu hands to pyscard
+    return [
+        lambda: list(t['sam_select'].build()),
+        lambda: list(t['picc_select_aid1'].build()),
+        lambda: list(t['picc_get_card_number'].build()),
+        lambda: list(t['picc_get_card_status'].build()),
+        lambda: list(t['picc_select_aid3'].build()),
+        lambda: list(t['picc_request_key_card'].build()),
+        lambda: list(t['picc_get_card_uid'].build()),
+        lambda: list(t['sam_auth_key'].build(CARD_NUMBER, CARD_UID, CARD_KEY)),
+        lambda: list(t['pdu_get_more_data'].build(0x18)),
+        lambda: list(t['picc_card_auth'].build(SAM_RANDOM)),
+        lambda: list(t['picc_get_last_transaction_date'].build()),
+        lambda: list(t['picc_get_balance'].build()),
+        lambda: list(t['picc_debet_balance'].build(1)),
+        lambda: list(t['sam_create_hash'].build(CARD_NUMBER, CARD_UID, CARD_RANDOM, CARD_NUMBER, 100, date, clock,
+                                                808117, 1, 1)),
+        lambda: list(t['pdu_get_more_data'].build(0x08)),
+        lambda: list(t['picc_write_log'].build(MID, TID, date, clock, 1, 100, 99)),
+        lambda: list(t['picc_write_last_transaction'].build(date, 1)),
+        lambda: list(t['picc_commit_transaction'].build()),
+    ]
+
+
+def transaction(builders):
+    def build_all():
+        return [build() for build in builders]
+
+    return build_all
+
+
+def count_allocations(builders, number):
+    '''
+    bytes allocated per transaction beyond the pdus themselves, and the bytes of the pdus, averaged over number
+    every pdu is built on its own and dropped again, the peak above what the pdu keeps is what building it took
+    '''
+    transient = kept = 0
+    tracemalloc.start()
+    try:
+        for _ in range(number):
+            for build in builders:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                pdu = build()
+                current, peak = tracemalloc.get_traced_memory()
+                transient += peak - current
+                kept += current - before
+                del pdu
+    finally:
+        tracemalloc.stop()
+    return transient / number, kept / number
+
+
+def run(number):
+    rows = []
+    for name, builders in (("str.format + toBytes", string_builders()), ("compiled template", template_builders())):
+        seconds = min(timeit.repeat(transaction(builders), number=number, repeat=5)) / number
+        transient, kept = count_allocations(builders, min(number, 2000))
+        rows.append((name, seconds * 1e6, transient, kept))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print("{:<24} {:>14} {:>18} {:>14}".format("path", "us/transaction", "transient B/trans", "pdu B/trans"))
+    for name, usec, transient, kept in run(args.number):
+        print("{:<24} {:>14.2f} {:>18.1f} {:>14.1f}".format(name, usec, transient, kept))
+
+
+if __name__ == '__main__':
+    main()
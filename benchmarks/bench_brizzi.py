@@ -0,0 +1,252 @@
+'''
+benchmarks of the tap hot path, no reader needed, the sam and cards are the zero latency ones of brizzi_sim
+
+apdu building of every template, response parsing, send_apdu, a full debit and BrizziCardObserver.update dispatch
+every case reports microseconds per operation, the median and the best of its repeats
+results are written as json and compared against a baseline on the best repeat, the one least disturbed by the
+rest of the machine, a case slower than its baseline by more than the threshold is a regression and the exit
+status is 1
+
+    python benchmarks/bench_brizzi.py --output result.json
+    python benchmarks/bench_brizzi.py --baseline benchmarks/baseline.json --threshold 0.25
+    python benchmarks/bench_brizzi.py --save-baseline benchmarks/baseline.json
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# brizzi_sim installs the RPi.GPIO stub off a pi
+import brizzi_sim
+import brizzi
+
+BASELINE_VERSION = 1
+
+
+class CannedConnection:
+    '''
+    connection answering every apdu with the same response, framed as the acr reader does
+    '''
+
+    def __init__(self, raw, reader="Canned"):
+        self.reader = reader
+        raw = bytes(raw)
+        if len(raw) == 1:
+            self.response = (list(raw), 0x90, 0x00)
+        else:
+            self.response = (list(raw[:-2]), raw[-2], raw[-1])
+
+    def transmit(self, apdu, protocol=None):
+        return self.response
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def sample_value(codec, length):
+    '''
+    a value of the field length for every apdu codec
+    '''
+    if codec is brizzi.apdu_fill_hex:
+        return "A5" * length
+    if codec is brizzi.apdu_fill_ascii:
+        return "1" * length
+    if codec in (brizzi.apdu_fill_decimal, brizzi.apdu_fill_decimal_ljust):
+        return 12345 % 10 ** length
+    if codec is brizzi.apdu_fill_byte:
+        return 16
+    return 100000 % (1 << 8 * length)
+
+
+def measure(function, repeat=7, min_time=0.05):
+    '''
+    microseconds per call of function, number of calls per repeat grown until one repeat takes min_time
+    '''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1 << 24:
+            break
+        number *= 2
+    timings = [elapsed / number * 1e6]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        timings.append((time.perf_counter() - start) / number * 1e6)
+    return {'us': round(statistics.median(timings), 3), 'min_us': round(min(timings), 3), 'number': number,
+            'repeat': repeat}
+
+
+def sam_pool():
+    pool = brizzi.SamSessionPool()
+    pool.add_connection(brizzi_sim.SimulatedSam(), "Simulated SAM")
+    return pool
+
+
+def apdu_cases():
+    cases = []
+    for name, template in sorted(brizzi.BrizziProcessor.APDU_TEMPLATES.items()):
+        template = template.copy()
+        values = [sample_value(codec, length) for _, _, length, codec in template.fields]
+        cases.append(("apdu_build/" + name, lambda template=template, values=values: template.build(*values)))
+    return cases
+
+
+def parse_cases(pool):
+    card = brizzi_sim.SimulatedBrizziCard()
+    record = bytes.fromhex("1122334455667788AABBCCDDEEFF0000261018150429EB050000A08601009B8601")
+    responses = (
+        ("card_get_uid", card.uid + b"\x90\x00", lambda processor: processor.card_get_uid()),
+        ("card_get_number", b"\x00" + card._file(1, 0), lambda processor: processor.card_get_number()),
+        ("card_get_status", b"\x00" + card._file(1, 1), lambda processor: processor.card_get_status()),
+        ("card_get_last_transaction_date", b"\x00" + bytes.fromhex("19071600000005"),
+         lambda processor: processor.card_get_last_transaction_date()),
+        ("card_get_balance", b"\x00" + (100000).to_bytes(4, 'little'), lambda processor: processor.card_get_balance()),
+        ("card_read_log", b"\x00" + record, lambda processor: processor.card_read_log()),
+    )
+    cases = []
+    for name, raw, call in responses:
+        processor = brizzi.BrizziProcessor(sam_pool=pool, picc_connection=CannedConnection(raw), debug_mode=False,
+                                           picc_setup=0.0)
+        cases.append(("parse/" + name, lambda processor=processor, call=call: call(processor)))
+    cases.append(("parse/log_record", lambda: brizzi.log_record(record)))
+    cases.append(("parse/sw_reason", lambda: brizzi.sw_reason(0x6985)))
+
+    processor = brizzi.BrizziProcessor(sam_pool=pool, picc_connection=CannedConnection(b"\x00"), debug_mode=False,
+                                       picc_setup=0.0)
+    pdu = brizzi.BrizziProcessor.APDU_TEMPLATES['picc_select_aid1'].build()
+    cases.append(("send_apdu/picc", lambda: processor.send_apdu(pdu, False)))
+    return cases
+
+
+def debit_cases(pool, processors):
+    cases = []
+    for name, options in (("pipelined", {}), ("sequential", {'pipelined': False}),
+                          ("burst", {'write_burst': "transmit"})):
+        card = brizzi_sim.SimulatedBrizziCard(balance=10 ** 7)
+        # built once and bound to the card for every debit, as the observers keep the processor of a reader
+        processor = brizzi.BrizziProcessor(sam_pool=pool, picc_connection=card, debug_mode=False, picc_setup=0.0,
+                                           **options)
+        processors.append(processor)
+
+        def debit(card=card, processor=processor):
+            processor.bind(card, 0.0)
+            result = processor.transaction_debet_card(1)
+            processor.release()
+            if not result['status']:
+                raise RuntimeError("debit failed at {}".format(result['failed_step']))
+
+        cases.append(("debit/" + name, debit))
+    return cases
+
+
+def observer_cases(pool):
+    # no ttl and no debounce, every update is a full debit and not a cached re-tap
+    observer = brizzi.BrizziCardObserver(pool, card_cache=brizzi.CardSessionCache(ttl=0.0, debounce=0.0),
+                                         connections=brizzi.ReaderConnectionManager(metrics=False))
+    sam_card = brizzi_sim.SimulatedCard(pool._sessions[0].connection)
+    reader = brizzi_sim.SimulatedReader("Simulated Reader")
+    tap = reader.present(brizzi_sim.SimulatedBrizziCard(balance=10 ** 7))
+    return [
+        ("observer/update_empty", lambda: observer.update(None, ([], []))),
+        ("observer/update_sam", lambda: observer.update(None, ([sam_card], []))),
+        ("observer/update_tap", lambda: observer.update(None, ([tap], []))),
+    ]
+
+
+def run(name_filter=None, repeat=7, min_time=0.05):
+    brizzi.LOGGER_MAIN.setLevel(logging.WARNING)
+    brizzi.ACTUATOR_MAIN = brizzi.ActuatorScheduler(brizzi.GPIOControl()).start()
+    pool = sam_pool()
+    processors = []
+    results = {}
+    try:
+        for name, function in apdu_cases() + parse_cases(pool) + debit_cases(pool, processors) + observer_cases(pool):
+            if name_filter and name_filter not in name:
+                continue
+            results[name] = measure(function, repeat, min_time)
+    finally:
+        for processor in processors:
+            processor.close()
+        brizzi.ACTUATOR_MAIN.stop()
+        pool.close()
+    # what update adds around the debit, derived from two noisy cases and never a regression on its own
+    if "observer/update_tap" in results and "debit/pipelined" in results:
+        overhead = results["observer/update_tap"]['min_us'] - results["debit/pipelined"]['min_us']
+        results["observer/tap_overhead"] = {'min_us': round(max(0.0, overhead), 3), 'derived': True}
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    ratio to the baseline added to every result, returns the names slower than the baseline by more than threshold
+    '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None or result.get('derived') or not base.get('min_us'):
+            continue
+        result['baseline_us'] = base['min_us']
+        result['ratio'] = round(result['min_us'] / base['min_us'], 3)
+        if result['ratio'] > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time apdu building, parsing, the debit and observer dispatch")
+    parser.add_argument("--output", help="result json, standard output without")
+    parser.add_argument("--baseline", help="baseline json the results are compared against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="slowdown against the baseline that fails")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline")
+    parser.add_argument("--filter", help="only the cases whose name holds this text")
+    parser.add_argument("--repeat", type=int, default=7, help="repeats per case")
+    parser.add_argument("--min-time", type=float, default=0.05, help="seconds one repeat of a case runs at least")
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat, args.min_time)
+    report = {
+        'version': BASELINE_VERSION,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'machine': "{} {}".format(platform.system(), platform.machine()),
+        'threshold': args.threshold,
+        'results': results,
+        'regressions': []
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['regressions'] = compare(results, json.load(baseline_file), args.threshold)
+
+    for name, result in sorted(results.items()):
+        print("{:<48} {:>12.3f} us{}{}".format(
+            name, result['min_us'], 'ratio' in result and "  x{:.3f}".format(result['ratio']) or "",
+            name in report['regressions'] and "  REGRESSION" or ""), file=sys.stderr)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            baseline_file.write(json.dumps(dict(report, regressions=[]), indent=2, sort_keys=True) + "\n")
+    return report['regressions'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
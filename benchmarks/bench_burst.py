@@ -0,0 +1,36 @@
+'''
+write burst benchmark on the simulator, picc exchanges and tap latency per commit phase mode
+
+    python benchmarks/bench_burst.py [--taps 300] [--picc-latency 6] [--sam-latency 4]
+'''
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import brizzi_sim
+
+MODES = (("per step", None), ("back to back", "transmit"), ("escape burst", "escape"))
+
+
+def run(taps, picc_latency, sam_latency):
+    return [(name, brizzi_sim.run_load(taps, 50, sam_latency=sam_latency, picc_latency=picc_latency,
+                                       write_burst=write_burst)) for name, write_burst in MODES]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--taps", type=int, default=300)
+    parser.add_argument("--picc-latency", type=float, default=6.0, help="ms per picc exchange")
+    parser.add_argument("--sam-latency", type=float, default=4.0, help="ms per sam apdu")
+    args = parser.parse_args()
+
+    print("{:<16} {:>12} {:>10} {:>10}".format("commit phase", "picc/tap", "p50 ms", "p90 ms"))
+    for name, report in run(args.taps, args.picc_latency / 1000, args.sam_latency / 1000):
+        print("{:<16} {:>12.2f} {:>10.3f} {:>10.3f}".format(name, report['picc_per_tap'], report['p50_ms'],
+                                                            report['p90_ms']))
+
+
+if __name__ == '__main__':
+    main()
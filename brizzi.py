@@ -1,15 +1,32 @@
 import logging
-import binascii
+import logging.handlers
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import queue
+import struct
+import threading
 import time
+
+# start of the import, the first startup phase runs until main
+IMPORT_STARTED = time.perf_counter()
+
 # from smartcard.System import readers
 from smartcard.CardConnectionObserver import ConsoleCardConnectionObserver
 from smartcard.CardConnection import CardConnection
 from smartcard.CardMonitoring import CardMonitor, CardObserver
+from smartcard.ReaderMonitoring import ReaderMonitor, ReaderObserver
 from smartcard.util import *
+from smartcard.scard import SCARD_CTL_CODE
 # from smartcard.scard import *
 
-# gpio
-import RPi.GPIO as GPIO
+# gpio, RPi.GPIO is imported by the first GPIOControl, see gpio_backend
+GPIO = None
 
 '''
 https://stackoverflow.com/questions/7621897/python-logging-module-globally
@@ -28,11 +45,331 @@ def setup_custom_logger(name):
     return logger
 
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    queue handler for a listener in the same process, the record is queued as is and formatted by the listener
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    '''
+    one json object per record, an apdu record carries its exchange as fields
+    '''
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName
+        }
+        apdu = getattr(record, 'apdu', None)
+        if apdu is not None:
+            entry.update(apdu.to_dict())
+        else:
+            entry['msg'] = record.getMessage()
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def queue_logging(logger, structured=False):
+    '''
+    move the handlers of logger behind a queue, the transaction threads only pay a queue put
+    returns the started QueueListener, stop it to flush on exit
+    '''
+    handlers = logger.handlers[:]
+    if structured:
+        for handler in handlers:
+            handler.setFormatter(StructuredFormatter())
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ApduLogEntry:
+    '''
+    one exchange as captured on the transaction thread, hex formatting happens only when it is written
+    '''
+    __slots__ = ('ts', 'owner', 'to_sam', 'apdu', 'data', 'sw1', 'sw2', 'seconds')
+
+    def __init__(self, ts, owner, to_sam, apdu, data, sw1, sw2, seconds):
+        self.ts = ts
+        self.owner = owner
+        self.to_sam = to_sam
+        self.apdu = apdu
+        self.data = data
+        self.sw1 = sw1
+        self.sw2 = sw2
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {
+            'target': self.to_sam and "sam" or "picc",
+            'apdu': bytes(self.apdu).hex().upper(),
+            'data': bytes(self.data).hex().upper() if self.data is not None else None,
+            'sw': self.sw1 is not None and "{:02X}{:02X}".format(self.sw1, self.sw2) or None,
+            'ms': round(self.seconds * 1000, 3)
+        }
+
+    def __str__(self):
+        return "{target} {apdu} -> [{sw}] {data} ({ms} ms)".format(**self.to_dict())
+
+
+class JsonMessage:
+    '''
+    a result dict logged as json, encoded only when the record is written
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value)
+
+
+class ApduTrace:
+    '''
+    in memory ring of the last exchanges of every processor, dumped for a transaction that failed
+    sample_every and max_per_second limit what also goes to the logger at debug level
+    the counters are not locked, under several lanes the sampling is approximate
+    '''
+
+    def __init__(self, logger=None, ring_size=512, sample_every=0, max_per_second=50):
+        self._logger = logger
+        self._ring = collections.deque(maxlen=ring_size)
+        self._sample_every = sample_every
+        self._max_per_second = max_per_second
+        self._count = 0
+        self._window = 0
+        self._window_count = 0
+        self.dropped = 0
+        self.dumps = 0
+
+    def record(self, owner, to_sam, apdu, data, sw1, sw2, seconds):
+        entry = ApduLogEntry(time.time(), owner, to_sam, apdu, data, sw1, sw2, seconds)
+        self._ring.append(entry)
+        if not self._sample_every or self._logger is None:
+            return
+        self._count += 1
+        if self._count % self._sample_every:
+            return
+        window = int(entry.ts)
+        if window != self._window:
+            self._window = window
+            self._window_count = 0
+        self._window_count += 1
+        if self._max_per_second and self._window_count > self._max_per_second:
+            self.dropped += 1
+            return
+        self._logger.debug("APDU %s", entry, extra={'apdu': entry})
+
+    def entries(self, owner=None, since=None):
+        return [entry for entry in list(self._ring)
+                if (owner is None or entry.owner == owner) and (since is None or entry.ts >= since)]
+
+    def dump(self, owner=None, since=None, reason=None):
+        '''
+        write the ring entries of owner since the unix time since to the logger, whatever the sampling
+        '''
+        entries = self.entries(owner, since)
+        if self._logger is not None and entries:
+            self.dumps += 1
+            self._logger.warning("APDU trace of failed transaction ({}), {} exchanges".format(reason, len(entries)))
+            for entry in entries:
+                self._logger.warning("APDU %s", entry, extra={'apdu': entry})
+        return entries
+
+
+class LatencyHistogram:
+    '''
+    fixed bucket histogram of durations in second, observe is a bisect and three additions
+    '''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        # last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def prometheus_lines(self, name, labels=""):
+        separator = labels and "," or ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, separator, bound, cumulative))
+        lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(name, labels, separator, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, self.count))
+        return lines
+
+
+class Instrumentation:
+    '''
+    apdu, step and transaction latency with status word and failure step counts
+    the hot path only does dict lookups and additions, text is built on export
+    counters are updated without a lock, a concurrent update may rarely be lost
+    '''
+
+    def __init__(self):
+        self.apdu = {True: LatencyHistogram(), False: LatencyHistogram()}
+        self.steps = {}
+        self.transaction = LatencyHistogram()
+        self.transactions = {True: 0, False: 0}
+        self.status_words = {}
+        self.failed_steps = {}
+        self.transport_errors = {True: 0, False: 0}
+        self.connect = LatencyHistogram()
+        self.detect = LatencyHistogram()
+        self._server = None
+        self._export_thread = None
+        self._export_stop = threading.Event()
+
+    def observe_apdu(self, to_sam, seconds, sw1, sw2):
+        self.apdu[to_sam].observe(seconds)
+        sw = sw1 << 8 | sw2
+        self.status_words[sw] = self.status_words.get(sw, 0) + 1
+
+    def observe_transport_error(self, to_sam):
+        self.transport_errors[to_sam] += 1
+
+    def observe_connect(self, seconds):
+        self.connect.observe(seconds)
+
+    def observe_detect(self, seconds):
+        self.detect.observe(seconds)
+
+    def observe_step(self, step, seconds):
+        histogram = self.steps.get(step)
+        if histogram is None:
+            histogram = self.steps[step] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def observe_transaction(self, seconds, status, failed_step=None):
+        self.transaction.observe(seconds)
+        self.transactions[status] += 1
+        if failed_step is not None:
+            self.failed_steps[failed_step] = self.failed_steps.get(failed_step, 0) + 1
+
+    def to_prometheus(self):
+        lines = ["# TYPE brizzi_apdu_seconds histogram"]
+        for to_sam, histogram in self.apdu.items():
+            lines += histogram.prometheus_lines("brizzi_apdu_seconds", 'target="{}"'.format(to_sam and "sam" or "picc"))
+        lines.append("# TYPE brizzi_step_seconds histogram")
+        for step, histogram in sorted(self.steps.items()):
+            lines += histogram.prometheus_lines("brizzi_step_seconds", 'step="{}"'.format(step))
+        lines.append("# TYPE brizzi_connect_seconds histogram")
+        lines += self.connect.prometheus_lines("brizzi_connect_seconds")
+        lines.append("# TYPE brizzi_detect_seconds histogram")
+        lines += self.detect.prometheus_lines("brizzi_detect_seconds")
+        lines.append("# TYPE brizzi_transaction_seconds histogram")
+        lines += self.transaction.prometheus_lines("brizzi_transaction_seconds")
+        lines.append("# TYPE brizzi_transactions_total counter")
+        for status, count in self.transactions.items():
+            lines.append('brizzi_transactions_total{{status="{}"}} {}'.format(status and "ok" or "failed", count))
+        lines.append("# TYPE brizzi_status_words_total counter")
+        for sw, count in sorted(self.status_words.items()):
+            lines.append('brizzi_status_words_total{{sw="{:04X}"}} {}'.format(sw, count))
+        lines.append("# TYPE brizzi_failed_steps_total counter")
+        for step, count in sorted(self.failed_steps.items()):
+            lines.append('brizzi_failed_steps_total{{step="{}"}} {}'.format(step, count))
+        lines.append("# TYPE brizzi_transport_errors_total counter")
+        for to_sam, count in self.transport_errors.items():
+            lines.append('brizzi_transport_errors_total{{target="{}"}} {}'.format(to_sam and "sam" or "picc", count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # textfile collector format, replaced atomically
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def start_file_export(self, path, interval=15.0):
+        def export_loop():
+            while not self._export_stop.wait(interval):
+                try:
+                    self.write_prometheus(path)
+                except Exception as err:
+                    pass
+                    LOGGER_MAIN.error(err)
+
+        self._export_stop.clear()
+        self._export_thread = threading.Thread(target=export_loop, name="metrics-export", daemon=True)
+        self._export_thread.start()
+
+    def serve_prometheus(self, port=9464, host="127.0.0.1"):
+        '''
+        local /metrics endpoint on its own thread
+        '''
+        import http.server
+
+        instrumentation = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = instrumentation.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server
+
+    def stop(self):
+        self._export_stop.set()
+        self._export_thread and self._export_thread.join()
+        self._export_thread = None
+        self._server and self._server.shutdown()
+        self._server = None
+
+
 '''
 main logger
 '''
 LOGGER_MAIN = setup_custom_logger("brizzi_root")
+TRACE_MAIN = ApduTrace(LOGGER_MAIN)
 GPIO_CONTROL_MAIN = None
+ACTUATOR_MAIN = None
+METRICS_MAIN = Instrumentation()
+
+
+def gpio_backend():
+    '''
+    RPi.GPIO on first use, None off a raspberry pi where the gpio outputs do nothing
+    '''
+    global GPIO
+    if GPIO is None:
+        try:
+            import RPi.GPIO as gpio_module
+            GPIO = gpio_module
+        except (ImportError, RuntimeError) as err:
+            # RPi.GPIO raises RuntimeError when it is not running on a pi
+            LOGGER_MAIN.warning("No gpio backend : {}".format(err))
+    return GPIO
 
 
 class GPIOControl:
@@ -40,10 +377,19 @@ class GPIOControl:
     pin_buzzer = 21
     pin_gate = 20
 
-    def __init__(self):
+    def __init__(self, pin_buzzer=None, pin_gate=None):
         try:
             self.initialize = False
 
+            # per lane pins, default to the class definition
+            if pin_buzzer is not None:
+                self.pin_buzzer = pin_buzzer
+            if pin_gate is not None:
+                self.pin_gate = pin_gate
+
+            if gpio_backend() is None:
+                return
+
             GPIO.setwarnings(False)
             GPIO.setmode(GPIO.BCM)
 
@@ -67,11 +413,11 @@ class GPIOControl:
 
     # buzzer on off
     def buzzer_on_off(self, isOn=False):
-        GPIO.output(self.pin_buzzer, isOn * GPIO.HIGH)
+        self.initialize and GPIO.output(self.pin_buzzer, isOn * GPIO.HIGH)
 
     # gate on off
     def gate_on_off(self, isOn=False):
-        GPIO.output(self.pin_gate, isOn * GPIO.HIGH)
+        self.initialize and GPIO.output(self.pin_gate, isOn * GPIO.HIGH)
 
     def buzzer_beep(self, repeat_num=1, delay_ms=200):
         for i in range(0, repeat_num):
@@ -80,13 +426,1416 @@ class GPIOControl:
             self.buzzer_on_off(True)
             time.sleep(delay_ms / 1000)
 
-    def gate_open(self, delay_close_ms=6000):
-        self.gate_open(True)
-        time.sleep(delay_close_ms / 1000)
-        self.gate_open()
+    def gate_open(self, delay_close_ms=6000):
+        self.gate_on_off(True)
+        time.sleep(delay_close_ms / 1000)
+        self.gate_on_off()
+
+    def gate_close(self):
+        self.gate_on_off()
+
+
+class ActuatorScheduler:
+    '''
+    timer queue driving buzzer and gate from its own thread, every command returns at once
+    '''
+
+    def __init__(self, gpio_control, logger=None):
+        self._gpio = gpio_control
+        self._logger = logger
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        # a newer command of the same kind makes the pending steps of the older one stale
+        self._generation = {'buzzer': 0, 'gate': 0}
+        self._gate_close_at = None
+
+        # queue wait, time between the due time of a step and its execution
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_last = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="actuator", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread and self._thread.join()
+        self._thread = None
+
+    def _schedule(self, kind, steps):
+        # steps are (delay second, callable, argument) relative to now
+        now = time.monotonic()
+        with self._cond:
+            self._generation[kind] += 1
+            generation = self._generation[kind]
+            for delay, action, arg in steps:
+                heapq.heappush(self._queue, (now + delay, next(self._seq), kind, generation, action, arg))
+            self._cond.notify()
+
+    def beep(self, repeat_num=1, delay_ms=200):
+        # a new pattern replaces whatever is left of the previous one
+        delay = delay_ms / 1000
+        steps = []
+        for i in range(0, repeat_num):
+            steps.append((2 * i * delay, self._gpio.buzzer_on_off, True))
+            steps.append(((2 * i + 1) * delay, self._gpio.buzzer_on_off, False))
+        self._schedule('buzzer', steps)
+
+    def gate_open(self, delay_close_ms=6000):
+        # a second valid tap while the gate is open only moves the close time
+        close_at = time.monotonic() + delay_close_ms / 1000
+        with self._cond:
+            if self._gate_close_at is not None and close_at <= self._gate_close_at:
+                return
+            already_open = self._gate_close_at is not None
+            self._gate_close_at = close_at
+        steps = [(delay_close_ms / 1000, self._close_gate, None)]
+        if not already_open:
+            steps.insert(0, (0, self._gpio.gate_on_off, True))
+        self._schedule('gate', steps)
+
+    def gate_close(self):
+        '''
+        close the gate now unless it is open for a passenger who paid, a declined tap never shortens that window
+        returns False when the gate was left open
+        '''
+        with self._cond:
+            if self._gate_close_at is not None:
+                return False
+            self._schedule('gate', [(0, self._gpio.gate_on_off, False)])
+        return True
+
+    def _close_gate(self, arg=None):
+        with self._cond:
+            self._gate_close_at = None
+        self._gpio.gate_on_off(False)
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for item in self._queue if item[3] == self._generation[item[2]])
+
+    def queue_wait_stats(self):
+        return {
+            'count': self.wait_count,
+            'avg_ms': self.wait_count and self.wait_total / self.wait_count * 1000 or 0.0,
+            'max_ms': self.wait_max * 1000,
+            'last_ms': self.wait_last * 1000,
+            'pending': self.pending()
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    self._cond.wait(max(0, self._queue[0][0] - time.monotonic()) if self._queue else None)
+                if not self._running:
+                    return
+                due, _, kind, generation, action, arg = heapq.heappop(self._queue)
+                if generation != self._generation[kind]:
+                    continue
+
+            wait = time.monotonic() - due
+            self.wait_count += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.wait_last = wait
+            try:
+                action(arg)
+            except Exception as err:
+                pass
+                self._logger and self._logger.error(err)
+
+
+'''
+apdu codecs, each one fills a field of a compiled apdu template in place
+'''
+
+
+def apdu_fill_hex(view, offset, length, value):
+    # hex text or raw bytes, right padded with 00 and truncated like "{:0<N.N}"
+    if isinstance(value, str):
+        value = bytes.fromhex(value[:length * 2].ljust(length * 2, '0'))
+    value = value[:length]
+    view[offset:offset + len(value)] = value
+    view[offset + len(value):offset + length] = bytes(length - len(value))
+
+
+def apdu_fill_ascii(view, offset, length, value):
+    # ascii text, right padded with 00 and truncated
+    if isinstance(value, str):
+        value = value.encode('ascii')
+    apdu_fill_hex(view, offset, length, value)
+
+
+def apdu_fill_decimal(view, offset, length, value):
+    # ascii decimal, left padded with "0" like "{:0>Nd}"
+    view[offset:offset + length] = (b'%0*d' % (length, value))[:length]
+
+
+def apdu_fill_decimal_ljust(view, offset, length, value):
+    # ascii decimal, right padded with "0" like "{:0<N}"
+    view[offset:offset + length] = (b'%d' % value).ljust(length, b'0')[:length]
+
+
+def apdu_fill_le(view, offset, length, value):
+    view[offset:offset + length] = value.to_bytes(length, 'little')
+
+
+def apdu_fill_be(view, offset, length, value):
+    view[offset:offset + length] = value.to_bytes(length, 'big')
+
+
+def apdu_fill_byte(view, offset, length, value):
+    struct.pack_into('B', view, offset, value & 0xFF)
+
+
+class ApduTemplate:
+    '''
+    apdu compiled once into a fixed byte layout, variable fields are filled in place on build
+    '''
+    __slots__ = ('name', 'buffer', 'view', 'fields')
+
+    def __init__(self, name, *parts):
+        # every part is either a hex constant or a (field name, length, codec) tuple
+        self.name = name
+        self.buffer = bytearray()
+        self.fields = []
+        for part in parts:
+            if isinstance(part, str):
+                self.buffer += bytes.fromhex(part)
+            else:
+                field_name, length, codec = part
+                self.fields.append((field_name, len(self.buffer), length, codec))
+                self.buffer += bytes(length)
+        self.fields = tuple(self.fields)
+        self.view = memoryview(self.buffer)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def copy(self):
+        # each processor owns its buffers, so lanes never share a template
+        template = ApduTemplate.__new__(ApduTemplate)
+        template.name = self.name
+        template.buffer = bytearray(self.buffer)
+        template.view = memoryview(template.buffer)
+        template.fields = self.fields
+        return template
+
+    def build(self, *values):
+        '''
+        fill the fields in declaration order, the returned buffer is reused by the next build
+        '''
+        view = self.view
+        for (_, offset, length, codec), value in zip(self.fields, values):
+            codec(view, offset, length, value)
+        return self.buffer
+
+
+def response_view(data, sw1=None, sw2=None):
+    '''
+    response data as a memoryview, optionally followed by sw1 sw2 for fields that span into the status word
+    '''
+    buffer = bytearray(data)
+    if sw1 is not None:
+        buffer.append(sw1)
+        buffer.append(sw2)
+    return memoryview(buffer)
+
+
+def apdu_with_le(apdu, le):
+    '''
+    apdu (list of int, short length) with its le byte set, appended for a case 1 or 3 command
+    '''
+    lc = len(apdu) > 5 and apdu[4] or 0
+    if len(apdu) == 5 or (lc and len(apdu) == 6 + lc):
+        apdu[-1] = le
+    else:
+        apdu.append(le)
+    return apdu
+
+
+'''
+write burst escape, several picc apdu in one reader exchange
+request  E0 00 00 B0 <count> then <length> <apdu> per command
+response <length> <data sw1 sw2> per command, the reader stops after the first command that failed
+stock acr firmware does not implement it, the reader has to (brizzi_sim does)
+'''
+BURST_ESCAPE_HEADER = b"\xE0\x00\x00\xB0"
+# acr escape ioctl
+BURST_CONTROL_CODE = SCARD_CTL_CODE(3500)
+
+
+def burst_pack(apdus):
+    payload = bytearray(BURST_ESCAPE_HEADER)
+    payload.append(len(apdus))
+    for apdu in apdus:
+        payload.append(len(apdu))
+        payload += apdu
+    return payload
+
+
+def burst_unpack(response):
+    '''
+    [(data, sw1, sw2)] of the commands the reader answered
+    '''
+    results = []
+    offset = 0
+    while offset < len(response):
+        length = response[offset]
+        answer = response[offset + 1:offset + 1 + length]
+        offset += 1 + length
+        if len(answer) < 2:
+            break
+        results.append((list(answer[:-2]), answer[-2], answer[-1]))
+    return results
+
+
+class SamSession:
+    '''
+    long lived sam session, connected once and kept selected between transactions
+    '''
+    SAMCARD_SELECT = toBytes("00A4040C09A00000000000000011")
+
+    # sw1 values that leave the sam applet selected
+    SW1_SELECTED = (0x90, 0x61, 0x6C)
+
+    def __init__(self, connection, slot=None, logger=None):
+        self.connection = connection
+        self.slot = slot
+        self._logger = logger
+        self.connected = False
+        self.selected = False
+        self.atr = None
+        self.select_count = 0
+        self.error_count = 0
+        self.last_used = 0.0
+
+    def open(self):
+        try:
+            if not self.connected:
+                self.connection.connect()
+                self.atr = self.connection.getATR()
+                self.connected = True
+            return True
+        except Exception as err:
+            self._logger and self._logger.error("SAM {} connect failed : {}".format(self.slot, err))
+            self.connected = self.selected = False
+            return False
+
+    def close(self):
+        try:
+            self.connection.disconnect()
+        except Exception:
+            pass
+        self.connected = self.selected = False
+
+    def select(self):
+        try:
+            _, sw1, sw2 = self.connection.transmit(self.SAMCARD_SELECT)
+            self.selected = sw1 == 0x90 and sw2 == 0x00
+        except Exception as err:
+            self._logger and self._logger.error("SAM {} select failed : {}".format(self.slot, err))
+            self.invalidate(True)
+        self.select_count += 1
+        return self.selected
+
+    def ensure_ready(self):
+        # only touch the sam when the session was invalidated by an error or a reset
+        if self.selected:
+            return True
+        return self.open() and self.select()
+
+    def invalidate(self, reset=False):
+        self.selected = False
+        if reset:
+            self.close()
+
+    def health_check(self):
+        '''
+        probe the sam with SCardStatus (getATR), a changed or missing atr means the reader was reset
+        '''
+        if not self.connected:
+            return self.ensure_ready()
+        try:
+            atr = self.connection.getATR()
+            if atr != self.atr:
+                self._logger and self._logger.warning("SAM {} was reset".format(self.slot))
+                self.invalidate(True)
+        except Exception as err:
+            self._logger and self._logger.warning("SAM {} health check failed : {}".format(self.slot, err))
+            self.invalidate(True)
+        return self.ensure_ready()
+
+    # connection interface, so the session can stand in for the sam connection of BrizziProcessor
+    def transmit(self, bytes, protocol=None):
+        try:
+            data, sw1, sw2 = self.connection.transmit(bytes, protocol)
+        except Exception:
+            self.error_count += 1
+            self.invalidate(True)
+            raise
+        if sw1 not in self.SW1_SELECTED:
+            self.error_count += 1
+            self.selected = False
+        return data, sw1, sw2
+
+    def addObserver(self, observer):
+        self.connection.addObserver(observer)
+
+    def deleteObserver(self, observer):
+        self.connection.deleteObserver(observer)
+
+    def connect(self, *args, **kwargs):
+        return self.open()
+
+    def disconnect(self):
+        # the pool owns the connection, transactions must not drop it
+        pass
+
+
+class SamSessionPool:
+    '''
+    pool of pre-selected sam sessions, one per sam slot
+    waiting transactions are served first come first served, a released session goes to the oldest waiter
+    '''
+
+    def __init__(self, logger=None, health_interval=30.0):
+        self._logger = logger
+        self._health_interval = health_interval
+        self._sessions = []
+        self._idle = collections.deque()
+        # [slot, session] entries, session is filled in by release
+        self._waiters = collections.deque()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def has_slot(self, slot):
+        return any(session.slot == slot for session in self._sessions)
+
+    def available(self, slot=None):
+        return any(slot is None or session.slot == slot for session in self._sessions)
+
+    def add_connection(self, connection, slot=None, atr=None):
+        '''
+        atr of a connection already connected, otherwise it is connected here
+        '''
+        session = SamSession(connection, slot, self._logger)
+        if atr is not None:
+            session.connected = True
+            session.atr = atr
+        # connect and select once, before any transaction needs it
+        session.ensure_ready()
+        with self._cond:
+            self._sessions.append(session)
+        self.release(session)
+        self._logger and self._logger.debug("SAM {} added to pool, selected = {}".format(slot, session.selected))
+        return session
+
+    def remove_slot(self, slot):
+        with self._cond:
+            for session in [s for s in self._sessions if s.slot == slot]:
+                self._sessions.remove(session)
+                if session in self._idle:
+                    self._idle.remove(session)
+                session.close()
+
+    def acquire(self, timeout=None, slot=None):
+        '''
+        wait for an idle session, of the given slot when slot is not None
+        '''
+        deadline = timeout is not None and time.monotonic() + timeout
+        with self._cond:
+            # idle sessions exist only when no older waiter could take them, so taking one keeps the order
+            session = next((s for s in self._idle if slot is None or s.slot == slot), None)
+            if session is not None:
+                self._idle.remove(session)
+            else:
+                waiter = [slot, None]
+                self._waiters.append(waiter)
+                while waiter[1] is None:
+                    remaining = deadline and deadline - time.monotonic()
+                    if deadline and remaining <= 0:
+                        self._waiters.remove(waiter)
+                        return None
+                    self._cond.wait(remaining if deadline else None)
+                session = waiter[1]
+        if not session.ensure_ready():
+            self.release(session)
+            return None
+        return session
+
+    def release(self, session):
+        session.last_used = time.monotonic()
+        with self._cond:
+            if session not in self._sessions:
+                return
+            for waiter in self._waiters:
+                if waiter[0] is None or waiter[0] == session.slot:
+                    # hand over directly, so a newcomer cannot overtake the waiter
+                    self._waiters.remove(waiter)
+                    waiter[1] = session
+                    self._cond.notify_all()
+                    return
+            self._idle.append(session)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None, slot=None):
+        session = self.acquire(timeout, slot)
+        try:
+            yield session
+        finally:
+            session is not None and self.release(session)
+
+    def start(self):
+        if self._health_thread is None:
+            self._stop_event.clear()
+            self._health_thread = threading.Thread(target=self._health_loop, name="sam-health", daemon=True)
+            self._health_thread.start()
+
+    def close(self):
+        self._stop_event.set()
+        self._health_thread and self._health_thread.join()
+        self._health_thread = None
+        with self._cond:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._idle.clear()
+
+    def _health_loop(self):
+        while not self._stop_event.wait(self._health_interval):
+            # only idle sessions are probed, busy ones report errors through transmit
+            with self._cond:
+                idle = list(self._idle)
+                self._idle.clear()
+            for session in idle:
+                session.health_check()
+                self.release(session)
+
+
+class ReaderConnectionManager(ReaderObserver):
+    '''
+    one picc connection per reader name, kept across taps and warm reconnected for every new card
+    the pc/sc context and handle of a reader live as long as the reader, not as long as a tap
+    a reader unplugged, or a tap ending on a transport error, drops the connection, the next card builds a new one
+    '''
+
+    def __init__(self, logger=None, metrics=None, protocol=CardConnection.T1_protocol):
+        self._logger = logger
+        self._metrics = METRICS_MAIN if metrics is None else metrics
+        self._protocol = protocol
+        self._connections = {}
+        # prepared at startup, context established and not connected yet, see prepare
+        self._cold = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.prepared = 0
+        self.reconnects = 0
+        self.recoveries = 0
+        self.failures = 0
+        self.setup_time = 0.0
+
+    def _reconnect(self, connection):
+        reconnect = getattr(connection, "reconnect", None)
+        if reconnect is None:
+            # pyscard before reconnect, same handle object, new card handle
+            connection.disconnect()
+            connection.connect(self._protocol)
+        else:
+            reconnect(self._protocol)
+
+    def _dispose(self, connection):
+        try:
+            connection.disconnect()
+        except Exception as err:
+            pass
+        try:
+            # pyscard releasing the pc/sc context of the connection
+            release = getattr(connection, "release", None)
+            release and release()
+        except Exception as err:
+            pass
+
+    def prepare(self, reader, connection=None):
+        '''
+        connection object of a picc reader made before the first card, its pc/sc context is then already set up
+        connection is one already made on reader and not connected to a card
+        '''
+        reader_name = str(reader)
+        with self._lock:
+            if reader_name in self._connections or reader_name in self._cold:
+                connection is not None and self._dispose(connection)
+                return False
+        try:
+            connection = connection if connection is not None else reader.createConnection()
+        except Exception as err:
+            pass
+            self._logger and self._logger.warning("Reader {} not prepared : {}".format(reader_name, err))
+            return False
+        with self._lock:
+            self._cold[reader_name] = connection
+        self.prepared += 1
+        return True
+
+    def acquire(self, card):
+        '''
+        (connection, setup seconds) connected to card, connection is None when the card could not be reached
+        '''
+        reader_name = str(card.reader)
+        start = time.perf_counter()
+        with self._lock:
+            connection = self._connections.pop(reader_name, None)
+            cold = self._cold.pop(reader_name, None)
+        fresh = False
+        if cold is not None:
+            try:
+                # first card on a prepared reader, connected rather than reconnected
+                cold.connect(self._protocol)
+                self.created += 1
+                connection is not None and self._dispose(connection)
+                connection, fresh = cold, True
+            except Exception as err:
+                pass
+                self._dispose(cold)
+        if connection is not None and not fresh:
+            try:
+                self._reconnect(connection)
+                self.reconnects += 1
+            except Exception as err:
+                pass
+                # stale handle, the reader was plugged out and back in or pc/sc restarted
+                self._logger and self._logger.warning("Reader {} reconnect failed, new connection : {}".format(
+                    reader_name, err))
+                self._dispose(connection)
+                self.recoveries += 1
+                connection = None
+        if connection is None:
+            try:
+                connection = card.createConnection()
+                connection.connect(self._protocol)
+                self.created += 1
+            except Exception as err:
+                pass
+                self._logger and self._logger.error(err)
+                connection is not None and self._dispose(connection)
+                self.failures += 1
+                connection = None
+        if connection is not None:
+            with self._lock:
+                self._connections[reader_name] = connection
+        seconds = time.perf_counter() - start
+        self.setup_time += seconds
+        self._metrics and self._metrics.observe_connect(seconds)
+        return connection, seconds
+
+    def release(self, connection, result=None):
+        '''
+        hand connection back after a tap, it is dropped when the tap ended on a transport error
+        '''
+        if connection is None or result is None or result.get('failure_reason') != "transport_error":
+            return
+        with self._lock:
+            for reader_name, kept in list(self._connections.items()):
+                if kept is connection:
+                    del self._connections[reader_name]
+        self._dispose(connection)
+
+    def remove_reader(self, reader_name):
+        with self._lock:
+            connection = self._connections.pop(reader_name, None)
+            cold = self._cold.pop(reader_name, None)
+        connection is not None and self._dispose(connection)
+        cold is not None and self._dispose(cold)
+
+    def update(self, observable, actions):
+        '''
+        reader monitor events, the connection of a removed reader is disposed of
+        '''
+        (addedreaders, removedreaders) = actions
+        for reader in removedreaders:
+            self._logger and self._logger.warning("Reader {} removed".format(reader))
+            self.remove_reader(str(reader))
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values()) + list(self._cold.values())
+            self._connections, self._cold = {}, {}
+        for connection in connections:
+            self._dispose(connection)
+
+    def stats(self):
+        setups = self.created + self.reconnects + self.failures
+        return {
+            'readers': len(self._connections),
+            'prepared': self.prepared,
+            'created': self.created,
+            'reconnects': self.reconnects,
+            'recoveries': self.recoveries,
+            'failures': self.failures,
+            'setup_ms_avg': setups and round(self.setup_time / setups * 1000, 3) or 0
+        }
+
+
+class DetectedCard:
+    '''
+    card found by PresenceMonitor, stands in for smartcard.Card.Card
+    detected is the perf_counter of the state change, removed the one of the card leaving the field
+    '''
+    __slots__ = ('reader', 'atr', 'detected', 'started', 'finished', 'removed', '_reader')
+
+    def __init__(self, reader, atr, detected, reader_object=None):
+        self.reader = str(reader)
+        self.atr = atr
+        self.detected = detected
+        self.started = None
+        self.finished = None
+        self.removed = None
+        self._reader = reader_object
+
+    def createConnection(self):
+        if self._reader is None:
+            from smartcard.pcsc.PCSCReader import PCSCReader
+            self._reader = PCSCReader(self.reader)
+        return self._reader.createConnection()
+
+
+def tap_begin(card, metrics=None):
+    '''
+    seconds from the detection of card to the start of its tap, None for cards of the pyscard card monitor
+    a card that already left the field is not tapped, returns False
+    '''
+    if not isinstance(card, DetectedCard):
+        return None
+    if card.removed is not None:
+        return False
+    card.started = time.perf_counter()
+    seconds = card.started - card.detected
+    (METRICS_MAIN if metrics is None else metrics).observe_detect(seconds)
+    return seconds
+
+
+def tap_end(card, result=None):
+    '''
+    detect_ms and card_removed of a tap added to its result
+    '''
+    if not isinstance(card, DetectedCard) or card.started is None:
+        return result
+    card.finished = time.perf_counter()
+    if result is not None:
+        result['detect_ms'] = round((card.started - card.detected) * 1000, 3)
+        result['card_removed'] = card.removed is not None
+    return result
+
+
+class PresenceMonitor(ReaderObserver):
+    '''
+    card presence of every reader from a blocking SCardGetStatusChange on a thread and pc/sc context per reader,
+    the card observers get the cards as from a CardMonitor, on one dispatch thread
+    a card entering the field is dispatched at once, unless it comes back within debounce seconds of leaving, then
+    it is dispatched once it stayed debounce seconds
+    the wait of a reader starts at min_timeout after a change and doubles up to max_timeout while nothing happens,
+    some reader drivers only report a change on the next call
+    pcsc is the module with the SCard functions, smartcard.scard by default
+    '''
+
+    def __init__(self, logger=None, debounce=0.3, min_timeout=0.1, max_timeout=2.0, pcsc=None, metrics=None):
+        self._logger = logger
+        self._metrics = METRICS_MAIN if metrics is None else metrics
+        self._debounce = debounce
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._pcsc = pcsc
+        self._observers = []
+        self._watchers = {}
+        self._lock = threading.Lock()
+        self._events = queue.Queue()
+        self._dispatcher = None
+        self.detected = 0
+        self.removed = 0
+        self.bounces = 0
+        self.removed_during_tap = 0
+        self.wakeups = 0
+
+    def _scard(self):
+        if self._pcsc is None:
+            import smartcard.scard as pcsc
+            self._pcsc = pcsc
+        return self._pcsc
+
+    def addObserver(self, observer):
+        self._observers.append(observer)
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name="presence-dispatch", daemon=True)
+            self._dispatcher.start()
+
+    def deleteObserver(self, observer):
+        observer in self._observers and self._observers.remove(observer)
+
+    def _dispatch(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            for observer in list(self._observers):
+                try:
+                    observer.update(self, event)
+                except Exception as err:
+                    pass
+                    self._logger and self._logger.error("Presence observer failed : {}".format(err))
+
+    def update(self, observable, actions):
+        '''
+        reader monitor events, a thread watches every added reader until it is removed
+        '''
+        (addedreaders, removedreaders) = actions
+        for reader in removedreaders:
+            self.unwatch(str(reader))
+        for reader in addedreaders:
+            self.watch(reader)
+
+    def watch(self, reader):
+        reader_name = str(reader)
+        with self._lock:
+            if reader_name in self._watchers:
+                return False
+            watcher = self._watchers[reader_name] = {'reader': reader, 'stop': False, 'context': None,
+                                                     'timeout': self._min_timeout}
+        watcher['thread'] = threading.Thread(target=self._watch, args=(reader_name, watcher),
+                                             name="presence-" + reader_name[:24], daemon=True)
+        watcher['thread'].start()
+        return True
+
+    def unwatch(self, reader_name):
+        with self._lock:
+            watcher = self._watchers.pop(reader_name, None)
+        if watcher is not None:
+            watcher['stop'] = True
+            self._cancel(watcher)
+            watcher['thread'].join()
+
+    def _cancel(self, watcher):
+        context = watcher['context']
+        try:
+            context is not None and self._scard().SCardCancel(context)
+        except Exception as err:
+            pass
+
+    def _watch(self, reader_name, watcher):
+        pcsc = self._scard()
+        hresult, context = pcsc.SCardEstablishContext(pcsc.SCARD_SCOPE_USER)
+        if hresult != pcsc.SCARD_S_SUCCESS:
+            self._logger and self._logger.error("Presence {} no context : {}".format(
+                reader_name, pcsc.SCardGetErrorMessage(hresult)))
+            return
+        watcher['context'] = context
+        state = pcsc.SCARD_STATE_UNAWARE
+        card = None
+        # perf_counter of the last removal, and of a card waiting out the debounce
+        left = pending = None
+        try:
+            while not watcher['stop']:
+                timeout = watcher['timeout']
+                if pending is not None:
+                    timeout = max(0.0, pending + self._debounce - time.perf_counter())
+                # rounded up, a wait cut to 0 ms would spin out the last millisecond of a debounce
+                hresult, states = pcsc.SCardGetStatusChange(context, int(timeout * 1000 + 0.999),
+                                                            [(reader_name, state)])
+                now = time.perf_counter()
+                if hresult == pcsc.SCARD_E_TIMEOUT:
+                    watcher['timeout'] = min(self._max_timeout, watcher['timeout'] * 2)
+                    if pending is not None and now - pending >= self._debounce:
+                        # stayed in the field for the debounce, a card of its own
+                        card = self._added(reader_name, watcher, atr, pending)
+                        pending = None
+                    continue
+                if hresult != pcsc.SCARD_S_SUCCESS:
+                    if not watcher['stop'] and hresult != pcsc.SCARD_E_CANCELLED:
+                        self._logger and self._logger.warning("Presence {} : {}".format(
+                            reader_name, pcsc.SCardGetErrorMessage(hresult)))
+                        time.sleep(self._max_timeout)
+                    continue
+                self.wakeups += 1
+                watcher['timeout'] = self._min_timeout
+                _, event_state, atr = states[0]
+                state = event_state & ~pcsc.SCARD_STATE_CHANGED
+                present = bool(event_state & pcsc.SCARD_STATE_PRESENT)
+                if present and card is None and pending is None:
+                    if left is not None and now - left < self._debounce:
+                        pending = now
+                    else:
+                        card = self._added(reader_name, watcher, atr, now)
+                elif not present and pending is not None:
+                    # back out within the debounce, never dispatched
+                    self.bounces += 1
+                    pending, left = None, now
+                elif not present and card is not None:
+                    self._removed(card, now)
+                    card, left = None, now
+        finally:
+            watcher['context'] = None
+            pcsc.SCardReleaseContext(context)
+
+    def _added(self, reader_name, watcher, atr, detected):
+        card = DetectedCard(reader_name, list(atr), detected, watcher['reader'])
+        self.detected += 1
+        self._events.put(([card], []))
+        return card
+
+    def _removed(self, card, now):
+        card.removed = now
+        self.removed += 1
+        if card.started is not None and card.finished is None:
+            self.removed_during_tap += 1
+            self._logger and self._logger.warning("Card removed from {} during the tap, {:.3f} s in".format(
+                card.reader, now - card.started))
+        elif card.started is None:
+            # left before its tap started, the observer skips it
+            self.bounces += 1
+        self._events.put(([], [card]))
+
+    def stop(self):
+        with self._lock:
+            watchers, self._watchers = list(self._watchers.values()), {}
+        for watcher in watchers:
+            watcher['stop'] = True
+            self._cancel(watcher)
+        for watcher in watchers:
+            watcher['thread'].join()
+        if self._dispatcher is not None:
+            self._events.put(None)
+            self._dispatcher.join()
+            self._dispatcher = None
+
+    def stats(self):
+        return {
+            'readers': len(self._watchers),
+            'timeouts_s': dict((name, watcher['timeout']) for name, watcher in list(self._watchers.items())),
+            'detected': self.detected,
+            'removed': self.removed,
+            'bounces': self.bounces,
+            'removed_during_tap': self.removed_during_tap,
+            'wakeups': self.wakeups,
+            'detect_ms_avg': self._metrics and self._metrics.detect.count and round(
+                self._metrics.detect.sum / self._metrics.detect.count * 1000, 3) or 0
+        }
+
+
+class CardSessionEntry:
+    __slots__ = ('card_number', 'cached_at', 'status_at', 'committed_at', 'result')
+
+    def __init__(self, card_number=None, cached_at=0.0):
+        self.card_number = card_number
+        self.cached_at = cached_at
+        self.status_at = None
+        self.committed_at = None
+        self.result = None
+
+
+class CardSessionCache:
+    '''
+    short lived lru cache of card data keyed by card uid
+    the card number skips its read for ttl seconds, a good card status skips the aid1 reads for status_ttl seconds
+    only, a card blocked since is let through for at most status_ttl seconds
+    a committed transaction seen again within debounce seconds is a re-tap and is not debited again
+    '''
+
+    def __init__(self, max_entries=1024, ttl=300.0, debounce=3.0, status_ttl=30.0):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._debounce = debounce
+        self._status_ttl = status_ttl
+        self.hits = 0
+        self.misses = 0
+        self.retaps = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _entry(self, uid, now):
+        entry = self._entries.get(uid)
+        if entry is not None and now - entry.cached_at > self._ttl:
+            del self._entries[uid]
+            self.expirations += 1
+            entry = None
+        return entry
+
+    def _store(self, uid, now):
+        entry = self._entry(uid, now)
+        if entry is None:
+            entry = self._entries[uid] = CardSessionEntry(cached_at=now)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        self._entries.move_to_end(uid)
+        return entry
+
+    def lookup(self, uid):
+        '''
+        (card number or None, True when its status was found good within status_ttl,
+        result of the re-tapped transaction or None)
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(uid, now)
+            if entry is None or entry.card_number is None:
+                self.misses += 1
+                return None, False, None
+            self._entries.move_to_end(uid)
+            status_checked = entry.status_at is not None and now - entry.status_at <= self._status_ttl
+            if entry.committed_at is not None and now - entry.committed_at <= self._debounce:
+                self.retaps += 1
+                return entry.card_number, status_checked, entry.result
+            self.hits += 1
+            return entry.card_number, status_checked, None
+
+    def put_static(self, uid, card_number):
+        # card number and good status read now
+        now = time.monotonic()
+        with self._lock:
+            entry = self._store(uid, now)
+            entry.card_number = card_number
+            entry.status_at = now
+
+    def record_commit(self, uid, result):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._store(uid, now)
+            entry.card_number = result['card_number']
+            entry.committed_at = now
+            # fingerprint of the committed transaction, returned as is on a re-tap
+            entry.result = dict(result)
+
+    def stats(self):
+        lookups = self.hits + self.retaps + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'retaps': self.retaps,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': lookups and round((self.hits + self.retaps) / lookups, 4) or 0.0
+        }
+
+
+'''
+status decoding, precomputed so a declined card is told apart without any exception
+'''
+SW_MEANINGS = {
+    0x6281: "data_corrupted",
+    0x6300: "verification_failed",
+    0x6581: "memory_failure",
+    0x6700: "wrong_length",
+    0x6982: "security_not_satisfied",
+    0x6983: "key_blocked",
+    0x6985: "conditions_not_satisfied",
+    0x6A80: "wrong_data",
+    0x6A82: "file_not_found",
+    0x6A86: "wrong_p1p2",
+    0x6D00: "ins_not_supported",
+    0x6E00: "cla_not_supported",
+    0x6F00: "unknown_error",
+}
+SW1_MEANINGS = tuple({
+    0x61: "more_data",
+    0x62: "warning",
+    0x63: "warning",
+    0x64: "execution_error",
+    0x65: "memory_error",
+    0x67: "wrong_length",
+    0x68: "cla_function_not_supported",
+    0x69: "command_not_allowed",
+    0x6A: "wrong_parameters",
+    0x6B: "wrong_p1p2",
+    0x6C: "wrong_le",
+    0x6D: "ins_not_supported",
+    0x6E: "cla_not_supported",
+}.get(sw1) for sw1 in range(256))
+# desfire native status, first data byte of a picc response through the acr reader
+DESFIRE_STATUS = tuple({
+    0x00: "ok",
+    0x0C: "no_changes",
+    0x0E: "out_of_eeprom",
+    0x1C: "illegal_command",
+    0x1E: "integrity_error",
+    0x40: "no_such_key",
+    0x7E: "length_error",
+    0x9D: "permission_denied",
+    0x9E: "parameter_error",
+    0xA0: "application_not_found",
+    0xA1: "application_integrity_error",
+    0xAE: "authentication_error",
+    0xAF: "additional_frame",
+    0xBE: "boundary_error",
+    0xC1: "picc_integrity_error",
+    0xCA: "command_aborted",
+    0xCD: "picc_disabled",
+    0xCE: "count_error",
+    0xDE: "duplicate_error",
+    0xEE: "eeprom_error",
+    0xF0: "file_not_found",
+    0xF1: "file_integrity_error",
+}.get(status, "status_{:02X}".format(status)) for status in range(256))
+
+
+def sw_reason(sw):
+    # 91xx is a desfire status wrapped in iso 7816, 9100 is no reason and stays sw_9100
+    if sw >> 8 == 0x91 and sw & 0xFF:
+        return DESFIRE_STATUS[sw & 0xFF]
+    return SW_MEANINGS.get(sw) or SW1_MEANINGS[sw >> 8] or "sw_{:04X}".format(sw)
+
+
+def picc_ok(data, sw1, sw2):
+    '''
+    desfire status ok answered with 9000, False for a transport error
+    '''
+    return bool(data) and data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
+
+
+# card log record, as written by picc_write_log
+LOG_RECORD_SIZE = 32
+
+
+def log_record(raw):
+    '''
+    fields of one card log record, date and time are the yymmdd and hhmmss of the debit
+    '''
+    return {
+        'mid': raw[0:8].hex().upper(),
+        'tid': raw[8:16].hex().upper(),
+        'date': raw[16:19].hex(),
+        'time': raw[19:22].hex(),
+        'type': "{:02X}".format(raw[22]),
+        'amount': int.from_bytes(raw[23:26], 'little'),
+        'balance_before': int.from_bytes(raw[26:29], 'little'),
+        'balance_after': int.from_bytes(raw[29:32], 'little')
+    }
+
+
+class StepResult:
+    '''
+    outcome of one transaction step, sw and desfire status of its last exchange, times in ms from the tap start
+    '''
+    __slots__ = ('step', 'target', 'ok', 'sw', 'status', 'reason', 'start_ms', 'duration_ms')
+
+    def __init__(self, step, target, ok, sw=None, status=None, reason=None, start_ms=0.0, duration_ms=0.0):
+        self.step = step
+        self.target = target
+        self.ok = ok
+        self.sw = sw
+        self.status = status
+        self.reason = reason
+        self.start_ms = start_ms
+        self.duration_ms = duration_ms
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        return "StepResult({}, {}, sw={}, reason={}, {:.3f} ms)".format(
+            self.step, self.ok and "ok" or "failed", self.sw is not None and "{:04X}".format(self.sw) or None,
+            self.reason, self.duration_ms)
+
+
+def step_failure_reason(sw, status, error=None, declined=None):
+    '''
+    decline reason, else the transport error, the desfire status or the status word of the failed exchange
+    '''
+    if declined is not None:
+        return declined
+    if error is not None:
+        return error
+    if status is not None and status != 0x00:
+        return DESFIRE_STATUS[status]
+    if sw is not None and sw != 0x9000:
+        return sw_reason(sw)
+    return sw is None and "no_exchange" or "rejected"
+
+
+class CardDenylist:
+    '''
+    blocked card numbers from a text file, one number per line, # starts a comment
+    the file is reloaded when its mtime changed, checked at most every check_interval seconds on lookup
+    '''
+
+    def __init__(self, path, check_interval=5.0, logger=None):
+        self.path = path
+        self._check_interval = check_interval
+        self._logger = logger
+        self._numbers = frozenset()
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.reload()
+
+    def __len__(self):
+        return len(self._numbers)
+
+    def __contains__(self, card_number):
+        now = time.monotonic()
+        if now - self._checked >= self._check_interval:
+            self._checked = now
+            self.reload()
+        return card_number in self._numbers
+
+    def reload(self, force=False):
+        '''
+        load the file again when it changed, a file that can not be read keeps the current list
+        '''
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime and not force:
+                    return False
+                with open(self.path) as denylist_file:
+                    numbers = frozenset(line.split("#", 1)[0].strip() for line in denylist_file)
+                # swapped whole, lookups never see a half loaded list
+                self._numbers = numbers - {""}
+                self._mtime = mtime
+                self.reloads += 1
+                self._logger and self._logger.info("Denylist loaded, {} cards".format(len(self._numbers)))
+                return True
+            except Exception as err:
+                pass
+                self._logger and self._logger.error("Denylist {} not loaded : {}".format(self.path, err))
+                return False
+
+
+# packed bcd of 0 to 99
+BCD = bytes(value // 10 << 4 | value % 10 for value in range(100))
+
+
+class TransactionClock:
+    '''
+    the wall clock read once per transaction, the sam hash, the card log, the journal and the result all carry
+    its date and time, each encoding built once here
+    start is the perf_counter taken with it, the timings of the transaction count from there
+    '''
+    __slots__ = ('wall', 'start', 'local', 'month', 'date_ascii', 'time_ascii', 'date_bcd', 'time_bcd',
+                 'date_number', 'date_text', 'time_text')
+
+    def __init__(self, wall=None, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.wall = time.time() if wall is None else wall
+        local = self.local = time.localtime(self.wall)
+        year, self.month, day = local.tm_year % 100, local.tm_mon, local.tm_mday
+        hour, minute, second = local.tm_hour, local.tm_min, local.tm_sec
+        # sam hash, ascii ddmmyy and hhmmss
+        self.date_ascii = b"%02d%02d%02d" % (day, self.month, year)
+        self.time_ascii = b"%02d%02d%02d" % (hour, minute, second)
+        # card log and last transaction, bcd yymmdd and hhmmss
+        self.date_bcd = bytes((BCD[year], BCD[self.month], BCD[day]))
+        self.time_bcd = bytes((BCD[hour], BCD[minute], BCD[second]))
+        # ledger, yymmdd as a number
+        self.date_number = (year * 100 + self.month) * 100 + day
+        # result, journal and settlement
+        self.date_text = "%04d-%02d-%02d" % (local.tm_year, self.month, day)
+        self.time_text = "%02d:%02d:%02d" % (hour, minute, second)
+
+
+class TransactionContext:
+    '''
+    state shared by the steps of one debit transaction
+    '''
+
+    def __init__(self, debet_amount=0, mid=None, tid=None, proc_code=808117, ref_number=1, batch_number=1,
+                 clock=None):
+        self.debet_amount = debet_amount
+        self.mid = mid
+        self.tid = tid
+        self.proc_code = proc_code
+        self.ref_number = ref_number
+        self.batch_number = batch_number
+
+        # card and sam data, filled in by the steps
+        self.card_number = None
+        self.card_uid = None
+        self.card_key = None
+        self.sam_random_key = None
+        self.card_random_number = None
+        self.last_trans_date = None
+        self.last_trans_akum_debet = None
+        self.balance = None
+        self.hash = None
+
+        # debit state, an uncommitted debit must be aborted
+        self.debited = False
+        self.committed = False
+        self.failed_step = None
+
+        # StepResult of every step run, first failed one
+        self.timing = []
+        self.failure = None
+        # date and time of the whole transaction, start is its perf_counter
+        self.clock = clock is not None and clock or TransactionClock()
+        self.start = self.clock.start
+
+        # journal transaction id
+        self.tx_id = None
+
+        # card number came from the card session cache, its read is skipped,
+        # status_cached also skips the aid1 select and status read
+        self.cached = False
+        self.status_cached = False
+
+        # reason the card was turned down before any debit
+        self.declined = None
+
+        # reason the card state does not match the balance ledger, the tap still goes on
+        self.anomaly = None
+
+        # tariff rule that decided debet_amount
+        self.fare_rule = None
+
+        # raw log records read by an inspection
+        self.log = None
+
+        # pooled sam session held from the first sam step to the end of the transaction, see sam_lease
+        self.sam_session = None
+        self.sam_busy = False
+        self.sam_ended = False
+        self.sam_lock = threading.Lock()
+
+
+class TransactionStep:
+    '''
+    one exchange of the debit flow, run on the sam or picc connection after its dependencies succeeded
+    '''
+    __slots__ = ('name', 'target', 'deps', 'run', 'skip')
+
+    def __init__(self, name, target, deps, run, skip=None):
+        self.name = name
+        self.target = target
+        self.deps = deps
+        self.run = run
+        # skip(ctx) True counts the step as done without running it
+        self.skip = skip
+
+
+class TransactionEngine:
+    '''
+    runs a declared step graph, sam and picc steps run concurrently on their own connection
+    each connection keeps the declared order of its steps, so commit/abort ordering stays as declared
+    '''
+
+    def __init__(self, steps, concurrent=True, logger=None, metrics=None, exchanges=None):
+        self._logger = logger
+        self._metrics = metrics
+        # target -> [sw, desfire status, error] of the last exchange, written by the step functions
+        self._exchanges = exchanges
+        self._steps = tuple(steps)
+        self._concurrent = concurrent
+        self._executor = None
+
+        # dependencies must be declared before the step using them
+        declared = set()
+        for step in self._steps:
+            missing = [dep for dep in step.deps if dep not in declared]
+            if missing:
+                raise ValueError("step {} depends on undeclared {}".format(step.name, missing))
+            declared.add(step.name)
+
+    @property
+    def steps(self):
+        return self._steps
+
+    def close(self):
+        self._executor and self._executor.shutdown()
+        self._executor = None
+
+    def run_step(self, step, ctx):
+        '''
+        run one step for ctx, timed and recorded, return its StepResult
+        '''
+        if step.skip is not None and step.skip(ctx):
+            return StepResult(step.name, step.target, True, reason="skipped")
+
+        exchange = self._exchanges and self._exchanges.get(step.target)
+        if exchange:
+            exchange[0] = exchange[1] = exchange[2] = None
+        start = time.perf_counter()
+        ok = False
+        reason = None
+        try:
+            ok = bool(step.run(ctx))
+        except Exception as err:
+            pass
+            self._logger and self._logger.error(err)
+            reason = "exception"
+        end = time.perf_counter()
+
+        sw, status, error = exchange and exchange or (None, None, None)
+        if not ok:
+            reason = reason or step_failure_reason(sw, status, error, ctx.declined)
+        result = StepResult(step.name, step.target, ok, sw, status, reason, (start - ctx.start) * 1000,
+                            (end - start) * 1000)
+        self._metrics and self._metrics.observe_step(step.name, end - start)
+        ctx.timing.append(result)
+        if not ok and ctx.failure is None:
+            ctx.failure = result
+            ctx.failed_step = ctx.failed_step or step.name
+        return result
+
+    def run(self, ctx):
+        '''
+        run all steps for ctx, return True when every step succeeded
+        '''
+        done = dict((step.name, threading.Event()) for step in self._steps)
+        ok = {}
+        failed = threading.Event()
 
-    def gate_close(self):
-        self.gate_on_off()
+        def run_lane(steps):
+            index = 0
+            try:
+                for index, step in enumerate(steps):
+                    for dep in step.deps:
+                        done[dep].wait()
+                        if not ok.get(dep):
+                            failed.set()
+                    if failed.is_set():
+                        return
+
+                    result = self.run_step(step, ctx).ok
+                    ok[step.name] = result
+                    done[step.name].set()
+                    if not result:
+                        failed.set()
+                        return
+                index = len(steps)
+            finally:
+                # never leave the other connection waiting on a step that will not run
+                for step in steps[index:]:
+                    done[step.name].set()
+
+        if not self._concurrent:
+            run_lane(self._steps)
+        else:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                       thread_name_prefix="brizzi-sam")
+            sam_future = self._executor.submit(run_lane, [step for step in self._steps if step.target == 'sam'])
+            run_lane([step for step in self._steps if step.target != 'sam'])
+            sam_future.result()
+
+        return not failed.is_set() and len(ok) == len(self._steps)
 
 
 class BrizziProcessor:
@@ -112,17 +1861,155 @@ class BrizziProcessor:
     PICC_WRITE_LOG = "3B01000000200000{:0<16.16}{:0<16.16}{:0<6.6}{:0<6.6}EB{:0<6.6}{:0<6.6}{:0<6.6}"
     PICC_WRITE_LAST_TRANSACTION = "3D03000000070000{:0<6.6}{:0<8.8}"
 
+    '''
+    debit flow as a dependency graph, (step, connection, dependencies)
+    the sam hash only needs the card random number so it overlaps the picc balance read and debit,
+    the commit waits for both
+    '''
+    TRANSACTION_STEPS = (
+        ("sam_prepare", "sam", ()),
+        ("card_get_uid", "picc", ()),
+        ("card_select_aid1", "picc", ("card_get_uid",)),
+        ("card_get_number", "picc", ("card_select_aid1",)),
+        ("card_precheck", "picc", ("card_get_number",)),
+        ("card_get_status", "picc", ("card_precheck",)),
+        ("card_select_aid3", "picc", ("card_get_status",)),
+        ("card_request_key_card", "picc", ("card_select_aid3",)),
+        ("sam_authenticate_key", "sam", ("sam_prepare", "card_get_number", "card_get_uid", "card_request_key_card")),
+        ("card_authenticate", "picc", ("sam_authenticate_key",)),
+        ("card_get_last_transaction_date", "picc", ("card_authenticate",)),
+        ("card_get_balance", "picc", ("card_get_last_transaction_date",)),
+        ("sam_create_hash", "sam", ("card_get_balance",)),
+        ("card_debet_balance", "picc", ("card_get_balance",)),
+        ("card_write_log", "picc", ("card_debet_balance",)),
+        ("card_write_last_transaction", "picc", ("card_write_log",)),
+        ("card_commit_transaction", "picc", ("card_write_last_transaction", "sam_create_hash")),
+    )
+
+    # debit, log and last transaction folded into one picc exchange, commit still waits for the hash
+    TRANSACTION_STEPS_BURST = tuple(step for step in TRANSACTION_STEPS if step[0] not in (
+        "card_debet_balance", "card_write_log", "card_write_last_transaction", "card_commit_transaction")) + (
+        ("card_write_burst", "picc", ("card_get_balance",)),
+        ("card_commit_transaction", "picc", ("card_write_burst", "sam_create_hash")),
+    )
+
+    # read only readout of card_inspect, authenticated like a debit, no hash and no write
+    INSPECTION_STEPS = (
+        ("sam_prepare", "sam", ()),
+        ("card_get_uid", "picc", ()),
+        ("card_select_aid1", "picc", ("card_get_uid",)),
+        ("card_get_number", "picc", ("card_select_aid1",)),
+        ("card_select_aid3", "picc", ("card_get_number",)),
+        ("card_request_key_card", "picc", ("card_select_aid3",)),
+        ("sam_authenticate_key", "sam", ("sam_prepare", "card_get_number", "card_get_uid", "card_request_key_card")),
+        ("card_authenticate", "picc", ("sam_authenticate_key",)),
+        ("card_get_last_transaction_date", "picc", ("card_authenticate",)),
+        ("card_read_balance", "picc", ("card_get_last_transaction_date",)),
+        ("card_read_log", "picc", ("card_read_balance",)),
+    )
+
+    '''
+    compiled pdu, same layout as the format strings above
+    '''
+    APDU_TEMPLATES = dict((template.name, template) for template in (
+        ApduTemplate("sam_select", "00A4040C09A00000000000000011"),
+        ApduTemplate("sam_auth_key", "80B0000020", ("card_number", 8, apdu_fill_hex),
+                     ("card_uid", 7, apdu_fill_hex), "FF0000030080000000", ("key_card", 8, apdu_fill_hex)),
+        ApduTemplate("sam_create_hash", "80B4000058", ("card_number", 8, apdu_fill_hex),
+                     ("card_uid", 7, apdu_fill_hex), "FF0000030080000000",
+                     ("card_random_number", 8, apdu_fill_hex), ("card_number_ascii", 16, apdu_fill_ascii),
+                     ("amount", 10, apdu_fill_decimal_ljust), ("date", 6, apdu_fill_ascii),
+                     ("time", 6, apdu_fill_ascii), ("proc_code", 6, apdu_fill_decimal),
+                     ("ref_number", 6, apdu_fill_decimal), ("batch_number", 2, apdu_fill_decimal), "FFFFFFFF"),
+        ApduTemplate("picc_select_aid1", "5A010000"),
+        ApduTemplate("picc_get_card_number", "BD00000000170000"),
+        ApduTemplate("picc_get_card_status", "BD01000000200000"),
+        ApduTemplate("picc_select_aid3", "5A030000"),
+        ApduTemplate("picc_request_key_card", "0A00"),
+        ApduTemplate("picc_get_card_uid", "FFCA000000"),
+        ApduTemplate("picc_card_auth", "AF", ("random_key", 16, apdu_fill_hex)),
+        ApduTemplate("picc_get_last_transaction_date", "BD03000000070000"),
+        ApduTemplate("picc_get_balance", "6C00"),
+        ApduTemplate("picc_debet_balance", "DC00", ("amount", 3, apdu_fill_le), "00"),
+        ApduTemplate("picc_commit_transaction", "C7"),
+        ApduTemplate("picc_abort_transaction", "A7"),
+        ApduTemplate("pdu_get_more_data", "00C00000", ("length", 1, apdu_fill_byte)),
+        ApduTemplate("picc_write_log", "3B01000000200000", ("mid", 8, apdu_fill_hex), ("tid", 8, apdu_fill_hex),
+                     ("date", 3, apdu_fill_hex), ("time", 3, apdu_fill_hex), "EB", ("amount", 3, apdu_fill_le),
+                     ("balance_before", 3, apdu_fill_le), ("balance_after", 3, apdu_fill_le)),
+        ApduTemplate("picc_write_last_transaction", "3D03000000070000", ("date", 3, apdu_fill_hex),
+                     ("akum_debet", 4, apdu_fill_be)),
+        ApduTemplate("picc_read_log", "BB01", ("offset", 3, apdu_fill_le), ("count", 3, apdu_fill_le)),
+        ApduTemplate("picc_additional_frame", "AF"),
+    ))
+
     def __init__(self, logger=None, sam_connection=None, picc_connection=None, mid="1122334455667788",
-                 tid="aabbccddeeff0000", debug_mode=True):
+                 tid="aabbccddeeff0000", debug_mode=True, sam_pool=None, sam_acquire_timeout=5.0, pipelined=True,
+                 sam_slot=None, metrics=None, journal=None, card_cache=None, write_burst=False,
+                 burst_control_code=None, denylist=None, sam_le=None, trace=None,
+                 picc_setup=None, ledger=None, tariff=None, lane=None, settlement=None):
+        # own copy of the compiled pdu buffers
+        self._apdu = dict((name, template.copy()) for name, template in self.APDU_TEMPLATES.items())
+
+        # latency instrumentation, on by default, False to disable
+        self._metrics = METRICS_MAIN if metrics is None else metrics
+        # apdu ring buffer and sampled apdu log, on by default, False to disable
+        self._trace = TRACE_MAIN if trace is None else trace
+        # transaction journal, see brizzi_journal.TransactionJournal
+        self._journal = journal
+        # CardSessionCache shared by the processors of a lane or gate
+        self._card_cache = card_cache
+        # write_burst sends debit, log and last transaction back to back as one step,
+        # in one escape exchange when the reader takes the burst on burst_control_code
+        self._burst_control_code = burst_control_code
+        # CardDenylist or any container of blocked card numbers
+        self._denylist = denylist
+        # brizzi_ledger.BalanceLedger, balance of the card checked before and recorded after a debit
+        self._ledger = ledger
+        # brizzi_tariff.TariffEngine, the fare of lane replaces the debit amount once the card history is read
+        self._tariff = tariff
+        self._lane = lane
+        # ref and batch number allocator, see brizzi_settlement.SettlementCounters, numbers are taken in place of
+        # ref_number and batch_number right before the sam hash, a tap declined or failed before it takes none
+        self._settlement = settlement
+        # le sent with the sam commands answering data, 0x00 lets a t=1 sam answer without get response
+        self._sam_le = sam_le
+
+        # picc_setup is the seconds ReaderConnectionManager.acquire took to connect picc_connection, such a
+        # connection is already open and stays open for the next card, otherwise it is opened and closed here
+        self._picc_owned = picc_setup is None
+        self._picc_open = not self._picc_owned
+        self.connect_seconds = picc_setup or 0.0
+
+        # sw and desfire status of the last exchange per connection, read by the engine for StepResult
+        self._exchanges = {'sam': [None, None, None], 'picc': [None, None, None]}
+
+        # pipelined runs sam and picc steps concurrently, otherwise in declared order
+        self._pipelined = pipelined
+        self._engine = self._build_engine(write_burst and self.TRANSACTION_STEPS_BURST or self.TRANSACTION_STEPS,
+                                          logger)
+        # built by the first card_inspect
+        self._inspect_engine = None
+        self._inspect_log_records = 0
+
         try:
             # get setting
             self._logger = logger
             self._mid = mid
             self._tid = tid
+            self._sam_pool = sam_pool
+            self._sam_acquire_timeout = sam_acquire_timeout
+            self._sam_slot = sam_slot
             self.initialize = False
 
             # check sam and picc connection object
-            if sam_connection is None or picc_connection is None:
+            if sam_pool is not None and picc_connection is not None:
+                # sam sessions are owned by the pool and handed out per transaction
+                self._reader_sam_connection = None
+                self.bind(picc_connection, picc_setup)
+
+                self._logger and self._logger.debug("Initializing picc reader with SAM pool OK")
+            elif sam_connection is None or picc_connection is None:
                 self._logger and self._logger.error("SAM and or PICC connection is unavailable")
             else:
                 # assign to sam and picc interface
@@ -146,13 +2033,48 @@ class BrizziProcessor:
             pass
             self._logger and self._logger.error(err)
 
+    def _build_engine(self, steps, logger=None):
+        return TransactionEngine(
+            [TransactionStep(name, target, deps, getattr(self, "_step_" + name), getattr(self, "_skip_" + name, None))
+             for name, target, deps in steps],
+            self._pipelined, logger, self._metrics, self._exchanges)
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # self.close_all_connection()
+        self.close()
         return True
 
+    def bind(self, picc_connection, picc_setup=None):
+        '''
+        serve the next card on picc_connection, picc_setup as for the constructor, sam pool processors only
+        the compiled pdu buffers and the engines with their sam thread are kept from the card before
+        '''
+        self.release()
+        self._picc_owned = picc_setup is None
+        self._picc_open = not self._picc_owned
+        self.connect_seconds = picc_setup or 0.0
+        self._reader_picc_connection = picc_connection
+        self.initialize = self._sam_pool is not None and picc_connection is not None
+        self.initialize and not self._picc_open and self.card_open_connection()
+        return self.initialize
+
+    def release(self):
+        '''
+        end of a card, disconnect a picc connection opened here
+        '''
+        if self._picc_owned and self._picc_open:
+            self.card_close_connection()
+
+    def close(self):
+        '''
+        stop the engine and disconnect a picc connection opened here, the sam stays with its pool or owner
+        '''
+        self.release()
+        self._engine.close()
+        self._inspect_engine and self._inspect_engine.close()
+
     def close_all_connection(self):
         try:
             try:
@@ -170,19 +2092,26 @@ class BrizziProcessor:
 
     def card_close_connection(self):
         try:
+            self._picc_open = False
             self._reader_picc_connection.disconnect()
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
 
     def card_open_connection(self):
+        start = time.perf_counter()
         try:
             self._reader_picc_connection.connect(CardConnection.T1_protocol)
+            self._picc_open = True
             return True
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
             return False
+        finally:
+            seconds = time.perf_counter() - start
+            self.connect_seconds += seconds
+            self._metrics and self._metrics.observe_connect(seconds)
 
     def sam_close_connection(self):
         try:
@@ -200,376 +2129,737 @@ class BrizziProcessor:
             self._logger and self._logger.error(err)
             return False
 
-    def send_apdu(self, apdu_text=None, to_sam=True):
+    # get response and 6Cxx re-issues followed for one chained command
+    CHAIN_LIMIT = 16
+
+    def send_apdu(self, apdu_text=None, to_sam=True, chain=False, le=None):
+        '''
+        apdu_text is either hex text or a compiled apdu buffer, le is set on the command when given
+        chain follows 61xx with get response and re-issues on 6Cxx, the parts of a 61xx answer come back joined in
+        one bytearray
+        '''
+        # pyscard transmit takes a list of int
+        apdu = isinstance(apdu_text, str) and toBytes(apdu_text) or list(apdu_text)
+        le is not None and apdu_with_le(apdu, le)
+        data, sw1, sw2 = self._transmit(apdu, to_sam)
+        if not chain:
+            return data, sw1, sw2
+
+        response = None
+        for _ in range(self.CHAIN_LIMIT):
+            if sw1 == 0x6C:
+                # wrong le, same command again with the length the card asked for
+                data, sw1, sw2 = self._transmit(apdu_with_le(apdu, sw2), to_sam)
+            elif sw1 == 0x61:
+                if response is None:
+                    response = bytearray(data)
+                else:
+                    response.extend(data)
+                apdu = list(self._apdu['pdu_get_more_data'].build(sw2))
+                data, sw1, sw2 = self._transmit(apdu, to_sam)
+            else:
+                break
+        if response is not None and data is not None:
+            response.extend(data)
+            data = response
+        return data, sw1, sw2
+
+    def _transmit(self, apdu, to_sam):
+        start = time.perf_counter()
         try:
             if to_sam:
-                self._logger and self._logger.debug("Transmit to SAMCARD = {}".format(apdu_text))
-                data, sw1, sw2 = self._reader_sam_connection.transmit(toBytes(apdu_text))
+                data, sw1, sw2 = self._reader_sam_connection.transmit(apdu)
             else:
-                self._logger and self._logger.debug("Transmit to PICC = {}".format(apdu_text))
-                data, sw1, sw2 = self._reader_picc_connection.transmit(toBytes(apdu_text))
-
-            self._logger and self._logger.debug("[SW1SW2] : DATA = [%02X%02X] : %s" % (sw1, sw2, toHexString(data)))
+                data, sw1, sw2 = self._reader_picc_connection.transmit(apdu)
+            self._metrics and self._metrics.observe_apdu(to_sam, time.perf_counter() - start, sw1, sw2)
+            exchange = self._exchanges[to_sam and 'sam' or 'picc']
+            if to_sam:
+                exchange[0] = sw1 << 8 | sw2
+            else:
+                self._picc_exchange(exchange, data, sw1, sw2)
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
+            self._metrics and self._metrics.observe_transport_error(to_sam)
+            self._exchanges[to_sam and 'sam' or 'picc'][2] = "transport_error"
             data = sw1 = sw2 = None
 
+        # kept as captured, formatted only when sampled or dumped
+        self._trace and self._trace.record(id(self), to_sam, apdu, data, sw1, sw2, time.perf_counter() - start)
         return data, sw1, sw2
 
+    @staticmethod
+    def _picc_exchange(exchange, data, sw1, sw2):
+        # the acr reader hands the last two bytes of a longer picc answer over as sw1 sw2
+        exchange[0] = len(data) <= 1 and sw1 << 8 | sw2 or None
+        exchange[1] = data[0] if data else None
+        if not data and exchange[0] in (0x9000, 0x9100):
+            # a success status word without the desfire status byte, a protocol error and not an ok
+            exchange[2] = "short_response"
+
     def sam_select(self):
+        _, sw1, sw2 = self.send_apdu(self._apdu['sam_select'].build())
+        return sw1 == 0x90 and sw2 == 0
+
+    def sam_prepare(self):
+        # a pooled session stays selected, only select again after an error or reset
+        if self._sam_pool is not None:
+            return self._sam_pool.available(self._sam_slot)
+        if isinstance(self._reader_sam_connection, SamSession):
+            return self._reader_sam_connection.ensure_ready()
+        return self.sam_select()
+
+    @contextlib.contextmanager
+    def sam_lease(self, ctx):
+        '''
+        pooled sam session of the transaction of ctx, leased by its first sam step and kept until sam_release
+        the sam keeps the card authenticated by sam_authenticate_key for sam_create_hash, no other card may come
+        between them on the same sam
+        '''
+        if self._sam_pool is None:
+            yield self._reader_sam_connection is not None
+            return
+
+        with ctx.sam_lock:
+            ended = ctx.sam_ended
+            ctx.sam_busy = not ended
+            sam_session = ctx.sam_session
+        if ended:
+            yield False
+            return
         try:
-            _, sw1, sw2 = self.send_apdu(self.SAMCARD_SELECT)
-            select_result = sw1 == 0x90 and sw2 == 0
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            select_result = False
-        return select_result
+            if sam_session is None:
+                sam_session = self._sam_pool.acquire(self._sam_acquire_timeout, self._sam_slot)
+                ctx.sam_session = sam_session
+            if sam_session is None:
+                self._logger and self._logger.error("No SAM session available")
+                yield False
+            else:
+                self._reader_sam_connection = sam_session
+                yield True
+        finally:
+            self._reader_sam_connection = None
+            with ctx.sam_lock:
+                ctx.sam_busy = False
+                ended = ctx.sam_ended
+            # the transaction ended while this step still ran, e.g. on a timeout, the session goes back here
+            ended and self._sam_release_session(ctx)
+
+    def sam_release(self, ctx):
+        '''
+        end of the transaction of ctx, its sam session goes back to the pool, after the sam step still running
+        '''
+        with ctx.sam_lock:
+            ctx.sam_ended = True
+            busy = ctx.sam_busy
+        busy or self._sam_release_session(ctx)
+
+    def _sam_release_session(self, ctx):
+        with ctx.sam_lock:
+            sam_session, ctx.sam_session = ctx.sam_session, None
+        sam_session is not None and self._sam_pool.release(sam_session)
 
     def card_select_aid1(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_SELECT_AID1, False)
-            select_result = sw1 == 0x90 and sw2 == 0 and data[0] == 0
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            select_result = False
-        return select_result
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_select_aid1'].build(), False)
+        return picc_ok(data, sw1, sw2)
 
     def card_get_number(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_GET_CARD_NUMBER, False)
-            return toHexString(data[4:12], PACK)
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_get_card_number'].build(), False)
+        if not (data and data[0] == 0x00 and len(data) >= 12):
             return None
+        return response_view(data)[4:12].hex().upper()
 
     def card_get_status(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_GET_CARD_STATUS, False)
-            return data[4:6] == [0x61, 0x61]
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            return False
+        '''
+        True for an active card, False for a blocked one, None when the answer holds no status
+        '''
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_get_card_status'].build(), False)
+        # desfire status and the status file up to its two status bytes
+        if not (data and data[0] == 0x00 and len(data) >= 6):
+            return None
+        return response_view(data)[4:6] == b'\x61\x61'
 
     def card_select_aid3(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_SELECT_AID3, False)
-            select_result = sw1 == 0x90 and sw2 == 0 and data[0] == 0
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            select_result = False
-
-        return select_result
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_select_aid3'].build(), False)
+        return picc_ok(data, sw1, sw2)
 
     def card_request_key_card(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_REQUEST_KEY_CARD, False)
-            card_key = data[1:] + [sw1, sw2]
-            return toHexString(card_key, PACK)
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_request_key_card'].build(), False)
+        # additional frame status followed by the 8 byte challenge, the last two in sw1 sw2
+        if not (data and data[0] == 0xAF and len(data) == 7):
             return None
+        return response_view(data, sw1, sw2)[1:].hex().upper()
 
     def card_get_uid(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_GET_CARD_UID, False)
-            return toHexString(data, PACK)
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_get_card_uid'].build(), False)
+        if not (data and sw1 == 0x90 and sw2 == 0x00):
             return None
+        return response_view(data).hex().upper()
 
     def pdu_get_more_data(self, data_len=0, to_sam=True):
-        try:
-            return self.send_apdu(self.PDU_GET_MORE_DATA.format(data_len), to_sam)
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            return None
+        return self.send_apdu(self._apdu['pdu_get_more_data'].build(data_len), to_sam)
 
     def sam_authenticate_key(self, card_number_in, card_uid_in, key_card_in):
-        try:
-            random_key = None
-            data, sw1, sw2 = self.send_apdu(
-                self.SAMCARD_AUTH_KEY.format(card_number=card_number_in, card_uid=card_uid_in, key_card=key_card_in))
-            if sw1 == 0x61:
-                data, sw1, sw2 = self.pdu_get_more_data(sw2)
-                if sw1 == 0x90 and sw2 == 0x00:
-                    random_key = toHexString(data[-16:], PACK)
-            else:
-                random_key = None
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            random_key = None
-
-        return random_key
+        data, sw1, sw2 = self.send_apdu(self._apdu['sam_auth_key'].build(card_number_in, card_uid_in, key_card_in),
+                                        chain=True, le=self._sam_le)
+        if not (data and sw1 == 0x90 and sw2 == 0x00):
+            return None
+        return response_view(data)[-16:].hex().upper()
 
     def sam_create_hash(self, card_number_in, card_uid_in, card_random_number_in, debet_value, proc_code=808117,
-                        ref_number=36, batch_num=3):
-        try:
-            pdu_txt = self.SAMCARD_CREATE_HASH.format(card_number_in,
-                                                      card_uid_in,
-                                                      card_random_number_in,
-                                                      toHexString(toASCIIBytes(card_number_in), PACK),
-                                                      toHexString(
-                                                          toASCIIBytes("{:0<10}".format(int(float(debet_value) * 100))),
-                                                          PACK),
-                                                      toHexString(
-                                                          toASCIIBytes("{:0<12}".format(time.strftime("%d%m%y"))),
-                                                          PACK),
-                                                      toHexString(
-                                                          toASCIIBytes("{:0<12}".format(time.strftime("%H%M%I"))),
-                                                          PACK),
-                                                      toHexString(toASCIIBytes("{:0>6d}".format(proc_code)), PACK),
-                                                      toHexString(toASCIIBytes("{:0>6d}".format(ref_number)), PACK),
-                                                      toHexString(toASCIIBytes("{:0>2d}".format(batch_num)), PACK)
-                                                      )
-            # print(pdu_txt)
-
-            data, sw1, sw2 = self.send_apdu(pdu_txt)
-            hash_value = None
-            if sw1 == 0x61:
-                data, sw1, sw2 = self.pdu_get_more_data(sw2)
-                if sw1 == 0x90 and sw2 == 0x00:
-                    hash_value = toHexString(data, PACK)
-            else:
-                hash_value = None
-
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            hash_value = None
-
-        return hash_value
+                        ref_number=36, batch_num=3, clock=None):
+        clock = clock is not None and clock or TransactionClock()
+        pdu = self._apdu['sam_create_hash'].build(card_number_in,
+                                                  card_uid_in,
+                                                  card_random_number_in,
+                                                  card_number_in,
+                                                  int(float(debet_value) * 100),
+                                                  clock.date_ascii,
+                                                  clock.time_ascii,
+                                                  proc_code,
+                                                  ref_number,
+                                                  batch_num)
+
+        data, sw1, sw2 = self.send_apdu(pdu, chain=True, le=self._sam_le)
+        if not (data and sw1 == 0x90 and sw2 == 0x00):
+            return None
+        return response_view(data).hex().upper()
 
     def card_authenticate(self, random_key_in):
-        try:
-            card_random_number = None
-            data, sw1, sw2 = self.send_apdu(self.PICC_CARD_AUTH.format(random_key_in), False)
-            if data[0] == 0x00:
-                card_random_number = toHexString(data[1:9] + [sw1, sw2], PACK)
-            else:
-                card_random_number = None
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            card_random_number = None
-
-        return card_random_number
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_card_auth'].build(random_key_in), False)
+        if not (data and data[0] == 0x00 and len(data) >= 7):
+            return None
+        return response_view(data[1:9], sw1, sw2).hex().upper()
 
     def card_get_last_transaction_date(self):
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_get_last_transaction_date'].build(), False)
+        if not (data and data[0] == 0x00 and len(data) >= 6):
+            return None, None
+        view = response_view(data, sw1, sw2)
         try:
-            last_trans_data = None, None
-            data, sw1, sw2 = self.send_apdu(self.PICC_GET_LAST_TRANSACTION_DATE, False)
-            if data[0] != 0x00:
-                last_trans_data = None, None
-            else:
-                last_trans_data = time.strptime("{:02X}{:02X}{:02X}".format(data[1], data[2], data[3]),
-                                                "%y%m%d"), int.from_bytes(data[4:] + [sw1, sw2], 'big')
-
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            last_trans_data = None, None
-
-        return last_trans_data
+            last_trans_date = time.strptime(view[1:4].hex(), "%y%m%d")
+        except ValueError as err:
+            # a card never used holds no valid date
+            self._logger and self._logger.error("Bad last transaction date {} : {}".format(view[1:4].hex(), err))
+            return None, None
+        return last_trans_date, int.from_bytes(view[4:], 'big')
 
     def card_get_balance(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_GET_BALANCE, False)
-            balance = -2
-            if data[0] == 0x00:
-                balance = int.from_bytes(data[1:] + [sw1, sw2], 'little')
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            balance = -1
-
-        return balance
+        '''
+        balance, -1 on a transport error, -2 when the card refused
+        '''
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_get_balance'].build(), False)
+        if not data:
+            return -1
+        if data[0] != 0x00 or len(data) < 3:
+            return -2
+        return int.from_bytes(response_view(data, sw1, sw2)[1:], 'little')
+
+    def card_read_log(self, count=0, offset=0):
+        '''
+        raw 32 byte log records, newest first, at most count of them, 0 for all, None on a failed read
+        an empty log answers with a boundary error and comes back as no record
+        '''
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_read_log'].build(offset, count), False)
+        raw = bytearray()
+        for _ in range(self.CHAIN_LIMIT):
+            if not data:
+                return None
+            # a frame of only the status byte is answered with a real 9000
+            raw += len(data) > 1 and response_view(data, sw1, sw2)[1:] or b""
+            if data[0] != 0xAF:
+                break
+            data, sw1, sw2 = self.send_apdu(self._apdu['picc_additional_frame'].build(), False)
+        if data[0] == 0xBE and not raw:
+            # fewer records than count, or none at all
+            records = self.card_read_log(0, offset) if count else []
+            return records[:count] if records is not None else None
+        if data[0] != 0x00:
+            return None
+        return [bytes(raw[index:index + LOG_RECORD_SIZE]) for index in range(0, len(raw), LOG_RECORD_SIZE)]
 
     def card_debet_balance(self, debet_value=0):
-        try:
-            data, sw1, sw2 = self.send_apdu(
-                self.PICC_DEBET_BALANCE.format(binascii.hexlify((debet_value).to_bytes(3, 'little')).decode()), False)
-            debet_status = data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            debet_status = False
-
-        return debet_status
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_debet_balance'].build(debet_value), False)
+        return picc_ok(data, sw1, sw2)
 
     def card_commit_transaction(self):
-        try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_COMMIT_TRANSACTION, False)
-            commit_result = data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
-        except Exception as err:
-            pass
-            self._logger and self._logger.error(err)
-            commit_result = False
-
-        return commit_result
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_commit_transaction'].build(), False)
+        return picc_ok(data, sw1, sw2)
 
     def cardAbortTransaction(self):
+        data, sw1, sw2 = self.send_apdu(self._apdu['picc_abort_transaction'].build(), False)
+        return picc_ok(data, sw1, sw2)
+
+    def _write_log_pdu(self, debet_value=0, balance_before=0, balance_after=0, mid=None, tid=None, clock=None):
+        clock = clock is not None and clock or TransactionClock()
+        return self._apdu['picc_write_log'].build(
+            mid and mid or self._mid,
+            tid and tid or self._tid,
+            clock.date_bcd,
+            clock.time_bcd,
+            debet_value,
+            balance_before,
+            balance_after
+        )
+
+    @staticmethod
+    def _akum_debet_total(last_trans_date, last_akum_debet, debet_value=0, local=None):
+        # the month total restarts with the first debit of a month, the same month of an earlier year is another one
+        local = local if local is not None else time.localtime()
+        akum_debet_total = debet_value
+        if (last_trans_date.tm_year, last_trans_date.tm_mon) == (local.tm_year, local.tm_mon):
+            akum_debet_total += last_akum_debet
+        return akum_debet_total
+
+    def _write_last_transaction_pdu(self, last_trans_date, last_akum_debet, debet_value=0, clock=None):
+        clock = clock is not None and clock or TransactionClock()
+        return self._apdu['picc_write_last_transaction'].build(
+            clock.date_bcd, self._akum_debet_total(last_trans_date, last_akum_debet, debet_value, clock.local))
+
+    def card_write_log(self, debet_value=0, balance_before=0, balance_after=0, mid=None, tid=None, clock=None):
+        data, sw1, sw2 = self.send_apdu(self._write_log_pdu(debet_value, balance_before, balance_after, mid, tid,
+                                                            clock), False)
+        return picc_ok(data, sw1, sw2)
+
+    def card_write_last_transaction(self, last_trans_date, last_akum_debet, debet_value=0, clock=None):
+        data, sw1, sw2 = self.send_apdu(self._write_last_transaction_pdu(last_trans_date, last_akum_debet,
+                                                                         debet_value, clock), False)
+        return picc_ok(data, sw1, sw2)
+
+    def card_write_burst(self, debet_value, balance_before, last_trans_date, last_akum_debet, mid=None, tid=None,
+                         clock=None):
+        '''
+        debit, write log and write last transaction with every pdu built before the first one is sent
+        one escape exchange when a burst control code is set, otherwise back to back transmits
+        '''
+        clock = clock is not None and clock or TransactionClock()
+        pdus = (
+            self._apdu['picc_debet_balance'].build(debet_value),
+            self._write_log_pdu(debet_value, balance_before, balance_before - debet_value, mid, tid, clock),
+            self._write_last_transaction_pdu(last_trans_date, last_akum_debet, debet_value, clock)
+        )
+        if self._burst_control_code is None:
+            for pdu in pdus:
+                if not picc_ok(*self.send_apdu(pdu, False)):
+                    return False
+            return True
+
+        start = time.perf_counter()
+        payload = burst_pack(pdus)
         try:
-            data, sw1, sw2 = self.send_apdu(self.PICC_ABORT_TRANSACTION, False)
-            abort_result = data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
+            response = self._reader_picc_connection.control(self._burst_control_code, list(payload))
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
-            abort_result = False
+            self._metrics and self._metrics.observe_transport_error(False)
+            self._exchanges['picc'][2] = "transport_error"
+            self._trace and self._trace.record(id(self), False, payload, None, None, None,
+                                               time.perf_counter() - start)
+            return False
+        results = burst_unpack(response)
+        if not results:
+            return False
+
+        data, sw1, sw2 = results[-1]
+        self._metrics and self._metrics.observe_apdu(False, time.perf_counter() - start, sw1, sw2)
+        self._trace and self._trace.record(id(self), False, payload, response, sw1, sw2, time.perf_counter() - start)
+        self._picc_exchange(self._exchanges['picc'], data, sw1, sw2)
+        return len(results) == len(pdus) and all(picc_ok(data, sw1, sw2) for data, sw1, sw2 in results)
+
+    def _transaction_debet_card_failed(self, debet_amount=0, mid=None, tid=None, ref_number=1, batch_number=1,
+                                       clock=None):
+        clock = clock is not None and clock or TransactionClock()
+        return {
+            'status': False,
+            'card_number': "",
+            'transaction_date': clock.date_text,
+            'transaction_time': clock.time_text,
+            'balance': 0,
+            'amount': debet_amount,
+            'ref_number': ref_number,
+            'batch_number': batch_number,
+            'mid': mid and mid or self._mid,
+            'tid': tid and tid or self._tid,
+            'hash': '00000000'
+        }
+
+    def transaction_begin(self, debet_amount=0, mid=None, tid=None, proc_code=808117, ref_number=1,
+                           batch_number=1):
+        '''
+        open the card and journal the intent, returns (ctx, result, connected)
+        on a re-tap ctx is None and result is the final answer, otherwise transaction_end completes result
+        '''
+        ctx = TransactionContext(debet_amount, mid and mid or self._mid, tid and tid or self._tid, proc_code,
+                                 ref_number, batch_number)
+        transaction_result = self._transaction_debet_card_failed(debet_amount, ctx.mid, ctx.tid, ref_number,
+                                                                 batch_number, ctx.clock)
+
+        # open connection, once, a processor built on an open connection skips it
+        connected = self._picc_open or self.card_open_connection()
+        if connected and self._card_cache is not None:
+            retap_result = self._card_cache_lookup(ctx)
+            if retap_result is not None:
+                return None, retap_result, False
+
+        if self._journal is not None:
+            ctx.tx_id = self._journal.begin({'amount': debet_amount, 'mid': ctx.mid, 'tid': ctx.tid,
+                                             'date': transaction_result['transaction_date'],
+                                             'time': transaction_result['transaction_time']})
+        return ctx, transaction_result, connected
+
+    def transaction_end(self, ctx, transaction_result):
+        '''
+        abort an uncommitted debit and fill the result, both connections must be idle
+        '''
+        self.sam_release(ctx)
+        if ctx.debited and not ctx.committed:
+            aborted = self.cardAbortTransaction()
+            self._journal and self._journal.record(ctx.tx_id, "abort", {'ok': aborted,
+                                                                        'failed_step': ctx.failed_step})
+
+        self._metrics and self._metrics.observe_transaction(time.perf_counter() - ctx.start,
+                                                            transaction_result['status'], ctx.failed_step)
+        if self._trace and not transaction_result['status'] and ctx.declined is None:
+            self._trace.dump(id(self), ctx.clock.wall,
+                             "{} {}".format(ctx.tx_id, ctx.failed_step))
+        transaction_result.update(
+            {
+                'card_number': ctx.card_number,
+                'balance': ctx.balance is not None and ctx.balance or 0,
+                'ref_number': ctx.ref_number,
+                'batch_number': ctx.batch_number,
+                'hash': ctx.hash,
+                'failed_step': ctx.failed_step,
+                'declined': ctx.declined,
+                'anomaly': ctx.anomaly,
+                'amount': ctx.debet_amount,
+                'fare_rule': ctx.fare_rule,
+                'tx_id': ctx.tx_id,
+                'failure_reason': ctx.failure is not None and ctx.failure.reason or None,
+                'failure_sw': ctx.failure is not None and ctx.failure.sw is not None and
+                              "{:04X}".format(ctx.failure.sw) or None,
+                'timing': dict((result.step, round(result.duration_ms, 3)) for result in ctx.timing),
+                'connect_ms': round(self.connect_seconds * 1000, 3),
+                'total_ms': round((time.perf_counter() - ctx.start) * 1000, 3)
+            }
+        )
+        if self._card_cache is not None and transaction_result['status']:
+            self._card_cache.record_commit(ctx.card_uid, transaction_result)
+        if self._ledger is not None and ctx.committed:
+            self._ledger.record(ctx.card_number, ctx.balance, ctx.balance - ctx.debet_amount, ctx.debet_amount,
+                                ctx.clock.date_number,
+                                self._akum_debet_total(ctx.last_trans_date, ctx.last_trans_akum_debet,
+                                                       ctx.debet_amount, ctx.clock.local), ctx.clock.wall)
+        return transaction_result
+
+    @property
+    def steps(self):
+        '''
+        steps of the debit, for a scheduler running them itself between transaction_begin and transaction_end
+        '''
+        return self._engine.steps
 
-        return abort_result
+    def run_step(self, step, ctx):
+        '''
+        run one debit step for ctx, timed and recorded as the engine does, returns its StepResult
+        '''
+        return self._engine.run_step(step, ctx)
+
+    def transaction_debet_card(self, debet_amount=0, mid=None, tid=None, proc_code=808117, ref_number=1,
+                               batch_number=1):
+        ctx, transaction_result, connected = self.transaction_begin(debet_amount, mid, tid, proc_code, ref_number,
+                                                                     batch_number)
+        if ctx is None:
+            return transaction_result
 
-    def card_write_log(self, debet_value=0, balance_before=0, balance_after=0, mid=None, tid=None):
         try:
-            pdu = self.PICC_WRITE_LOG.format(
-                mid and mid or self._mid,
-                tid and tid or self._tid,
-                time.strftime("%y%m%d"),
-                time.strftime("%H%M%I"),
-                binascii.hexlify(debet_value.to_bytes(3, 'little')).decode(),
-                binascii.hexlify(balance_before.to_bytes(3, 'little')).decode(),
-                binascii.hexlify(balance_after.to_bytes(3, 'little')).decode()
-            )
-            # print(pdu)
-            data, sw1, sw2 = self.send_apdu(pdu, False)
-            result = data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
+            if connected:
+                transaction_result['status'] = self._engine.run(ctx)
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
-            result = False
-
-        return result
+            transaction_result['status'] = False
+        # both connections are idle here, safe to abort
+        return self.transaction_end(ctx, transaction_result)
 
-    def card_write_last_transaction(self, last_trans_date, last_akum_debet, debet_value=0):
+    def card_inspect(self, log_records=0):
+        '''
+        read only readout of the card in the field, balance, last debit, month total and log, log_records is the
+        number of log records read, 0 for all of them
+        nothing is hashed, written or journaled, the sam only authenticates the card
+        '''
+        ctx = TransactionContext(0, self._mid, self._tid)
+        self._inspect_engine = self._inspect_engine or self._build_engine(self.INSPECTION_STEPS, self._logger)
+        self._inspect_log_records = log_records
+        status = False
         try:
-            akum_debet_total = debet_value
-            if last_trans_date.tm_mon == int(time.strftime("%m")):
-                akum_debet_total += last_akum_debet
-            data, sw1, sw2 = self.send_apdu(self.PICC_WRITE_LAST_TRANSACTION.format(
-                time.strftime("%y%m%d"),
-                binascii.hexlify((akum_debet_total).to_bytes(4, 'big')).decode()
-            ), False)
-            result = data[0] == 0x00 and sw1 == 0x90 and sw2 == 0x00
+            if self._picc_open or self.card_open_connection():
+                status = self._inspect_engine.run(ctx)
         except Exception as err:
             pass
             self._logger and self._logger.error(err)
-            result = False
+        self.sam_release(ctx)
+        last_date = ctx.last_trans_date
+        return {
+            'status': status,
+            'card_number': ctx.card_number or "",
+            'card_uid': ctx.card_uid or "",
+            'balance': ctx.balance if ctx.balance is not None and ctx.balance >= 0 else None,
+            'last_transaction_date': last_date is not None and "%04d-%02d-%02d" % (
+                last_date.tm_year, last_date.tm_mon, last_date.tm_mday) or None,
+            'akum_debet': ctx.last_trans_akum_debet,
+            'log': [log_record(raw) for raw in ctx.log or ()],
+            'inspection_date': ctx.clock.date_text,
+            'inspection_time': ctx.clock.time_text,
+            'failed_step': ctx.failed_step,
+            'failure_reason': ctx.failure is not None and ctx.failure.reason or None,
+            'connect_ms': round(self.connect_seconds * 1000, 3),
+            'total_ms': round((time.perf_counter() - ctx.start) * 1000, 3)
+        }
+
+    def _card_cache_lookup(self, ctx):
+        '''
+        read the uid ahead of the step graph, a re-tap returns the committed result without any debit
+        '''
+        ctx.card_uid = self.card_get_uid()
+        if ctx.card_uid is None:
+            return None
+        card_number, status_checked, retap_result = self._card_cache.lookup(ctx.card_uid)
+        if retap_result is not None:
+            # already paid, not a transaction of its own, the gate must not open a second time for it
+            retap_result = dict(retap_result)
+            retap_result.update({'status': False, 'retap': True, 'declined': "retap",
+                                 'total_ms': round((time.perf_counter() - ctx.start) * 1000, 3)})
+            self._logger and self._logger.debug("Re-tap of card {}, no debit".format(card_number))
+            return retap_result
+        if card_number is not None:
+            ctx.card_number = card_number
+            ctx.cached = True
+            ctx.status_cached = status_checked
+        return None
+
+    # steps skipped when the context already holds their result
+
+    def _skip_card_get_uid(self, ctx):
+        return ctx.card_uid is not None
+
+    def _skip_card_select_aid1(self, ctx):
+        return ctx.status_cached
+
+    def _skip_card_get_number(self, ctx):
+        return ctx.cached
+
+    def _skip_card_get_status(self, ctx):
+        return ctx.status_cached
+
+    # transaction steps, each returns True to let the dependent steps run
+
+    def _step_sam_prepare(self, ctx):
+        return self.sam_prepare()
+
+    def _step_card_get_uid(self, ctx):
+        ctx.card_uid = self.card_get_uid()
+        return ctx.card_uid is not None
+
+    def _step_card_select_aid1(self, ctx):
+        return self.card_select_aid1()
+
+    def _step_card_get_number(self, ctx):
+        ctx.card_number = self.card_get_number()
+        return ctx.card_number is not None
+
+    def _step_card_precheck(self, ctx):
+        # local checks before the card or sam is asked anything costly
+        if self._denylist is not None and ctx.card_number in self._denylist:
+            ctx.declined = "denylisted"
+        return self._decline(ctx)
+
+    def _decline(self, ctx):
+        if ctx.declined is None:
+            return True
+        self._logger and self._logger.info("Card {} declined : {}".format(ctx.card_number, ctx.declined))
+        self._journal and self._journal.record(ctx.tx_id, "declined", {'card_number': ctx.card_number,
+                                                                       'reason': ctx.declined})
+        return False
+
+    def _step_card_get_status(self, ctx):
+        status = self.card_get_status()
+        if status is False:
+            # status file read fine, the card itself is not active
+            ctx.declined = "blocked"
+            return self._decline(ctx)
+        if status is None and self._exchanges['picc'][1:] == [0x00, None]:
+            # answered ok but too short to hold the status, a protocol error and not a blocked card
+            self._exchanges['picc'][2] = "short_response"
+        # only cards with a good status are cached, a blocked card is read again on every tap
+        status and self._card_cache is not None and self._card_cache.put_static(ctx.card_uid, ctx.card_number)
+        return status
+
+    def _step_card_select_aid3(self, ctx):
+        return self.card_select_aid3()
+
+    def _step_card_request_key_card(self, ctx):
+        ctx.card_key = self.card_request_key_card()
+        return ctx.card_key is not None
+
+    def _step_sam_authenticate_key(self, ctx):
+        with self.sam_lease(ctx) as leased:
+            if leased:
+                ctx.sam_random_key = self.sam_authenticate_key(ctx.card_number, ctx.card_uid, ctx.card_key)
+        return ctx.sam_random_key is not None
+
+    def _step_card_authenticate(self, ctx):
+        ctx.card_random_number = self.card_authenticate(ctx.sam_random_key)
+        return ctx.card_random_number is not None
+
+    def _step_sam_create_hash(self, ctx):
+        with self.sam_lease(ctx) as leased:
+            if leased:
+                allocated = self._settlement is not None and self._settlement.allocate()
+                ref_number, batch_number = allocated or (ctx.ref_number, ctx.batch_number)
+                ctx.hash = self.sam_create_hash(ctx.card_number, ctx.card_uid, ctx.card_random_number,
+                                                ctx.debet_amount, ctx.proc_code, ref_number, batch_number, ctx.clock)
+                if ctx.hash is not None:
+                    ctx.ref_number, ctx.batch_number = ref_number, batch_number
+                elif allocated:
+                    # a number no hash was made with goes back unless a later one was already handed out
+                    self._settlement.release(*allocated)
+        self._journal and ctx.hash is not None and self._journal.record(ctx.tx_id, "hash", {
+            'hash': ctx.hash, 'ref_number': ctx.ref_number, 'batch_number': ctx.batch_number})
+        return ctx.hash is not None
+
+    def _step_card_get_last_transaction_date(self, ctx):
+        ctx.last_trans_date, ctx.last_trans_akum_debet = self.card_get_last_transaction_date()
+        return ctx.last_trans_date is not None and ctx.last_trans_akum_debet is not None
+
+    def _step_card_read_balance(self, ctx):
+        ctx.balance = self.card_get_balance()
+        return ctx.balance >= 0
+
+    def _step_card_read_log(self, ctx):
+        ctx.log = self.card_read_log(self._inspect_log_records)
+        return ctx.log is not None
+
+    def _step_card_get_balance(self, ctx):
+        ctx.balance = self.card_get_balance()
+        if ctx.balance < 0:
+            return False
+        self._ledger is not None and self._ledger_check(ctx)
+        if self._tariff is not None:
+            # the month total so far caps the fare, the hash and the debit below use this amount
+            ctx.debet_amount, ctx.fare_rule = self._tariff.fare(
+                self._lane, ctx.clock.local, self._akum_debet_total(ctx.last_trans_date, ctx.last_trans_akum_debet,
+                                                                    local=ctx.clock.local))
+        # balance floor, the hash and the debit are not tried for a card that can not pay
+        if ctx.balance < ctx.debet_amount:
+            ctx.declined = "insufficient_balance"
+        return self._decline(ctx)
+
+    def _ledger_check(self, ctx):
+        last_date = ctx.last_trans_date
+        ctx.anomaly = self._ledger.check(ctx.card_number, ctx.balance,
+                                         (last_date.tm_year % 100 * 100 + last_date.tm_mon) * 100 + last_date.tm_mday,
+                                         ctx.last_trans_akum_debet)
+        if ctx.anomaly is not None:
+            entry = self._ledger.lookup(ctx.card_number)
+            self._logger and self._logger.warning("Card {} {} : balance {}, ledger {}".format(
+                ctx.card_number, ctx.anomaly, ctx.balance, entry is not None and entry.balance or None))
+            self._journal and self._journal.record(ctx.tx_id, "anomaly", {'card_number': ctx.card_number,
+                                                                          'anomaly': ctx.anomaly,
+                                                                          'balance': ctx.balance})
+
+    def _journal_debit(self, ctx):
+        # a failed debit command may still have left a pending change on the card, the event is on disk before
+        # the command goes out, together with the intent queued ahead of it
+        self._journal and self._journal.record(ctx.tx_id, "debit", {'card_number': ctx.card_number,
+                                                                    'card_uid': ctx.card_uid,
+                                                                    'amount': ctx.debet_amount,
+                                                                    'fare_rule': ctx.fare_rule,
+                                                                    'balance': ctx.balance}, durable=True)
+        ctx.debited = True
+
+    def _step_card_debet_balance(self, ctx):
+        self._journal_debit(ctx)
+        return self.card_debet_balance(ctx.debet_amount)
+
+    def _step_card_write_log(self, ctx):
+        return self.card_write_log(ctx.debet_amount, ctx.balance, ctx.balance - ctx.debet_amount, ctx.mid, ctx.tid,
+                                   ctx.clock)
+
+    def _step_card_write_last_transaction(self, ctx):
+        return self.card_write_last_transaction(ctx.last_trans_date, ctx.last_trans_akum_debet, ctx.debet_amount,
+                                                ctx.clock)
+
+    def _step_card_write_burst(self, ctx):
+        self._journal_debit(ctx)
+        return self.card_write_burst(ctx.debet_amount, ctx.balance, ctx.last_trans_date, ctx.last_trans_akum_debet,
+                                     ctx.mid, ctx.tid, ctx.clock)
+
+    def _step_card_commit_transaction(self, ctx):
+        ctx.committed = self.card_commit_transaction()
+        # an unanswered commit is recorded as well, the card may still have committed
+        self._journal and self._journal.record(ctx.tx_id, ctx.committed and "commit" or "commit_failed",
+                                               {'balance_after': ctx.balance - ctx.debet_amount})
+        return ctx.committed
+
+
+class ReaderProcessors:
+    '''
+    one BrizziProcessor kept per picc reader, its pdu buffers and engines are built for the first card only and
+    every later card on the reader is bound to it, options go to the BrizziProcessor constructor
+    a processor is taken out while its card is served, a second card at once on a reader gets one of its own
+    '''
 
-        return result
+    def __init__(self, **options):
+        self._options = dict(options, debug_mode=False)
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, reader, picc_connection, picc_setup=None):
+        with self._lock:
+            processor = self._idle.pop(reader, None)
+            if processor is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if processor is None:
+            return BrizziProcessor(picc_connection=picc_connection, picc_setup=picc_setup, **self._options)
+        processor.bind(picc_connection, picc_setup)
+        return processor
 
-    def transaction_debet_card(self, debet_amount=0, mid=None, tid=None, proc_code=808117, ref_number=1,
-                               batch_number=1):
-        global transaction_result
+    def release(self, reader, processor, keep=True):
+        '''
+        end of the card of processor, keep False closes it, e.g. when a step may still be running
+        '''
+        processor.release()
+        with self._lock:
+            if keep and reader not in self._idle:
+                self._idle[reader] = processor
+                return
+        processor.close()
+
+    @contextlib.contextmanager
+    def tap(self, reader, picc_connection, picc_setup=None):
+        processor = self.acquire(reader, picc_connection, picc_setup)
         try:
-            transaction_result = {
-                'status': False,
-                'card_number': "",
-                'transaction_date': "0000-00-00",
-                'transaction_time': "00:00:00",
-                'balance': 0,
-                'amount': 0,
-                'ref_number': 0,
-                'batch_number': 0,
-                'mid': '',
-                'tid': '',
-                'hash': '00000000'
-            }
-
-            # step 1
-            transaction_result.update(
-                {
-                    'transaction_date': time.strftime("%Y-%m-%d"),
-                    'transaction_time': time.strftime("%H:%M:%I"),
-                    'amount': debet_amount,
-                    'mid': mid and mid or self._mid,
-                    'tid': tid and tid or self._tid,
-                    'ref_number': ref_number,
-                    'batch_number': batch_number
-                }
-            )
-
-            # open connection
-            if self.card_open_connection():
-                if self.sam_select():
-                    # step 2
-                    if self.card_select_aid1():
-                        # step 3
-                        card_number = self.card_get_number()
-                        transaction_result['card_number'] = card_number
-                        if card_number is not None:
-                            # step 4
-                            if self.card_get_status():
-                                # step 5
-                                if self.card_select_aid3():
-                                    # step 6
-                                    card_key = self.card_request_key_card()
-                                    if card_key is not None:
-                                        # step 7
-                                        card_uid = self.card_get_uid()
-                                        if card_uid is not None:
-
-                                            # step 8
-                                            sam_random_key = self.sam_authenticate_key(card_number, card_uid, card_key)
-                                            if sam_random_key is not None:
-                                                # step 9
-                                                card_random_number = self.card_authenticate(sam_random_key)
-                                                if card_random_number is not None:
-                                                    # step 10
-                                                    last_trans_date, last_trans_akum_debet = self.card_get_last_transaction_date()
-                                                    if last_trans_date is not None and last_trans_akum_debet is not None:
-                                                        # step 11
-                                                        card_balance = self.card_get_balance()
-                                                        transaction_result['balance'] = card_balance
-                                                        if card_balance >= 0:
-                                                            # step 12
-                                                            if self.card_debet_balance(debet_amount):
-                                                                # step 13
-                                                                sam_hash = self.sam_create_hash(card_number, card_uid,
-                                                                                                card_random_number,
-                                                                                                debet_amount, proc_code,
-                                                                                                ref_number,
-                                                                                                batch_number)
-                                                                transaction_result['hash'] = sam_hash
-                                                                if sam_hash is not None:
-                                                                    # step 14
-                                                                    if self.card_write_log(debet_amount, card_balance,
-                                                                                           card_balance - debet_amount,
-                                                                                           transaction_result['mid'],
-                                                                                           transaction_result['tid']):
-                                                                        # step 15
-                                                                        if self.card_write_last_transaction(
-                                                                                last_trans_date, last_trans_akum_debet,
-                                                                                debet_amount):
-                                                                            # step 16
-                                                                            if self.card_commit_transaction():
-                                                                                transaction_result['status'] = True
-                                                                            else:
-                                                                                self.cardAbortTransaction()
-                                                                        else:
-                                                                            self.cardAbortTransaction()
-                                                                    else:
-                                                                        self.cardAbortTransaction()
-                                                                else:
-                                                                    self.cardAbortTransaction()
-                                                            else:
-                                                                self.cardAbortTransaction()
-            # self.card_close_connection()
+            yield processor
         except Exception as err:
             pass
-            self._logger and self._logger.error(err)
-            transaction_result['status'] = False
-            # self.card_close_connection()
+            logger = self._options.get('logger')
+            logger and logger.error(err)
+        finally:
+            self.release(reader, processor)
 
-        return transaction_result
+    def close(self):
+        with self._lock:
+            processors, self._idle = list(self._idle.values()), {}
+        for processor in processors:
+            processor.close()
+
+    def stats(self):
+        return {'readers': len(self._idle), 'created': self.created, 'reused': self.reused}
 
 
 class BrizziCardObserver(CardObserver):
@@ -577,9 +2867,29 @@ class BrizziCardObserver(CardObserver):
     """
 
     # sam card
-    sam_connection = None
     sam_uid = "3B6800000073C84013009000"
 
+    def __init__(self, sam_pool=None, journal=None, settlement=None, card_cache=None, denylist=None,
+                 connections=None, ledger=None, tariff=None, amount=1, sam_le=None):
+        self.sam_pool = sam_pool if sam_pool is not None else SamSessionPool(LOGGER_MAIN)
+        # picc reader connections reused across taps
+        self.connections = connections if connections is not None else ReaderConnectionManager(LOGGER_MAIN)
+        self.journal = journal
+        self.card_cache = card_cache if card_cache is not None else CardSessionCache()
+        self.denylist = denylist
+        self.ledger = ledger
+        # fare from the tariff engine, amount when there is none
+        self.tariff = tariff
+        self.amount = amount
+        # ref and batch number allocator, see brizzi_settlement.SettlementCounters
+        self.settlement = settlement
+        self.processors = ReaderProcessors(sam_pool=self.sam_pool, journal=journal, card_cache=self.card_cache,
+                                           denylist=denylist, ledger=ledger, tariff=tariff, settlement=settlement,
+                                           sam_le=sam_le)
+
+    def close(self):
+        self.processors.close()
+
     def update(self, observable, actions):
         """
         When card is insert or removed, it goes here
@@ -595,46 +2905,477 @@ class BrizziCardObserver(CardObserver):
             print("-Removed: ", toHexString(card.atr))
         '''
 
+        # drop sam sessions of removed sam
+        for card in removedcards:
+            if toHexString(card.atr, PACK) == self.sam_uid:
+                self.sam_pool.remove_slot(str(card.reader))
+
         # get sam connection
         for card in addedcards:
             atrx = toHexString(card.atr, PACK)
             LOGGER_MAIN.debug(atrx)
             if atrx == self.sam_uid:
-                if self.sam_connection is None:
-                    self.sam_connection = card.createConnection()
+                if not self.sam_pool.has_slot(str(card.reader)):
+                    self.sam_pool.add_connection(card.createConnection(), str(card.reader))
             else:
-                picc_connection = card.createConnection()
+                if tap_begin(card) is False:
+                    # out of the field again before its tap started
+                    continue
+                picc_connection, picc_setup = self.connections.acquire(card)
+                if picc_connection is None:
+                    tap_end(card)
+                    continue
                 # picc_connection.connect()
                 # data, sw1, sw2 = picc_connection.transmit(toBytes("FF00480000"))
                 # data, sw1, sw2 = picc_connection.transmit(toBytes("E0000028010F"))
                 # firmware = toBytes("E000002900")
                 # retx = picc_connection.control(SCARD_CTL_CODE(3500), firmware)
                 # LOGGER_MAIN.debug(retx)
-                with BrizziProcessor(sam_connection=self.sam_connection, picc_connection=picc_connection,
-                                     debug_mode=False) as conn_obj:
+                resultx = None
+                with self.processors.tap(str(card.reader), picc_connection, picc_setup) as conn_obj:
                     if conn_obj.initialize:
-                        resultx = conn_obj.transaction_debet_card(1)
-                        LOGGER_MAIN.debug(resultx)
-                        if resultx['status']:
-                            GPIO_CONTROL_MAIN.buzzer_beep(1)
-                            GPIO_CONTROL_MAIN.gate_open()
+                        resultx = tap_end(card, conn_obj.transaction_debet_card(self.amount))
+                        if resultx.get('retap'):
+                            # paid a moment ago, acknowledged only, the gate is left as it is
+                            ACTUATOR_MAIN.beep(1)
+                        elif resultx['status']:
+                            ACTUATOR_MAIN.beep(1)
+                            ACTUATOR_MAIN.gate_open()
                         else:
-                            GPIO_CONTROL_MAIN.buzzer_beep(3)
-                            GPIO_CONTROL_MAIN.gate_close()
+                            ACTUATOR_MAIN.beep(3)
+                            ACTUATOR_MAIN.gate_close()
+                        LOGGER_MAIN.debug("result %s", JsonMessage(resultx))
+                        if self.journal is not None and not resultx.get('retap'):
+                            self.journal.record(resultx['tx_id'], "actuator",
+                                                {'gate': resultx['status'] and "open" or "closed"})
+                self.connections.release(picc_connection, resultx)
+                resultx is None and tap_end(card)
 
 
-def main():
+class LaneConfig:
+    '''
+    one turnstile, the picc reader driving it, its gpio pins and the sam slot it uses (None for any)
+    write_burst "transmit" sends the card writes back to back, "escape" in one reader escape exchange
+    sam_le is the le sent with the sam commands answering data, 0 for a t=1 sam answering without get response
+    '''
+
+    def __init__(self, name, picc_reader, pin_buzzer=GPIOControl.pin_buzzer, pin_gate=GPIOControl.pin_gate,
+                 sam_slot=None, amount=1, mid="1122334455667788", tid="aabbccddeeff0000", write_burst=None,
+                 sam_le=None):
+        self.name = name
+        self.picc_reader = picc_reader
+        self.pin_buzzer = pin_buzzer
+        self.pin_gate = pin_gate
+        self.sam_slot = sam_slot
+        self.amount = amount
+        self.mid = mid
+        self.tid = tid
+        self.write_burst = write_burst
+        self.sam_le = sam_le
+
+    def matches(self, reader_name):
+        return self.picc_reader in reader_name
+
+    def processor_options(self):
+        return {
+            'lane': self.name,
+            'mid': self.mid,
+            'tid': self.tid,
+            'sam_slot': self.sam_slot,
+            'write_burst': self.write_burst in ("transmit", "escape"),
+            'burst_control_code': self.write_burst == "escape" and BURST_CONTROL_CODE or None,
+            'sam_le': self.sam_le
+        }
+
+
+def load_lane_config(path, **defaults):
+    '''
+    read lanes from a json file, {"lanes": [{"name": "lane-1", "picc_reader": "ACR1252 Dual Reader PICC", ...}]}
+    defaults apply to every lane not setting them itself
+    '''
+    with open(path) as config_file:
+        config = json.load(config_file)
+    return [LaneConfig(**dict(defaults, **lane)) for lane in config['lanes']]
+
+
+class LaneWorker:
+    '''
+    runs the taps of one lane on its own thread, with its own gpio and actuator scheduler
+    '''
+
+    def __init__(self, config, sam_pool, logger=None, gpio_control=None, journal=None, settlement=None,
+                 card_cache=None, denylist=None, connections=None, ledger=None, tariff=None):
+        self.config = config
+        self._sam_pool = sam_pool
+        self._connections = connections if connections is not None else ReaderConnectionManager(logger)
+        self._logger = logger
+        self._journal = journal
+        self._queue = queue.Queue()
+        self._thread = None
+        self.gpio = gpio_control if gpio_control is not None else GPIOControl(config.pin_buzzer, config.pin_gate)
+        self.actuator = ActuatorScheduler(self.gpio, logger)
+        self.processors = ReaderProcessors(logger=logger, sam_pool=sam_pool, journal=journal, card_cache=card_cache,
+                                           denylist=denylist, ledger=ledger, tariff=tariff, settlement=settlement,
+                                           **config.processor_options())
+        self.taps = 0
+        self.succeeded = 0
+        self.busy_time = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self.actuator.start()
+            self._thread = threading.Thread(target=self._run, name="lane-" + self.config.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self.actuator.stop()
+        self.processors.close()
+
+    def submit(self, card):
+        self._queue.put(card)
+
+    def _run(self):
+        while True:
+            card = self._queue.get()
+            if card is None:
+                return
+            self.process(card)
+
+    def process(self, card):
+        if tap_begin(card) is False:
+            # out of the field again before its tap started
+            return None
+        start = time.perf_counter()
+        result = None
+        picc_connection, picc_setup = self._connections.acquire(card)
+        with self.processors.tap(str(card.reader), picc_connection, picc_setup) as conn_obj:
+            if conn_obj.initialize:
+                result = tap_end(card, conn_obj.transaction_debet_card(self.config.amount))
+                if result.get('retap'):
+                    # paid a moment ago, acknowledged only, the gate is left as it is
+                    self.actuator.beep(1)
+                elif result['status']:
+                    self.succeeded += 1
+                    self.actuator.beep(1)
+                    self.actuator.gate_open()
+                else:
+                    self.actuator.beep(3)
+                    self.actuator.gate_close()
+                self._logger and self._logger.debug("result %s", JsonMessage(result))
+                if self._journal is not None and not result.get('retap'):
+                    self._journal.record(result['tx_id'], "actuator",
+                                         {'lane': self.config.name, 'gate': result['status'] and "open" or "closed"})
+        self._connections.release(picc_connection, result)
+        result is None and tap_end(card)
+        self.taps += 1
+        self.busy_time += time.perf_counter() - start
+        return result
+
+
+class LaneOrchestrator(CardObserver):
+    '''
+    card observer for several lanes, routes every picc to the worker of its reader and sam to the shared pool
+    update only queues work, so one slow card never holds the monitor thread
+    '''
+    sam_uid = BrizziCardObserver.sam_uid
+
+    def __init__(self, lanes, sam_pool, logger=None, journal=None, settlement=None, denylist=None,
+                 connections=None, ledger=None, tariff=None):
+        self.sam_pool = sam_pool
+        self._logger = logger
+        # one cache for all lanes, a passenger moving to the next turnstile is still recognised
+        self.card_cache = CardSessionCache()
+        # every lane has its own reader, one manager keeps all of them
+        self.connections = connections if connections is not None else ReaderConnectionManager(logger)
+        self.workers = [LaneWorker(lane, sam_pool, logger, journal=journal, settlement=settlement,
+                                   card_cache=self.card_cache, denylist=denylist, connections=self.connections,
+                                   ledger=ledger, tariff=tariff)
+                        for lane in lanes]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def worker_for(self, reader_name):
+        return next((worker for worker in self.workers if worker.config.matches(reader_name)), None)
+
+    def update(self, observable, actions):
+        (addedcards, removedcards) = actions
+
+        for card in removedcards:
+            if toHexString(card.atr, PACK) == self.sam_uid:
+                self.sam_pool.remove_slot(str(card.reader))
+
+        for card in addedcards:
+            reader_name = str(card.reader)
+            if toHexString(card.atr, PACK) == self.sam_uid:
+                if not self.sam_pool.has_slot(reader_name):
+                    self.sam_pool.add_connection(card.createConnection(), reader_name)
+                continue
+
+            worker = self.worker_for(reader_name)
+            if worker is None:
+                self._logger and self._logger.warning("No lane for reader {}".format(reader_name))
+            else:
+                worker.submit(card)
+
+    def stats(self):
+        stats = dict((worker.config.name, {'taps': worker.taps, 'succeeded': worker.succeeded,
+                                           'busy_s': round(worker.busy_time, 3),
+                                           'actuator': worker.actuator.queue_wait_stats()})
+                     for worker in self.workers)
+        stats['connections'] = self.connections.stats()
+        stats['processors'] = dict((worker.config.name, worker.processors.stats()) for worker in self.workers)
+        return stats
+
+
+class StartupTimer:
+    '''
+    seconds spent in every startup phase, from the import of this module to the gate taking cards
+    '''
+
+    def __init__(self, logger=None, started=None):
+        self._logger = logger
+        self.started = IMPORT_STARTED if started is None else started
+        self.phases = collections.OrderedDict()
+        self.add("imports", time.perf_counter() - self.started)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        return "startup {:.3f} s ({})".format(self.elapsed(), ", ".join(
+            "{} {:.3f}".format(name, seconds) for name, seconds in self.phases.items()))
+
+    def check(self, budget):
+        '''
+        log the phases, warn when the startup took more than budget seconds
+        '''
+        elapsed = self.elapsed()
+        if budget and elapsed > budget:
+            slowest = max(self.phases, key=self.phases.get)
+            self._logger and self._logger.warning("Startup over budget, {:.3f} s > {:.3f} s, slowest {}".format(
+                elapsed, budget, slowest))
+        self._logger and self._logger.info(self.summary())
+        return elapsed
+
+
+def probe_reader(reader):
+    '''
+    (reader, connection, atr), atr is None for an empty reader, connection None when the reader is unusable
+    '''
+    connection = None
     try:
-        # initial screen
-        LOGGER_MAIN.info("System ready....")
+        connection = reader.createConnection()
+        connection.connect()
+        return reader, connection, connection.getATR()
+    except Exception as err:
+        pass
+        return reader, connection, None
+
+
+def prewarm_readers(sam_pool, connections=None, logger=None, sam_atr=BrizziCardObserver.sam_uid, reader_list=None):
+    '''
+    probe every reader at once, connect and select the sams into the pool and prepare the picc readers
+    the first tap then finds a selected sam and a picc reader with its pc/sc context already established
+    returns (sam slots, picc readers)
+    '''
+    if reader_list is None:
+        # pc/sc is only asked for its reader list here, the card monitor does it on its own thread later
+        from smartcard.System import readers
+        try:
+            reader_list = readers()
+        except Exception as err:
+            pass
+            logger and logger.error("No reader list : {}".format(err))
+            reader_list = []
+
+    def warm(reader):
+        if sam_pool.has_slot(str(reader)):
+            return True
+        reader, connection, atr = probe_reader(reader)
+        if atr is not None and toHexString(atr, PACK) == sam_atr:
+            # the probe connection becomes the sam session, selected on this thread
+            sam_pool.add_connection(connection, str(reader), atr)
+            return True
+        connection is not None and connection.disconnect()
+        # the probe connection, disconnected, is the cold connection of the picc reader
+        connections is not None and connections.prepare(reader, connection)
+        return False
+
+    sam_slots = picc_readers = 0
+    if reader_list:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(reader_list)) as executor:
+            for is_sam in executor.map(warm, reader_list):
+                sam_slots += is_sam
+                picc_readers += not is_sam
+    logger and logger.info("Readers warmed up, {} sam, {} picc".format(sam_slots, picc_readers))
+    return sam_slots, picc_readers
+
+
+def gate_arguments(parser):
+    '''
+    options shared by the gate entry points, this module and brizzi_async
+    '''
+    parser.add_argument("--metrics-port", type=int, help="serve prometheus metrics on this local port")
+    parser.add_argument("--metrics-file", help="write prometheus metrics to this file every 15 seconds")
+    parser.add_argument("--journal", default="brizzi_journal.sqlite3", help="transaction journal, empty to disable")
+    parser.add_argument("--settlement", help="settlement batch directory, needs the journal")
+    parser.add_argument("--upload-dir", help="directory standing in for the settlement upload")
+    parser.add_argument("--denylist", help="blocked card numbers, one per line, reloaded when the file changes")
+    parser.add_argument("--ledger", help="card balance ledger path, balances checked and recorded per debit")
+    parser.add_argument("--tariff", help="fare rules json, reloaded when the file changes")
+    parser.add_argument("--log-json", action="store_true", help="one json object per log record")
+    parser.add_argument("--apdu-log-every", type=int, default=0, help="log every nth apdu at debug level, 0 for none")
+    parser.add_argument("--apdu-log-rate", type=int, default=50, help="at most this many apdu log records a second")
+    parser.add_argument("--startup-budget", type=float, default=10.0,
+                        help="warn when the start up to System ready takes longer, in seconds, 0 to disable")
+    parser.add_argument("--card-monitor", action="store_true",
+                        help="cards from the polling pyscard card monitor instead of the presence monitor")
+    parser.add_argument("--debounce", type=float, default=0.3,
+                        help="seconds a card coming back to a reader it just left must stay before its tap")
+    parser.add_argument("--sam-t1", action="store_true", help="t=1 sam, its data commands are sent with le")
+    return parser
+
+
+def start_logging(args):
+    '''
+    log listener, apdu trace and metrics export of a gate process, returns the listener
+    '''
+    # log records are written by a listener thread, the taps only queue them
+    log_listener = queue_logging(LOGGER_MAIN, args.log_json)
+    global TRACE_MAIN
+    TRACE_MAIN = ApduTrace(LOGGER_MAIN, sample_every=args.apdu_log_every, max_per_second=args.apdu_log_rate)
+
+    args.metrics_port and METRICS_MAIN.serve_prometheus(args.metrics_port)
+    args.metrics_file and METRICS_MAIN.start_file_export(args.metrics_file)
+    return log_listener
+
+
+class GateServices:
+    '''
+    journal, settlement, denylist, ledger and tariff of a gate process, opened as its options ask
+    '''
+
+    def __init__(self, args, startup, logger=None):
+        # journal, flag what the last run left incomplete before taking new taps
+        self.journal = None
+        if args.journal:
+            with startup.phase("journal"):
+                from brizzi_journal import TransactionJournal
+                self.journal = TransactionJournal(args.journal, logger=logger)
+                self.journal.recover()
+
+        # ref and batch numbers for the sam hash, batches exported from the journal
+        self.settlement = self.exporter = None
+        if self.journal is not None and args.settlement:
+            with startup.phase("settlement"):
+                import brizzi_settlement
+                os.makedirs(args.settlement, exist_ok=True)
+                self.settlement = brizzi_settlement.SettlementCounters(os.path.join(args.settlement, "counters.json"))
+                self.exporter = brizzi_settlement.SettlementExporter(
+                    args.journal, args.settlement, self.settlement,
+                    args.upload_dir and brizzi_settlement.LocalDirectoryUploader(args.upload_dir) or None,
+                    logger).start()
+
+        with startup.phase("config"):
+            self.denylist = CardDenylist(args.denylist, logger=logger) if args.denylist else None
+
+            # balance ledger, a card whose balance disagrees with its last debit here is flagged
+            self.ledger = None
+            if args.ledger:
+                from brizzi_ledger import BalanceLedger
+                self.ledger = BalanceLedger(args.ledger, logger=logger)
+
+            # fares by time of day, lane and month total, the fixed amount without
+            self.tariff = None
+            if args.tariff:
+                from brizzi_tariff import TariffEngine
+                self.tariff = TariffEngine(args.tariff, logger=logger)
+
+        self.sam_le = 0x00 if args.sam_t1 else None
+
+    def close(self):
+        self.ledger and self.ledger.close()
+        self.exporter and self.exporter.stop()
+        self.journal and self.journal.close()
+
 
-        global GPIO_CONTROL_MAIN
-        GPIO_CONTROL_MAIN = GPIOControl()
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Brizzi gate controller")
+    parser.add_argument("--lanes", help="lane configuration json, one worker per picc reader")
+    args = gate_arguments(parser).parse_args()
+
+    log_listener = start_logging(args)
+
+    try:
+        startup = StartupTimer(LOGGER_MAIN)
+
+        global GPIO_CONTROL_MAIN, ACTUATOR_MAIN
+        with startup.phase("gpio"):
+            GPIO_CONTROL_MAIN = GPIOControl()
+            ACTUATOR_MAIN = ActuatorScheduler(GPIO_CONTROL_MAIN, LOGGER_MAIN).start()
+
+        services = GateServices(args, startup, LOGGER_MAIN)
+        journal, settlement, denylist = services.journal, services.settlement, services.denylist
+        ledger, tariff, sam_le = services.ledger, services.tariff, services.sam_le
+
+        with startup.phase("readers"):
+            # sam session pool, kept selected and health checked in background
+            sam_pool = SamSessionPool(LOGGER_MAIN)
+
+            # picc reader connections, kept across taps and dropped when a reader is unplugged
+            connections = ReaderConnectionManager(LOGGER_MAIN)
+
+            # sam selected and picc contexts up before the first card, not on it
+            prewarm_readers(sam_pool, connections, LOGGER_MAIN)
+            sam_pool.start()
+            readermonitor = ReaderMonitor()
+            readermonitor.addObserver(connections)
+
+        # card presence, blocking status change waits per reader, or the polling card monitor of pyscard
+        with startup.phase("monitor"):
+            if args.card_monitor:
+                cardmonitor = CardMonitor()
+            else:
+                cardmonitor = PresenceMonitor(LOGGER_MAIN, debounce=args.debounce)
+                readermonitor.addObserver(cardmonitor)
+            if args.lanes:
+                lanes = load_lane_config(args.lanes, sam_le=sam_le)
+                cardobserver = LaneOrchestrator(lanes, sam_pool, LOGGER_MAIN, journal,
+                                                settlement, denylist, connections, ledger, tariff).start()
+            else:
+                cardobserver = BrizziCardObserver(sam_pool, journal, settlement, denylist=denylist,
+                                                  connections=connections, ledger=ledger, tariff=tariff,
+                                                  sam_le=sam_le)
+            cardmonitor.addObserver(cardobserver)
 
-        # card monitor
-        cardmonitor = CardMonitor()
-        cardobserver = BrizziCardObserver()
-        cardmonitor.addObserver(cardobserver)
+        # initial screen, the gate takes cards from here
+        startup.check(args.startup_budget)
+        LOGGER_MAIN.info("System ready....")
 
         # eternal loop
         try:
@@ -645,6 +3386,17 @@ def main():
 
         # delete observer
         cardmonitor.deleteObserver(cardobserver)
+        if not args.card_monitor:
+            readermonitor.deleteObserver(cardmonitor)
+            cardmonitor.stop()
+        readermonitor.deleteObserver(connections)
+        if args.lanes:
+            cardobserver.stop()
+        else:
+            cardobserver.close()
+        connections.close()
+        sam_pool.close()
+        services.close()
 
         import sys
 
@@ -654,7 +3406,10 @@ def main():
     except Exception as err:
         pass
 
+    ACTUATOR_MAIN and ACTUATOR_MAIN.stop()
+    METRICS_MAIN.stop()
     GPIO_CONTROL_MAIN.gpio_cleanup()
+    log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,470 @@
+'''
+offline analysis of transaction journals and logs
+
+journal events, tap results and apdu exchanges are streamed into columns of numbers, strings become codes,
+every statistic is computed on numpy arrays
+parsing is incremental, the columns of every source are cached with the offset read so far and a second run
+only parses what was appended since
+
+    python brizzi_analysis.py --journal brizzi_journal.sqlite3 --log log/brizzi.log --cache .analysis
+'''
+import argparse
+import array
+import ast
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("brizzi_analysis needs numpy, pip install numpy")
+
+
+class Codes:
+    '''
+    string to small int codes of one source, None is -1
+    '''
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self._index = dict((value, code) for code, value in enumerate(self.values))
+
+    def code(self, value):
+        if value is None:
+            return -1
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def find(self, value):
+        # -2 matches no code, looking up does not add the value
+        return self._index.get(value, -2)
+
+    def name(self, code):
+        return code >= 0 and self.values[code] or None
+
+
+class Columns:
+    '''
+    append only table of typed columns, array.array while parsing and numpy arrays for analysis
+    '''
+
+    def __init__(self, **types):
+        self.types = types
+        self.data = dict((name, array.array(typecode)) for name, typecode in types.items())
+
+    def __len__(self):
+        return len(next(iter(self.data.values())))
+
+    def append(self, *values):
+        for column, value in zip(self.data.values(), values):
+            column.append(value)
+
+    def arrays(self):
+        require_numpy()
+        # copied out, an array.array exporting its buffer could not grow on the next update
+        return dict((name, np.frombuffer(column.tobytes(), dtype=column.typecode))
+                    for name, column in self.data.items())
+
+    def dump(self, prefix):
+        return dict((prefix + name, column.tobytes()) for name, column in self.data.items())
+
+    def load(self, prefix, stored):
+        for name, column in self.data.items():
+            column.frombytes(stored.get(prefix + name, b""))
+
+
+# text log line time, the listener formats asctime with milliseconds after a comma
+_second_cache = {}
+
+
+def parse_asctime(text):
+    second = _second_cache.get(text[:19])
+    if second is None:
+        second = _second_cache[text[:19]] = time.mktime(time.strptime(text[:19], "%Y-%m-%d %H:%M:%S"))
+    return second + int(text[20:23]) / 1000.0
+
+
+class LogSource:
+    '''
+    one log file, text or --log-json lines, parsed into taps, their steps and apdu exchanges
+    tap results are the "result {json}" debug records, older logs hold the repr of the result dict
+    exchanges are the APDU trace records, and the Transmit to / [SW1SW2] pairs of the old debug output
+    a trace dump of a failed tap repeats at warning level what sampling may already have logged at debug level
+    '''
+    KIND = "log"
+
+    def __init__(self, path):
+        self.path = path
+        self._reset()
+
+    def _reset(self, inode=None):
+        self.offset = 0
+        self.inode = inode
+        self.codes = Codes()
+        self.taps = Columns(ts='d', status='b', total_ms='f', connect_ms='f', failed_step='i', failure_reason='i',
+                            failure_sw='i', card='i')
+        self.steps = Columns(tap='i', step='i', ms='f')
+        self.apdus = Columns(ts='d', to_sam='b', command='i', sw='i', ms='f', dumped='b')
+        self._pending = None
+
+    def tables(self):
+        return {'taps': self.taps, 'steps': self.steps, 'apdus': self.apdus}
+
+    def state(self):
+        return {'offset': self.offset, 'inode': self.inode, 'codes': self.codes.values, 'pending': self._pending}
+
+    def restore(self, state):
+        self.offset = state['offset']
+        self.inode = state['inode']
+        self.codes = Codes(state['codes'])
+        self._pending = state['pending']
+
+    def update(self):
+        '''
+        parse what was appended since the last call, a rotated or truncated file is parsed again
+        returns the number of bytes read
+        '''
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self._reset(stat.st_ino)
+        read = 0
+        with open(self.path, "rb") as log_file:
+            log_file.seek(self.offset)
+            for line in log_file:
+                if not line.endswith(b"\n"):
+                    # still being written, taken on the next update
+                    break
+                read += len(line)
+                self.parse_line(line.decode("utf-8", "replace"))
+        self.offset += read
+        return read
+
+    def parse_line(self, line):
+        if line.startswith("{"):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                return
+            if 'target' in entry:
+                self._apdu(entry['ts'], entry['target'] == "sam", entry['apdu'], entry.get('sw'), entry.get('ms', 0.0),
+                           entry.get('level') == "WARNING")
+            else:
+                self.parse_message(entry.get('ts', 0.0), entry.get('msg', ""), entry.get('level'))
+            return
+        parts = line.split(" - ", 3)
+        if len(parts) == 4 and len(parts[0]) >= 23:
+            try:
+                ts = parse_asctime(parts[0])
+            except ValueError:
+                return
+            self.parse_message(ts, parts[3].rstrip("\n"), parts[1])
+
+    def parse_message(self, ts, message, level=None):
+        if message.startswith("APDU trace"):
+            # header of a dump, its exchanges follow as APDU records
+            pass
+        elif message.startswith("APDU "):
+            # APDU picc 5A010000 -> [9000] 00 (6.1 ms)
+            fields = message.split(" ", 5)
+            if len(fields) >= 5:
+                sw = fields[4][1:-1]
+                self._apdu(ts, fields[1] == "sam", fields[2], sw != "None" and sw or None,
+                           float(message[message.rfind("(") + 1:message.rfind(" ms)")] or 0.0), level == "WARNING")
+        elif message.startswith("result "):
+            self._tap(ts, json.loads(message[7:]))
+        elif message.startswith("{'status'"):
+            try:
+                self._tap(ts, ast.literal_eval(message))
+            except (ValueError, SyntaxError):
+                pass
+        elif message.startswith("Transmit to "):
+            target, _, apdu = message[12:].partition(" = ")
+            self._pending = (ts, target == "SAMCARD", apdu.strip())
+        elif message.startswith("[SW1SW2] : DATA = [") and self._pending is not None:
+            pending_ts, to_sam, apdu = self._pending
+            self._pending = None
+            self._apdu(pending_ts, to_sam, apdu, message[19:23], (ts - pending_ts) * 1000)
+
+    def _apdu(self, ts, to_sam, apdu, sw, ms, dumped=False):
+        # sam commands by class and instruction, native picc commands by their command byte
+        self.apdus.append(ts, to_sam, self.codes.code(apdu[:to_sam and 4 or 2].upper()), self.codes.code(sw), ms,
+                          dumped)
+
+    def _tap(self, ts, result):
+        tap = len(self.taps)
+        self.taps.append(ts, bool(result.get('status')), result.get('total_ms') or 0.0,
+                         result.get('connect_ms') or 0.0, self.codes.code(result.get('failed_step')),
+                         self.codes.code(result.get('failure_reason')), self.codes.code(result.get('failure_sw')),
+                         self.codes.code(result.get('card_number') or None))
+        for step, ms in (result.get('timing') or {}).items():
+            self.steps.append(tap, self.codes.code(step), ms)
+
+
+class JournalSource:
+    '''
+    events of a transaction journal, read incrementally by seq
+    '''
+    KIND = "journal"
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self.codes = Codes()
+        self.events = Columns(ts='d', tx='i', event='i', lane='i', card='i', failed_step='i')
+
+    def tables(self):
+        return {'events': self.events}
+
+    def state(self):
+        return {'seq': self.seq, 'codes': self.codes.values}
+
+    def restore(self, state):
+        self.seq = state['seq']
+        self.codes = Codes(state['codes'])
+
+    def update(self):
+        connection = sqlite3.connect(self.path)
+        count = 0
+        try:
+            for seq, tx_id, ts, event, data in connection.execute(
+                    "SELECT seq, tx_id, ts, event, data FROM journal WHERE seq > ? ORDER BY seq", (self.seq,)):
+                data = data and json.loads(data) or {}
+                self.events.append(ts, self.codes.code(tx_id), self.codes.code(event),
+                                   self.codes.code(data.get('lane')), self.codes.code(data.get('card_number')),
+                                   self.codes.code(data.get('failed_step')))
+                self.seq = seq
+                count += 1
+        finally:
+            connection.close()
+        return count
+
+
+class SourceCache:
+    '''
+    columns and read state of every source, one file per source in directory
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, source):
+        name = hashlib.sha1(os.path.abspath(source.path).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, "{}-{}.npz".format(source.KIND, name))
+
+    def load(self, source):
+        path = self._path(source)
+        if not os.path.exists(path):
+            return source
+        require_numpy()
+        with np.load(path) as stored:
+            stored = dict((key, stored[key].tobytes()) for key in stored.files)
+        source.restore(json.loads(stored.pop('state').decode()))
+        for name, table in source.tables().items():
+            table.load(name + ".", stored)
+        return source
+
+    def save(self, source):
+        require_numpy()
+        stored = {'state': np.frombuffer(json.dumps(source.state()).encode(), dtype=np.uint8)}
+        for name, table in source.tables().items():
+            for key, value in table.dump(name + ".").items():
+                stored[key] = np.frombuffer(value, dtype=np.uint8)
+        temp_path = self._path(source) + ".tmp.npz"
+        np.savez(temp_path, **stored)
+        os.replace(temp_path, self._path(source))
+
+
+def _groups(keys):
+    '''
+    order sorting keys, and the unique keys with the start and length of their run in that order
+    '''
+    order = np.argsort(keys, kind='stable')
+    unique, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    return order, unique, starts, counts
+
+
+def latency_by(keys, values, codes, percents=(50, 90, 99)):
+    '''
+    count and latency percentiles of values grouped by key code
+    '''
+    report = {}
+    if not len(keys):
+        return report
+    order, unique, starts, counts = _groups(keys)
+    values = values[order]
+    for key, start, count in zip(unique.tolist(), starts.tolist(), counts.tolist()):
+        group = values[start:start + count]
+        quantiles = np.percentile(group, percents)
+        report[codes.name(key) or "-"] = dict(
+            [('count', count)] + [("p{}_ms".format(percent), round(float(value), 3))
+                                  for percent, value in zip(percents, quantiles)] +
+            [('max_ms', round(float(group.max()), 3))])
+    return report
+
+
+def count_by(keys, codes, total=None):
+    unique, counts = np.unique(keys, return_counts=True)
+    return dict((codes.name(key) or "-", round(count / total, 5) if total else count)
+                for key, count in zip(unique.tolist(), counts.tolist()))
+
+
+def step_latency(source):
+    arrays = source.steps.arrays()
+    return latency_by(arrays['step'], arrays['ms'], source.codes)
+
+
+def apdu_latency(source):
+    '''
+    latency and status words by command, from the sampled exchanges when there are any, else from the dumps
+    '''
+    arrays = source.apdus.arrays()
+    sampled = arrays['dumped'] == 0
+    if sampled.any():
+        arrays = dict((name, column[sampled]) for name, column in arrays.items())
+    # sam and picc commands sharing a byte are kept apart, sam codes are 4 hex digits
+    return {'latency': latency_by(arrays['command'], arrays['ms'], source.codes),
+            'status_words': count_by(arrays['sw'], source.codes)}
+
+
+def failure_rates(source):
+    '''
+    failed share of the taps by failed step, by status word and by both
+    '''
+    arrays = source.taps.arrays()
+    total = len(arrays['status'])
+    if not total:
+        return {'taps': 0}
+    failed = arrays['status'] == 0
+    step, sw = arrays['failed_step'][failed], arrays['failure_sw'][failed]
+    # one key per step and status word pair, None codes are shifted to 0
+    pairs, counts = np.unique((step.astype(np.int64) + 1) << 32 | (sw.astype(np.int64) + 1), return_counts=True)
+    by_step_sw = {}
+    for pair, count in zip(pairs.tolist(), counts.tolist()):
+        key = "{} {}".format(source.codes.name((pair >> 32) - 1) or "-",
+                             source.codes.name((pair & 0xFFFFFFFF) - 1) or "-")
+        by_step_sw[key] = round(count / total, 5)
+    return {
+        'taps': total,
+        'failed': int(failed.sum()),
+        'by_step': count_by(step, source.codes, total),
+        'by_reason': count_by(arrays['failure_reason'][failed], source.codes, total),
+        'by_sw': count_by(sw, source.codes, total),
+        'by_step_sw': by_step_sw,
+        'total_p50_ms': round(float(np.percentile(arrays['total_ms'], 50)), 3),
+        'connect_p50_ms': round(float(np.percentile(arrays['connect_ms'], 50)), 3)
+    }
+
+
+def taps_per_minute(source):
+    '''
+    gate outcomes per minute for every lane, from the actuator events
+    '''
+    arrays = source.events.arrays()
+    actuator = arrays['event'] == source.codes.find("actuator")
+    lanes = arrays['lane'][actuator].astype(np.int64)
+    minutes = (arrays['ts'][actuator] // 60).astype(np.int64)
+    report = {}
+    if not len(lanes):
+        return report
+    keys, counts = np.unique(lanes << 40 | (minutes & (1 << 40) - 1), return_counts=True)
+    lane_of_key = keys >> 40
+    for lane in np.unique(lane_of_key).tolist():
+        lane_counts = counts[lane_of_key == lane]
+        lane_keys = keys[lane_of_key == lane]
+        busiest = int(lane_counts.argmax())
+        report[source.codes.name(lane) or "-"] = {
+            'minutes': len(lane_counts),
+            'taps': int(lane_counts.sum()),
+            'mean': round(float(lane_counts.mean()), 2),
+            'peak': int(lane_counts[busiest]),
+            'peak_minute': time.strftime("%Y-%m-%d %H:%M", time.localtime(int(lane_keys[busiest] & (1 << 40) - 1) * 60))
+        }
+    return report
+
+
+def repeat_taps(source, window=60.0):
+    '''
+    taps of the same card within window seconds of the previous one
+    double charges are two committed taps, retries follow a tap that did not commit
+    '''
+    arrays = source.events.arrays()
+    count = len(source.codes.values)
+    tx, event, card, ts = arrays['tx'], arrays['event'], arrays['card'], arrays['ts']
+    if not len(tx):
+        return {'transactions': 0}
+    # per transaction, indexed by its tx code
+    tx_card = np.full(count, -1, dtype=np.int64)
+    has_card = card >= 0
+    tx_card[tx[has_card]] = card[has_card]
+    tx_start = np.full(count, np.inf)
+    np.minimum.at(tx_start, tx, ts)
+    tx_committed = np.zeros(count, dtype=bool)
+    tx_committed[tx[event == source.codes.find("commit")]] = True
+
+    known = np.flatnonzero(tx_card >= 0)
+    order = known[np.lexsort((tx_start[known], tx_card[known]))]
+    cards, starts, committed = tx_card[order], tx_start[order], tx_committed[order]
+    repeat = (cards[1:] == cards[:-1]) & (np.diff(starts) < window)
+    double = repeat & committed[1:] & committed[:-1]
+    retry = repeat & ~committed[:-1]
+    gaps = np.diff(starts)[repeat]
+    return {
+        'transactions': len(np.unique(tx)),
+        'cards': len(np.unique(cards)),
+        'repeats': int(repeat.sum()),
+        'double_charges': int(double.sum()),
+        'double_charged_cards': len(np.unique(cards[1:][double])),
+        'retries': int(retry.sum()),
+        'retries_committed': int((retry & committed[1:]).sum()),
+        'repeat_gap_p50_s': round(float(np.median(gaps)), 3) if len(gaps) else None
+    }
+
+
+def analyse(journal_paths=(), log_paths=(), cache_directory=None, window=60.0):
+    '''
+    report of every source, sources are updated from the cache when one is given
+    '''
+    require_numpy()
+    cache = cache_directory and SourceCache(cache_directory) or None
+    report = {}
+    for kind, paths in ((JournalSource, journal_paths), (LogSource, log_paths)):
+        for path in paths:
+            source = cache and cache.load(kind(path)) or kind(path)
+            start = time.perf_counter()
+            read = source.update()
+            cache and cache.save(source)
+            parsed = {'read': read, 'parse_s': round(time.perf_counter() - start, 3)}
+            if kind is JournalSource:
+                report[path] = dict(parsed, taps_per_minute=taps_per_minute(source),
+                                    repeat_taps=repeat_taps(source, window))
+            else:
+                report[path] = dict(parsed, failures=failure_rates(source), steps=step_latency(source),
+                                    apdus=apdu_latency(source))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency, failure and tap statistics of journals and logs")
+    parser.add_argument("--journal", action="append", default=[], help="transaction journal sqlite file")
+    parser.add_argument("--log", action="append", default=[], help="log file, text or --log-json")
+    parser.add_argument("--cache", help="directory keeping parsed columns, later runs only parse what was appended")
+    parser.add_argument("--window", type=float, default=60.0, help="seconds between taps counted as a repeat")
+    args = parser.parse_args()
+
+    print(json.dumps(analyse(args.journal, args.log, args.cache, args.window), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+'''
+asyncio front end
+
+every apdu and transaction step is awaitable, the blocking pc/sc calls run on a bounded executor per reader
+card insertion arrives as an async stream, so one event loop drives all lanes with a timeout per tap
+
+    python brizzi_async.py --lanes lanes.json
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import threading
+
+from smartcard.CardMonitoring import CardMonitor, CardObserver
+from smartcard.ReaderMonitoring import ReaderMonitor
+from smartcard.util import toHexString, PACK
+
+import brizzi
+
+
+class ReaderExecutors:
+    '''
+    one bounded thread pool per reader, a reader never sees two exchanges at the same time
+    '''
+
+    def __init__(self):
+        self._executors = {}
+        self._lock = threading.Lock()
+
+    def executor(self, name, max_workers=1):
+        with self._lock:
+            executor = self._executors.get(name)
+            if executor is None:
+                executor = self._executors[name] = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix="reader-" + name[:24])
+            return executor
+
+    def shutdown(self):
+        with self._lock:
+            executors, self._executors = list(self._executors.values()), {}
+        for executor in executors:
+            executor.shutdown()
+
+
+class AsyncBrizziProcessor:
+    '''
+    awaitable wrapper of a BrizziProcessor, picc steps run on picc_executor and sam steps on sam_executor
+    the step graph and per connection ordering are the ones of BrizziProcessor.TRANSACTION_STEPS
+    '''
+
+    def __init__(self, processor, picc_executor, sam_executor, logger=None):
+        self.processor = processor
+        self._picc_executor = picc_executor
+        self._sam_executor = sam_executor
+        self._logger = logger
+
+    def _run(self, to_sam, function, *args):
+        return asyncio.get_running_loop().run_in_executor(to_sam and self._sam_executor or self._picc_executor,
+                                                          function, *args)
+
+    async def send_apdu(self, apdu_text=None, to_sam=True):
+        return await self._run(to_sam, self.processor.send_apdu, apdu_text, to_sam)
+
+    async def step(self, step, ctx):
+        return await self._run(step.target == 'sam', self.processor.run_step, step, ctx)
+
+    async def _run_steps(self, ctx):
+        tasks = {}
+        previous = {}
+
+        async def run_step(step, waits):
+            for name in waits:
+                if not await tasks[name]:
+                    return False
+            return await self.step(step, ctx)
+
+        for step in self.processor.steps:
+            # also wait for the step declared before on the same connection, its order must not change
+            waits = step.deps + tuple(name for name in (previous.get(step.target),)
+                                      if name is not None and name not in step.deps)
+            tasks[step.name] = asyncio.ensure_future(run_step(step, waits))
+            previous[step.target] = step.name
+
+        try:
+            results = await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        return all(results)
+
+    async def transaction_debet_card(self, debet_amount=0, mid=None, tid=None, proc_code=808117, ref_number=1,
+                                     batch_number=1, timeout=None):
+        '''
+        same result as BrizziProcessor.transaction_debet_card, failed_step is 'timeout' when timeout ran out
+        a cancelled tap still aborts an uncommitted debit before the cancellation is raised
+        '''
+        ctx, transaction_result, connected = await self._run(
+            False, self.processor.transaction_begin, debet_amount, mid, tid, proc_code, ref_number, batch_number)
+        if ctx is None:
+            return transaction_result
+
+        cancelled = False
+        try:
+            if connected:
+                transaction_result['status'] = await asyncio.wait_for(self._run_steps(ctx), timeout)
+        except asyncio.TimeoutError:
+            ctx.failed_step = ctx.failed_step or "timeout"
+        except asyncio.CancelledError:
+            ctx.failed_step = ctx.failed_step or "cancelled"
+            cancelled = True
+        except Exception as err:
+            pass
+            self._logger and self._logger.error(err)
+
+        # queued behind any step still running on the picc reader, the sam step in flight is not waited for
+        end = self._run(False, self._transaction_end, ctx, transaction_result)
+        try:
+            transaction_result = await asyncio.shield(end)
+        except asyncio.CancelledError:
+            cancelled = True
+            transaction_result = await end
+        if cancelled:
+            raise asyncio.CancelledError()
+        return transaction_result
+
+    def _transaction_end(self, ctx, transaction_result):
+        # a commit still in flight when the tap timed out has gone through, the passenger paid
+        if ctx.committed and not transaction_result['status']:
+            transaction_result['status'] = True
+            ctx.failed_step = None
+        return self.processor.transaction_end(ctx, transaction_result)
+
+    async def close(self):
+        await self._run(False, self.processor.close)
+
+
+class AsyncCardStream(CardObserver):
+    '''
+    card monitor events as an async stream of (added, card), added False for a removed card
+    the monitor thread only hands the cards over to the event loop
+    monitor is a brizzi.PresenceMonitor or any other with addObserver, a pyscard CardMonitor by default
+    '''
+
+    def __init__(self, loop=None, maxsize=0, monitor=None):
+        self._loop = loop
+        self._queue = None
+        self._maxsize = maxsize
+        self._monitor = monitor
+
+    async def __aenter__(self):
+        self._loop = self._loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self._maxsize)
+        self._monitor = self._monitor is not None and self._monitor or CardMonitor()
+        self._monitor.addObserver(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._monitor.deleteObserver(self)
+        self._monitor = None
+
+    def update(self, observable, actions):
+        (addedcards, removedcards) = actions
+        for card in removedcards:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (False, card))
+        for card in addedcards:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (True, card))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+
+class AsyncLane:
+    '''
+    one turnstile on the event loop, one tap at a time, its own gpio and actuator scheduler
+    '''
+
+    def __init__(self, config, gpio_control=None, logger=None):
+        self.config = config
+        self.lock = asyncio.Lock()
+        self.gpio = gpio_control if gpio_control is not None else brizzi.GPIOControl(config.pin_buzzer, config.pin_gate)
+        self.actuator = brizzi.ActuatorScheduler(self.gpio, logger)
+        self.taps = 0
+        self.succeeded = 0
+        self.timeouts = 0
+
+
+class AsyncLaneRunner:
+    '''
+    drives every lane from one event loop, sam cards go to the shared pool
+    '''
+
+    def __init__(self, lanes, sam_pool, logger=None, journal=None, settlement=None, card_cache=None,
+                 tap_timeout=2.0, executors=None, denylist=None, connections=None, ledger=None, tariff=None):
+        self.sam_pool = sam_pool
+        self.connections = connections if connections is not None else brizzi.ReaderConnectionManager(logger)
+        self.lanes = [AsyncLane(config, logger=logger) for config in lanes]
+        self.executors = executors if executors is not None else ReaderExecutors()
+        self._logger = logger
+        self._journal = journal
+        self._card_cache = card_cache if card_cache is not None else brizzi.CardSessionCache()
+        self._tap_timeout = tap_timeout
+        # processors kept per lane and reader, built on the picc reader thread of their first card
+        self._processors = dict((lane.config.name, brizzi.ReaderProcessors(
+            logger=logger, sam_pool=sam_pool, journal=journal, card_cache=self._card_cache, denylist=denylist,
+            ledger=ledger, tariff=tariff, settlement=settlement, **lane.config.processor_options()))
+            for lane in self.lanes)
+        self._tasks = set()
+
+    def lane_for(self, reader_name):
+        return next((lane for lane in self.lanes if lane.config.matches(reader_name)), None)
+
+    def _sam_executor(self, lane):
+        # a tap holds its sam session from the authentication to the hash, a lane waiting for the session must not
+        # sit in front of the hash of the lane holding it, so every lane has its own sam thread and the pool decides
+        return self.executors.executor("sam-" + lane.config.name)
+
+    async def process(self, lane, card):
+        '''
+        one tap of lane, returns the transaction result or None when no processor could be set up
+        '''
+        reader_name = str(card.reader)
+        picc_executor = self.executors.executor(reader_name)
+        loop = asyncio.get_running_loop()
+        result = None
+        async with lane.lock:
+            if brizzi.tap_begin(card) is False:
+                # out of the field again before its tap started
+                return None
+            picc_connection, picc_setup = await loop.run_in_executor(picc_executor, self.connections.acquire, card)
+            processors = self._processors[lane.config.name]
+            processor = await loop.run_in_executor(picc_executor, processors.acquire, reader_name, picc_connection,
+                                                   picc_setup)
+            async_processor = AsyncBrizziProcessor(processor, picc_executor, self._sam_executor(lane), self._logger)
+            try:
+                if processor.initialize:
+                    result = brizzi.tap_end(card, await async_processor.transaction_debet_card(
+                        lane.config.amount, timeout=self._tap_timeout))
+                    if result.get('retap'):
+                        # paid a moment ago, acknowledged only, the gate is left as it is
+                        lane.actuator.beep(1)
+                    elif result['status']:
+                        lane.succeeded += 1
+                        lane.actuator.beep(1)
+                        lane.actuator.gate_open()
+                    else:
+                        lane.timeouts += result['failed_step'] == "timeout"
+                        lane.actuator.beep(3)
+                        lane.actuator.gate_close()
+                    self._logger and self._logger.debug("result %s", brizzi.JsonMessage(result))
+                    if self._journal is not None and not result.get('retap'):
+                        self._journal.record(result['tx_id'], "actuator", {
+                            'lane': lane.config.name, 'gate': result['status'] and "open" or "closed"})
+            finally:
+                # a sam step may still run after a timeout or cancel, such a processor is not used again
+                settled = result is not None and result['failed_step'] not in ("timeout", "cancelled")
+                await loop.run_in_executor(picc_executor, processors.release, reader_name, processor, settled)
+                await loop.run_in_executor(picc_executor, self.connections.release, picc_connection, result)
+                result is None and brizzi.tap_end(card)
+            lane.taps += 1
+        return result
+
+    def dispatch(self, added, card):
+        '''
+        route one card event, a picc tap becomes a task on the loop
+        '''
+        reader_name = str(card.reader)
+        if toHexString(card.atr, PACK) == brizzi.BrizziCardObserver.sam_uid:
+            if not added:
+                self.sam_pool.remove_slot(reader_name)
+            elif not self.sam_pool.has_slot(reader_name):
+                self.sam_pool.add_connection(card.createConnection(), reader_name)
+            return None
+        if not added:
+            return None
+
+        lane = self.lane_for(reader_name)
+        if lane is None:
+            self._logger and self._logger.warning("No lane for reader {}".format(reader_name))
+            return None
+        task = asyncio.ensure_future(self.process(lane, card))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def run(self, stream):
+        for lane in self.lanes:
+            lane.actuator.start()
+        try:
+            async for added, card in stream:
+                self.dispatch(added, card)
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            self._tasks and await asyncio.gather(*self._tasks, return_exceptions=True)
+            for lane in self.lanes:
+                lane.actuator.stop()
+            for processors in self._processors.values():
+                processors.close()
+            self.executors.shutdown()
+            self.connections.close()
+
+    def stats(self):
+        stats = dict((lane.config.name, {'taps': lane.taps, 'succeeded': lane.succeeded, 'timeouts': lane.timeouts,
+                                         'actuator': lane.actuator.queue_wait_stats()})
+                     for lane in self.lanes)
+        stats['connections'] = self.connections.stats()
+        return stats
+
+
+async def serve(lanes, sam_pool, logger=None, journal=None, settlement=None, tap_timeout=2.0, denylist=None,
+                ledger=None, tariff=None, connections=None, startup=None, startup_budget=None, presence=None):
+    '''
+    startup is the brizzi.StartupTimer of the process, checked against startup_budget once cards are taken
+    presence is the brizzi.PresenceMonitor the cards come from, the pyscard card monitor without
+    '''
+    runner = AsyncLaneRunner(lanes, sam_pool, logger, journal, settlement, tap_timeout=tap_timeout,
+                             denylist=denylist, connections=connections, ledger=ledger, tariff=tariff)
+    # an unplugged reader drops its connection, the next card on it builds a new one
+    reader_monitor = ReaderMonitor()
+    reader_monitor.addObserver(runner.connections)
+    presence is not None and reader_monitor.addObserver(presence)
+    try:
+        async with AsyncCardStream(monitor=presence) as stream:
+            startup and startup.check(startup_budget)
+            logger and logger.info("System ready....")
+            await runner.run(stream)
+    finally:
+        reader_monitor.deleteObserver(runner.connections)
+        if presence is not None:
+            reader_monitor.deleteObserver(presence)
+            presence.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Brizzi gate controller on one event loop")
+    parser.add_argument("--lanes", required=True, help="lane configuration json")
+    parser.add_argument("--tap-timeout", type=float, default=2.0, help="seconds before a tap is given up")
+    args = brizzi.gate_arguments(parser).parse_args()
+
+    log_listener = brizzi.start_logging(args)
+    startup = brizzi.StartupTimer(brizzi.LOGGER_MAIN)
+    services = brizzi.GateServices(args, startup, brizzi.LOGGER_MAIN)
+
+    with startup.phase("readers"):
+        sam_pool = brizzi.SamSessionPool(brizzi.LOGGER_MAIN)
+        connections = brizzi.ReaderConnectionManager(brizzi.LOGGER_MAIN)
+        brizzi.prewarm_readers(sam_pool, connections, brizzi.LOGGER_MAIN)
+        sam_pool.start()
+    lanes = brizzi.load_lane_config(args.lanes, sam_le=services.sam_le)
+    try:
+        asyncio.run(serve(lanes, sam_pool, brizzi.LOGGER_MAIN, services.journal, services.settlement,
+                          tap_timeout=args.tap_timeout, denylist=services.denylist,
+                          ledger=services.ledger, tariff=services.tariff, connections=connections, startup=startup,
+                          startup_budget=args.startup_budget,
+                          presence=not args.card_monitor and brizzi.PresenceMonitor(
+                              brizzi.LOGGER_MAIN, debounce=args.debounce) or None))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sam_pool.close()
+        services.close()
+        brizzi.METRICS_MAIN.stop()
+        log_listener.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''
+card inspection for service desks and top up counters
+
+balance, last debit date, month total and log of every card presented, read only with BrizziProcessor.card_inspect
+one row per card is written as soon as the card is read, csv or one json object per line
+the sam stays selected in its pool and the picc reader connection is kept across cards, only the card is new
+
+    python brizzi_inspect.py --format csv --output inspected.csv
+    python brizzi_inspect.py --simulate 500 --picc-latency 3 --sam-latency 2
+'''
+import argparse
+import csv
+import json
+import sys
+import threading
+import time
+
+from smartcard.CardMonitoring import CardMonitor, CardObserver
+from smartcard.ReaderMonitoring import ReaderMonitor
+from smartcard.util import toHexString, PACK
+
+import brizzi
+
+CSV_FIELDS = ('inspection_date', 'inspection_time', 'reader', 'status', 'card_number', 'card_uid', 'balance',
+              'last_transaction_date', 'akum_debet', 'log_records', 'log', 'failed_step', 'failure_reason',
+              'total_ms')
+
+
+class InspectionWriter:
+    '''
+    rows of inspected cards to a text stream, flushed per card so a desk sees every card at once
+    '''
+
+    def __init__(self, stream, output_format="csv"):
+        self._stream = stream
+        self._format = output_format
+        self._lock = threading.Lock()
+        self._csv = None
+        if output_format == "csv":
+            self._csv = csv.DictWriter(stream, CSV_FIELDS, extrasaction='ignore')
+            self._csv.writeheader()
+        self.rows = 0
+
+    def write(self, result, reader=None):
+        with self._lock:
+            if self._csv is not None:
+                row = dict(result, reader=reader, log_records=len(result['log']),
+                           log=json.dumps(result['log'], separators=(',', ':')))
+                self._csv.writerow(row)
+            else:
+                self._stream.write(json.dumps(dict(result, reader=reader)) + "\n")
+            self._stream.flush()
+            self.rows += 1
+
+
+class InspectionObserver(CardObserver):
+    '''
+    inspects every picc presented, sam cards go to the pool as on the gate
+    '''
+
+    def __init__(self, sam_pool, writer, connections=None, log_records=0, logger=None):
+        self.sam_pool = sam_pool
+        self.writer = writer
+        self.connections = connections if connections is not None else brizzi.ReaderConnectionManager(logger)
+        self.log_records = log_records
+        self.processors = brizzi.ReaderProcessors(logger=logger, sam_pool=sam_pool)
+        self._logger = logger
+        self.inspected = 0
+        self.failed = 0
+        self.busy_time = 0.0
+
+    def inspect(self, card):
+        if brizzi.tap_begin(card) is False:
+            return None
+        start = time.perf_counter()
+        result = None
+        picc_connection, picc_setup = self.connections.acquire(card)
+        if picc_connection is not None:
+            with self.processors.tap(str(card.reader), picc_connection, picc_setup) as processor:
+                if processor.initialize:
+                    result = processor.card_inspect(self.log_records)
+            self.connections.release(picc_connection, result)
+        brizzi.tap_end(card)
+        if result is not None:
+            self.writer.write(result, str(card.reader))
+            self.inspected += 1
+            self.failed += not result['status']
+        self.busy_time += time.perf_counter() - start
+        return result
+
+    def update(self, observable, actions):
+        (addedcards, removedcards) = actions
+
+        for card in removedcards:
+            if toHexString(card.atr, PACK) == brizzi.BrizziCardObserver.sam_uid:
+                self.sam_pool.remove_slot(str(card.reader))
+
+        for card in addedcards:
+            if toHexString(card.atr, PACK) == brizzi.BrizziCardObserver.sam_uid:
+                if not self.sam_pool.has_slot(str(card.reader)):
+                    self.sam_pool.add_connection(card.createConnection(), str(card.reader))
+            else:
+                self.inspect(card)
+
+    def stats(self):
+        return {
+            'inspected': self.inspected,
+            'failed': self.failed,
+            'cards_per_s': self.busy_time and round(self.inspected / self.busy_time, 1) or 0.0,
+            'connections': self.connections.stats()
+        }
+
+
+def simulate(cards, writer, log_records=0, picc_latency=0.0, sam_latency=0.0, debits=3):
+    '''
+    inspect a simulated queue of cards presented one after the other on one reader, returns the observer stats
+    every card first gets debits debits so there is a log to read
+    '''
+    import brizzi_sim
+
+    sam_pool = brizzi.SamSessionPool()
+    sam_pool.add_connection(brizzi_sim.SimulatedSam(latency=sam_latency / 1000.0), "Simulated SAM")
+    population = brizzi_sim.make_card_population(cards)
+    for card in population:
+        with brizzi.BrizziProcessor(sam_pool=sam_pool, picc_connection=card, debug_mode=False) as processor:
+            for index in range(debits):
+                processor.transaction_debet_card(index + 1)
+    reader = brizzi_sim.SimulatedReader("Simulated Desk")
+    observer = InspectionObserver(sam_pool, writer, log_records=log_records)
+    started = time.perf_counter()
+    for card in population:
+        card.latency = picc_latency / 1000.0
+        observer.update(None, ([reader.present(card)], []))
+    stats = observer.stats()
+    stats['elapsed_s'] = round(time.perf_counter() - started, 3)
+    observer.processors.close()
+    observer.connections.close()
+    sam_pool.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="read balance, last debit and log of the cards presented")
+    parser.add_argument("--format", choices=("csv", "json"), default="csv", help="csv, or one json object a line")
+    parser.add_argument("--output", help="file the rows are appended to, standard output without")
+    parser.add_argument("--log-records", type=int, default=0, help="log records read per card, 0 for all")
+    parser.add_argument("--card-monitor", action="store_true",
+                        help="cards from the polling pyscard card monitor instead of the presence monitor")
+    parser.add_argument("--simulate", type=int, default=0, help="inspect this many simulated cards and exit")
+    parser.add_argument("--picc-latency", type=float, default=0.0, help="simulated picc ms per apdu")
+    parser.add_argument("--sam-latency", type=float, default=0.0, help="simulated sam ms per apdu")
+    args = parser.parse_args()
+
+    stream = args.output and open(args.output, "a", newline="") or sys.stdout
+    writer = InspectionWriter(stream, args.format)
+    try:
+        if args.simulate:
+            stats = simulate(args.simulate, writer, args.log_records, args.picc_latency, args.sam_latency)
+            print(json.dumps(stats), file=sys.stderr)
+            return
+
+        log_listener = brizzi.queue_logging(brizzi.LOGGER_MAIN)
+        sam_pool = brizzi.SamSessionPool(brizzi.LOGGER_MAIN)
+        connections = brizzi.ReaderConnectionManager(brizzi.LOGGER_MAIN)
+        brizzi.prewarm_readers(sam_pool, connections, brizzi.LOGGER_MAIN)
+        sam_pool.start()
+        readermonitor = ReaderMonitor()
+        readermonitor.addObserver(connections)
+        if args.card_monitor:
+            cardmonitor = CardMonitor()
+        else:
+            cardmonitor = brizzi.PresenceMonitor(brizzi.LOGGER_MAIN)
+            readermonitor.addObserver(cardmonitor)
+        observer = InspectionObserver(sam_pool, writer, connections, args.log_records, brizzi.LOGGER_MAIN)
+        cardmonitor.addObserver(observer)
+        brizzi.LOGGER_MAIN.info("Inspection ready....")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        cardmonitor.deleteObserver(observer)
+        if not args.card_monitor:
+            readermonitor.deleteObserver(cardmonitor)
+            cardmonitor.stop()
+        readermonitor.deleteObserver(connections)
+        observer.processors.close()
+        connections.close()
+        sam_pool.close()
+        brizzi.LOGGER_MAIN.info("Inspected {}".format(json.dumps(observer.stats())))
+        log_listener.stop()
+    finally:
+        stream is not sys.stdout and stream.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+'''
+durable local transaction journal
+
+append only sqlite journal in wal mode, written by one thread in group commits so a tap only pays a queue put
+on startup recover() flags transactions that were debited but never finished, for settlement
+'''
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# events of one transaction, in the order they are written
+EVENT_INTENT = "intent"
+EVENT_DEBIT = "debit"
+EVENT_HASH = "hash"
+EVENT_COMMIT = "commit"
+EVENT_COMMIT_FAILED = "commit_failed"
+EVENT_ABORT = "abort"
+EVENT_ACTUATOR = "actuator"
+
+# recovery reasons
+RECOVERY_DEBIT_IN_FLIGHT = "debit_in_flight"
+RECOVERY_COMMIT_UNCONFIRMED = "commit_unconfirmed"
+RECOVERY_ACTUATOR_UNKNOWN = "actuator_unknown"
+
+
+class TransactionJournal:
+    '''
+    append only journal of debit transactions, one row per event
+    '''
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS journal ("
+        " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " tx_id TEXT NOT NULL,"
+        " ts REAL NOT NULL,"
+        " event TEXT NOT NULL,"
+        " data TEXT)",
+        "CREATE INDEX IF NOT EXISTS journal_tx_id ON journal (tx_id)",
+        "CREATE TABLE IF NOT EXISTS recovery ("
+        " tx_id TEXT PRIMARY KEY,"
+        " reason TEXT NOT NULL,"
+        " last_event TEXT NOT NULL,"
+        " flagged_at REAL NOT NULL,"
+        " settled INTEGER NOT NULL DEFAULT 0)",
+    )
+
+    def __init__(self, path="brizzi_journal.sqlite3", group_window=0.002, group_size=128, logger=None):
+        self.path = path
+        self._logger = logger
+        self._group_window = group_window
+        self._group_size = group_size
+        self._queue = queue.Queue()
+        self._ids = itertools.count()
+        self._id_prefix = "{:x}-{:x}".format(int(time.time()), os.getpid())
+
+        # group commit statistic
+        self.groups = 0
+        self.records = 0
+        self.commit_time = 0.0
+
+        connection = self._connect()
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+        connection.close()
+
+        self._thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # FULL syncs the wal on every commit, one fsync per group
+        connection.execute("PRAGMA synchronous=FULL")
+        return connection
+
+    def begin(self, data=None):
+        '''
+        new transaction id, the intent is journaled with data
+        '''
+        tx_id = "{}-{:x}".format(self._id_prefix, next(self._ids))
+        self.record(tx_id, EVENT_INTENT, data)
+        return tx_id
+
+    def record(self, tx_id, event, data=None, durable=False):
+        '''
+        queue one event, durable waits until its group is on disk
+        '''
+        done = durable and threading.Event() or None
+        self._queue.put((tx_id, time.time(), event, data, done))
+        done and done.wait()
+
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self._queue.put((None, None, None, None, done))
+        return done.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        connection = self._connect()
+        running = True
+        while running:
+            item = self._queue.get()
+            group = [item]
+            deadline = time.monotonic() + self._group_window
+            # gather whatever else arrives within the window into the same commit, a durable event is waited for
+            # and goes at once
+            while item is not None and item[4] is None and len(group) < self._group_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        item = self._queue.get(timeout=remaining)
+                    else:
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                group.append(item)
+
+            running = group[-1] is not None
+            group = [entry for entry in group if entry is not None]
+            rows = [(tx_id, ts, event, data is not None and json.dumps(data) or None)
+                    for tx_id, ts, event, data, _ in group if tx_id is not None]
+            start = time.perf_counter()
+            try:
+                if rows:
+                    connection.executemany("INSERT INTO journal (tx_id, ts, event, data) VALUES (?, ?, ?, ?)", rows)
+                    connection.commit()
+            except Exception as err:
+                pass
+                self._logger and self._logger.error("journal write failed : {}".format(err))
+            self.commit_time += time.perf_counter() - start
+            self.groups += 1
+            self.records += len(rows)
+
+            for entry in group:
+                entry[4] and entry[4].set()
+        connection.close()
+
+    def events(self, tx_id):
+        connection = self._connect()
+        try:
+            return [(ts, event, data and json.loads(data) or None) for ts, event, data in connection.execute(
+                "SELECT ts, event, data FROM journal WHERE tx_id = ? ORDER BY seq", (tx_id,))]
+        finally:
+            connection.close()
+
+    def recover(self, since=None):
+        '''
+        flag transactions left incomplete by a crash, returns [(tx_id, reason, last_event)]
+        debit without commit or abort, the card may hold an uncommitted or committed debit
+        failed commit, the card may have committed before the answer was lost
+        commit without actuator outcome, the passenger paid but the gate state is unknown
+        since limits the scan to transactions started after that unix time
+        '''
+        self.flush()
+        connection = self._connect()
+        try:
+            flagged = []
+            now = time.time()
+            cursor = connection.execute(
+                "SELECT tx_id, group_concat(event) FROM (SELECT tx_id, event FROM journal WHERE ts >= ?"
+                " AND tx_id NOT IN (SELECT tx_id FROM recovery) ORDER BY seq) GROUP BY tx_id", (since or 0,))
+            for tx_id, events in cursor:
+                events = events.split(",")
+                reason = None
+                if EVENT_COMMIT_FAILED in events:
+                    reason = RECOVERY_COMMIT_UNCONFIRMED
+                elif EVENT_DEBIT in events and EVENT_COMMIT not in events and EVENT_ABORT not in events:
+                    reason = RECOVERY_DEBIT_IN_FLIGHT
+                elif EVENT_COMMIT in events and EVENT_ACTUATOR not in events:
+                    reason = RECOVERY_ACTUATOR_UNKNOWN
+                if reason is not None:
+                    flagged.append((tx_id, reason, events[-1]))
+            connection.executemany("INSERT INTO recovery (tx_id, reason, last_event, flagged_at) VALUES (?, ?, ?, ?)",
+                                   [(tx_id, reason, last_event, now) for tx_id, reason, last_event in flagged])
+            connection.commit()
+            for tx_id, reason, last_event in flagged:
+                self._logger and self._logger.warning(
+                    "journal recovery : {} {} (last event {})".format(tx_id, reason, last_event))
+            return flagged
+        finally:
+            connection.close()
+
+    def pending_settlement(self):
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT tx_id, reason, last_event, flagged_at FROM recovery"
+                                      " WHERE settled = 0 ORDER BY flagged_at").fetchall()
+        finally:
+            connection.close()
+
+    def mark_settled(self, tx_id):
+        connection = self._connect()
+        try:
+            connection.execute("UPDATE recovery SET settled = 1 WHERE tx_id = ?", (tx_id,))
+            connection.commit()
+        finally:
+            connection.close()
+
+    def stats(self):
+        return {
+            'groups': self.groups,
+            'records': self.records,
+            'records_per_group': self.groups and round(self.records / self.groups, 2) or 0,
+            'commit_ms_per_group': self.groups and round(self.commit_time / self.groups * 1000, 3) or 0
+        }
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    journal = TransactionJournal(len(sys.argv) > 1 and sys.argv[1] or "brizzi_journal.sqlite3",
+                                 logger=logging.getLogger("journal"))
+    journal.recover()
+    for row in journal.pending_settlement():
+        print(*row)
+    journal.close()
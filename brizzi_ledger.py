@@ -0,0 +1,352 @@
+'''
+offline card balance ledger
+
+balance after every committed debit, indexed by card number in a memory mapped open addressing table, and the
+balance trajectory of every card in an append only history file chained per card
+a tap checks the balance the card reports against the last balance recorded here in one table lookup, a card
+holding a different balance for the same last debit points to a cloned card or a double spend
+only the pages touched are read, millions of cards fit a pi without loading the table
+
+    python brizzi_ledger.py brizzi_ledger 6013500601504245
+'''
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"BZL1"
+# magic, capacity, cards
+HEADER = struct.Struct("<4s4xQQ")
+HEADER_SIZE = 32
+# card key, history offset + 1 of the last record, balance after, akum debet, last debit date yymmdd,
+# unix time, debits, anomalies
+SLOT = struct.Struct("<QQiiIIII")
+# card key, history offset + 1 of the previous record of the card, balance before, balance after, amount, unix time
+RECORD = struct.Struct("<QQiiiI")
+# the writer thread grows the table when this full, a tap only waits for it when the table reaches MAX_LOAD
+GROW_LOAD = 0.5
+MAX_LOAD = 0.7
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+# anomaly reasons
+ANOMALY_STALE_CARD = "stale_card"
+ANOMALY_BALANCE_BELOW = "balance_below_ledger"
+ANOMALY_BALANCE_ABOVE = "balance_above_ledger"
+
+
+def ledger_key(card_number):
+    '''
+    non zero 64 bit key of a card number, the number itself when it is 19 digits or less, which always fit
+    '''
+    if card_number.isdigit() and len(card_number) <= 19:
+        return int(card_number) or 1
+    return int.from_bytes(hashlib.blake2b(card_number.encode(), digest_size=8).digest(), 'little') | 1
+
+
+class LedgerEntry:
+    '''
+    last recorded state of one card
+    '''
+    __slots__ = ('card_key', 'balance', 'akum_debet', 'date', 'ts', 'debits', 'anomalies')
+
+    def __init__(self, card_key, balance, akum_debet, date, ts, debits, anomalies):
+        self.card_key = card_key
+        self.balance = balance
+        self.akum_debet = akum_debet
+        self.date = date
+        self.ts = ts
+        self.debits = debits
+        self.anomalies = anomalies
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class BalanceLedger:
+    '''
+    path.idx is the card table, path.hist the history, both are only ever appended to or updated in place
+    the ledger is advisory, the journal stays the record of the transactions, the table is synced to disk
+    every sync_every debits and on close
+    the sync and the grow of the table run on a writer thread, a debit only updates the mapped table and queues
+    its history record
+    '''
+
+    def __init__(self, path="brizzi_ledger", capacity=1 << 16, sync_every=256, logger=None):
+        self.path = path
+        self._logger = logger
+        self._sync_every = sync_every
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self.anomalies = 0
+        # keys changed while the writer rehashes the table, None when no grow runs
+        self._dirty = None
+        self._grow_error = None
+        self._grown = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._index_path = path + ".idx"
+        if not os.path.exists(self._index_path):
+            self._create_index(self._index_path, max(16, 1 << (capacity - 1).bit_length()))
+        self._open_index()
+        self._history = open(path + ".hist", "a+b")
+        self._history.seek(0, os.SEEK_END)
+        # a record cut short by a crash is dropped, the chains only point before it
+        self._history_size = self._history.tell() - self._history.tell() % RECORD.size
+        self._history.truncate(self._history_size)
+
+        self._thread = threading.Thread(target=self._run, name="ledger", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _create_index(path, capacity):
+        with open(path, "wb") as index_file:
+            index_file.write(HEADER.pack(MAGIC, capacity, 0).ljust(HEADER_SIZE, b"\x00"))
+            # sparse on the file systems of a pi, the blocks are allocated as cards arrive
+            index_file.truncate(HEADER_SIZE + capacity * SLOT.size)
+
+    def _open_index(self):
+        self._index_file = open(self._index_path, "r+b")
+        self._map = mmap.mmap(self._index_file.fileno(), 0)
+        magic, self.capacity, self.cards = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a ledger index".format(self._index_path))
+        self._shift = 64 - self.capacity.bit_length() + 1
+
+    def _close_index(self):
+        self._map.flush()
+        self._map.close()
+        self._index_file.close()
+
+    @staticmethod
+    def _probe(table, capacity, shift, card_key):
+        '''
+        offset of the slot of card_key in table, or of the empty slot where it goes
+        '''
+        mask = capacity - 1
+        index = (card_key * HASH_MULTIPLIER & 0xFFFFFFFFFFFFFFFF) >> shift
+        while True:
+            offset = HEADER_SIZE + index * SLOT.size
+            key = struct.unpack_from("<Q", table, offset)[0]
+            if key == card_key or key == 0:
+                return offset, key
+            index = (index + 1) & mask
+
+    def _find(self, card_key):
+        return self._probe(self._map, self.capacity, self._shift, card_key)
+
+    def _grow(self):
+        # rehashed into a new file next to the old one without the lock, the slots the taps change meanwhile are
+        # copied again under the lock and the new file swapped in
+        grow_path = self._index_path + ".grow"
+        with self._lock:
+            old_map, old_capacity = self._map, self.capacity
+            self._dirty = set()
+        capacity, shift = old_capacity * 2, self._shift - 1
+        try:
+            self._create_index(grow_path, capacity)
+            with open(grow_path, "r+b") as grow_file:
+                table = mmap.mmap(grow_file.fileno(), 0)
+                try:
+                    for index in range(old_capacity):
+                        slot = old_map[HEADER_SIZE + index * SLOT.size:HEADER_SIZE + (index + 1) * SLOT.size]
+                        if slot[:8] != bytes(8):
+                            offset = self._probe(table, capacity, shift, int.from_bytes(slot[:8], 'little'))[0]
+                            table[offset:offset + SLOT.size] = slot
+                    table.flush()
+                    with self._lock:
+                        for card_key in self._dirty:
+                            old_offset = self._find(card_key)[0]
+                            offset = self._probe(table, capacity, shift, card_key)[0]
+                            table[offset:offset + SLOT.size] = old_map[old_offset:old_offset + SLOT.size]
+                        self._dirty = None
+                        HEADER.pack_into(table, 0, MAGIC, capacity, self.cards)
+                        table.flush()
+                        table.close()
+                        old_map.close()
+                        self._index_file.close()
+                        os.replace(grow_path, self._index_path)
+                        self._open_index()
+                        self._grown.notify_all()
+                finally:
+                    table.closed or table.close()
+        finally:
+            self._dirty = None
+        self._logger and self._logger.info("ledger grown to {} slots for {} cards".format(self.capacity, self.cards))
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                return
+            try:
+                if self.cards > self.capacity * GROW_LOAD:
+                    self._grow()
+                    self._grow_error = None
+                if self._unsynced >= self._sync_every:
+                    self._sync_background()
+            except Exception as err:
+                self._logger and self._logger.error("ledger writer failed : {}".format(err))
+                with self._lock:
+                    self._grow_error = err
+                    self._grown.notify_all()
+
+    def lookup(self, card_number):
+        with self._lock:
+            offset, key = self._find(ledger_key(card_number))
+            if not key:
+                return None
+            values = SLOT.unpack_from(self._map, offset)
+        return LedgerEntry(values[0], values[2], values[3], values[4], values[5], values[6], values[7])
+
+    def check(self, card_number, balance, last_date=None, akum_debet=None):
+        '''
+        anomaly reason of the state a card reports against the ledger, None when consistent or unknown
+        last_date is the yymmdd of the last debit on the card, akum_debet its month total
+        a card debited later elsewhere is consistent, a card older than the ledger or with another balance for
+        the same last debit is not, a top up also reports balance_above_ledger
+        '''
+        with self._lock:
+            offset, key = self._find(ledger_key(card_number))
+            if not key:
+                return None
+            values = SLOT.unpack_from(self._map, offset)
+            recorded_balance, recorded_akum, recorded_date = values[2], values[3], values[4]
+            reason = None
+            if last_date is not None and last_date < recorded_date:
+                reason = ANOMALY_STALE_CARD
+            elif last_date is not None and last_date > recorded_date:
+                reason = None
+            elif akum_debet is not None and akum_debet < recorded_akum:
+                reason = ANOMALY_STALE_CARD
+            elif akum_debet is not None and akum_debet > recorded_akum:
+                reason = None
+            elif balance < recorded_balance:
+                reason = ANOMALY_BALANCE_BELOW
+            elif balance > recorded_balance:
+                reason = ANOMALY_BALANCE_ABOVE
+            if reason is not None:
+                struct.pack_into("<I", self._map, offset + SLOT.size - 4, values[7] + 1)
+                self._dirty is not None and self._dirty.add(key)
+                self.anomalies += 1
+        return reason
+
+    def record(self, card_number, balance_before, balance_after, amount, date, akum_debet, ts=None):
+        '''
+        one committed debit, date is the yymmdd written to the card and akum_debet the month total after it
+        '''
+        card_key = ledger_key(card_number)
+        ts = int(ts is None and time.time() or ts)
+        with self._lock:
+            while (self.cards + 1) > self.capacity * MAX_LOAD:
+                # the writer fell behind growing the table, the only case a debit waits for it
+                self._grow_error = None
+                self._wake.set()
+                self._grown.wait(1.0)
+                if self._grow_error is not None:
+                    raise self._grow_error
+            offset, key = self._find(card_key)
+            previous = 0
+            debits = anomalies = 0
+            if key:
+                values = SLOT.unpack_from(self._map, offset)
+                previous, debits, anomalies = values[1], values[6], values[7]
+            else:
+                self.cards += 1
+                HEADER.pack_into(self._map, 0, MAGIC, self.capacity, self.cards)
+
+            self._history.write(RECORD.pack(card_key, previous, balance_before, balance_after, amount, ts))
+            history_offset = self._history_size
+            self._history_size += RECORD.size
+            SLOT.pack_into(self._map, offset, card_key, history_offset + 1, balance_after, akum_debet, date, ts,
+                           debits + 1, anomalies)
+            self._dirty is not None and self._dirty.add(card_key)
+
+            self._unsynced += 1
+            if self._unsynced >= self._sync_every or self.cards > self.capacity * GROW_LOAD:
+                self._wake.set()
+
+    def history(self, card_number, limit=None):
+        '''
+        (unix time, balance before, balance after, amount) of the debits of a card, newest first
+        '''
+        records = []
+        with self._lock:
+            offset, key = self._find(ledger_key(card_number))
+            if not key:
+                return records
+            self._history.flush()
+            next_offset = SLOT.unpack_from(self._map, offset)[1]
+            while next_offset and (limit is None or len(records) < limit):
+                self._history.seek(next_offset - 1)
+                _, next_offset, balance_before, balance_after, amount, ts = RECORD.unpack(
+                    self._history.read(RECORD.size))
+                records.append((ts, balance_before, balance_after, amount))
+            self._history.seek(0, os.SEEK_END)
+        return records
+
+    def _sync(self):
+        self._history.flush()
+        os.fsync(self._history.fileno())
+        self._map.flush()
+        self._unsynced = 0
+
+    def _sync_background(self):
+        # only the buffered history is written under the lock, the writer is the one closing the map apart
+        # from close, which stops it first
+        with self._lock:
+            self._history.flush()
+            self._unsynced = 0
+            table = self._map
+        os.fsync(self._history.fileno())
+        table.flush()
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        with self._lock:
+            self._sync()
+            self._close_index()
+            self._history.close()
+
+    def stats(self):
+        return {
+            'cards': self.cards,
+            'capacity': self.capacity,
+            'load': round(self.cards / self.capacity, 3),
+            'history_records': self._history_size // RECORD.size,
+            'anomalies': self.anomalies
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="show the ledger state and balance trajectory of cards")
+    parser.add_argument("ledger", help="ledger path, without the .idx and .hist extension")
+    parser.add_argument("card_number", nargs="*")
+    parser.add_argument("--limit", type=int, default=20, help="history records shown per card")
+    args = parser.parse_args()
+
+    ledger = BalanceLedger(args.ledger)
+    try:
+        print(ledger.stats())
+        for card_number in args.card_number:
+            entry = ledger.lookup(card_number)
+            print(card_number, entry is not None and entry.to_dict() or "unknown")
+            for ts, balance_before, balance_after, amount in ledger.history(card_number, args.limit):
+                print("  {} {:>10} -> {:>10} ({})".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)),
+                                                       balance_before, balance_after, amount))
+    finally:
+        ledger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+'''
+settlement export
+
+monotonic ref and batch numbers for the sam hash, and streaming export of committed journal transactions into
+fixed width batch files with a crc32 trailer, one transaction in memory at a time
+
+    python brizzi_settlement.py brizzi_journal.sqlite3 settlement/ --upload-dir upload/
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+
+'''
+fixed width records, every line is 150 byte including the newline
+'''
+RECORD_LENGTH = 150
+HEADER_FORMAT = "H{batch:06d}{created:14.14}{mid:16.16}{tid:16.16}"
+# the sam hash as hex takes the rest of the detail record, a longer one is rejected and never cut
+HASH_WIDTH = 38
+DETAIL_FORMAT = ("D{ref_number:012d}{batch_number:06d}{card_number:16.16}{amount:010d}{balance_before:010d}"
+                 "{balance_after:010d}{date:8.8}{time:6.6}{mid:16.16}{tid:16.16}{hash:38.38}")
+TRAILER_FORMAT = "T{batch:06d}{count:08d}{total:014d}{crc:08X}"
+
+
+def write_atomic(path, text):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as temp_file:
+        temp_file.write(text)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
+
+
+class SettlementCounters:
+    '''
+    ref and batch numbers, persisted ahead in blocks so a tap never waits on fsync
+    after a restart the numbers continue from the reserved block and a new batch is opened, they never repeat
+    '''
+
+    def __init__(self, path="settlement_counters.json", ref_block=100, batch_max_count=1000,
+                 batch_max_age=3600.0):
+        self.path = path
+        self._ref_block = ref_block
+        self._batch_max_count = batch_max_count
+        self._batch_max_age = batch_max_age
+        self._lock = threading.Lock()
+
+        state = {'ref_number': 0, 'batch_number': 0}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                state = json.load(state_file)
+        self.ref_number = state['ref_number']
+        self._ref_reserved = self.ref_number
+        self.batch_number = state['batch_number']
+        self._open_batch()
+
+    def _save(self):
+        write_atomic(self.path, json.dumps({'ref_number': self._ref_reserved, 'batch_number': self.batch_number}))
+
+    def _open_batch(self):
+        self.batch_number += 1
+        self.batch_count = 0
+        self.batch_opened = time.time()
+        self._save()
+
+    def allocate(self):
+        '''
+        next (ref_number, batch_number) for a transaction
+        '''
+        with self._lock:
+            if self.batch_count >= self._batch_max_count or time.time() - self.batch_opened >= self._batch_max_age:
+                self._open_batch()
+            self.ref_number += 1
+            self.batch_count += 1
+            if self.ref_number > self._ref_reserved:
+                self._ref_reserved = self.ref_number + self._ref_block
+                self._save()
+            return self.ref_number, self.batch_number
+
+    def release(self, ref_number, batch_number):
+        '''
+        give back a number allocate handed out and no hash was made with, when no later one was handed out yet
+        '''
+        with self._lock:
+            if (ref_number, batch_number) != (self.ref_number, self.batch_number):
+                return False
+            self.ref_number -= 1
+            self.batch_count -= 1
+            return True
+
+
+def iter_committed(connection, after_seq=0):
+    '''
+    (seq, tx_id) of committed transactions in journal order, streamed from the cursor
+    '''
+    return connection.execute("SELECT seq, tx_id FROM journal WHERE event = 'commit' AND seq > ? ORDER BY seq",
+                              (after_seq,))
+
+
+def transaction_record(connection, tx_id):
+    '''
+    merge the journal events of one transaction into the fields of a detail record
+    '''
+    record = {}
+    for event, data in connection.execute("SELECT event, data FROM journal WHERE tx_id = ? ORDER BY seq", (tx_id,)):
+        data and record.update(json.loads(data))
+    return {
+        'ref_number': record.get('ref_number', 0),
+        'batch_number': record.get('batch_number', 0),
+        'card_number': record.get('card_number') or "",
+        'amount': record.get('amount', 0),
+        'balance_before': record.get('balance') or 0,
+        'balance_after': record.get('balance_after') or 0,
+        'date': (record.get('date') or "").replace("-", ""),
+        'time': (record.get('time') or "").replace(":", ""),
+        'mid': record.get('mid') or "",
+        'tid': record.get('tid') or "",
+        'hash': record.get('hash') or ""
+    }
+
+
+def detail_line(record):
+    '''
+    detail record of a transaction, ValueError when its hash does not fit
+    '''
+    if len(record['hash']) > HASH_WIDTH:
+        raise ValueError("hash of {} characters does not fit the {} of a detail record".format(
+            len(record['hash']), HASH_WIDTH))
+    return DETAIL_FORMAT.format(**record).ljust(RECORD_LENGTH - 1) + "\n"
+
+
+class BatchWriter:
+    '''
+    one batch file, written as a .part file and renamed once the trailer is on disk
+    '''
+
+    def __init__(self, directory, batch_number, mid="", tid="", part=0):
+        self.batch_number = batch_number
+        self.part = part
+        self.count = 0
+        self.total = 0
+        self.crc = 0
+        # first journal seq written and monotonic time of the last write
+        self.first_seq = None
+        self.last_write = time.monotonic()
+        # a late transaction of a batch already closed goes into a numbered supplement
+        self.path = os.path.join(directory, part and "batch_{:06d}_{:02d}.txt".format(batch_number, part) or
+                                 "batch_{:06d}.txt".format(batch_number))
+        self._part_path = self.path + ".part"
+        self._file = open(self._part_path, "w", newline="\n")
+        self._file.write(HEADER_FORMAT.format(batch=batch_number, created=time.strftime("%Y%m%d%H%M%S"),
+                                              mid=mid, tid=tid).ljust(RECORD_LENGTH - 1) + "\n")
+
+    def write(self, record):
+        line = detail_line(record)
+        self.crc = zlib.crc32(line.encode("ascii"), self.crc)
+        self.count += 1
+        self.total += record['amount']
+        self._file.write(line)
+
+    def close(self):
+        self._file.write(TRAILER_FORMAT.format(batch=self.batch_number, count=self.count, total=self.total,
+                                               crc=self.crc).ljust(RECORD_LENGTH - 1) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._part_path, self.path)
+        return self.path
+
+    def discard(self):
+        self._file.close()
+        os.remove(self._part_path)
+
+
+def verify_batch_file(path):
+    '''
+    check record length, count, total and crc32 of a batch file, returns the trailer values
+    '''
+    crc = count = total = 0
+    trailer = None
+    with open(path, "rb") as batch_file:
+        for line in batch_file:
+            if len(line) != RECORD_LENGTH:
+                raise ValueError("bad record length {} in {}".format(len(line), path))
+            kind = line[:1]
+            if kind == b"D":
+                crc = zlib.crc32(line, crc)
+                count += 1
+                total += int(line[35:45])
+            elif kind == b"T":
+                trailer = line
+    if trailer is None:
+        raise ValueError("missing trailer in {}".format(path))
+    expected = (int(trailer[7:15]), int(trailer[15:29]), int(trailer[29:37], 16))
+    if expected != (count, total, crc):
+        raise ValueError("trailer mismatch in {} : {} != {}".format(path, expected, (count, total, crc)))
+    return {'count': count, 'total': total, 'crc': "{:08X}".format(crc)}
+
+
+class LocalDirectoryUploader:
+    '''
+    upload stand in, moves finished batch files into a directory
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, path):
+        target = os.path.join(self.directory, os.path.basename(path))
+        shutil.move(path, target)
+        return target
+
+
+class SettlementExporter:
+    '''
+    streams committed transactions from the journal into batch files
+    a batch stays open until the allocator moved past it and no transaction arrived for grace seconds,
+    so taps of other lanes still in flight across a rollover land in the right file
+    the journal cursor only moves past records whose batch file is complete, a crash re-exports open batches
+    '''
+    # closed batches remembered in the cursor file, with their number of parts
+    FINISHED_KEPT = 64
+
+    def __init__(self, journal_path, directory, counters=None, uploader=None, logger=None, grace=30.0):
+        self.journal_path = journal_path
+        self.directory = directory
+        self._counters = counters
+        self._uploader = uploader
+        self._logger = logger
+        self._grace = grace
+        self._state_path = os.path.join(directory, "export.cursor")
+        self._writers = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self.exported = 0
+        self.rejected = 0
+        self.batches = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # a .part file is a batch that was open during a crash, it is exported again from the cursor
+        for name in os.listdir(directory):
+            name.endswith(".part") and os.remove(os.path.join(directory, name))
+        state = {'seq': 0, 'finished': {}}
+        if os.path.exists(self._state_path):
+            with open(self._state_path) as state_file:
+                state = json.load(state_file)
+        self.cursor = state['seq']
+        self._finished = dict((int(batch), parts) for batch, parts in state['finished'].items())
+        self._seq = self.cursor
+
+    def _save_state(self):
+        # keep the cursor before the first record of any batch still open
+        open_seqs = [writer.first_seq - 1 for writer in self._writers.values()]
+        self.cursor = min(open_seqs + [self._seq])
+        finished = dict(sorted(self._finished.items())[-self.FINISHED_KEPT:])
+        write_atomic(self._state_path, json.dumps({'seq': self.cursor, 'finished': finished}))
+
+    def _finish_batch(self, batch_number):
+        writer = self._writers.pop(batch_number)
+        path = writer.close()
+        self._finished[batch_number] = writer.part + 1
+        self._save_state()
+        self.batches += 1
+        self._logger and self._logger.info("settlement batch {} part {} closed : {} transactions".format(
+            batch_number, writer.part, writer.count))
+        if self._uploader is not None:
+            path = self._uploader(path)
+        return path
+
+    def finish_open_batches(self):
+        return [self._finish_batch(batch_number) for batch_number in sorted(self._writers)]
+
+    def export(self):
+        '''
+        export everything committed since the last call, returns the finished batch files
+        '''
+        connection = sqlite3.connect(self.journal_path)
+        try:
+            # a second connection reads the events while the first one streams the commits
+            events = sqlite3.connect(self.journal_path)
+            try:
+                for seq, tx_id in iter_committed(connection, self._seq):
+                    record = transaction_record(events, tx_id)
+                    if len(record['hash']) > HASH_WIDTH:
+                        # left in the journal for the operator, the batch file only carries hashes the host can
+                        # verify
+                        self._logger and self._logger.error("settlement {} rejected : hash of {} characters".format(
+                            tx_id, len(record['hash'])))
+                        self._seq = seq
+                        self.rejected += 1
+                        continue
+                    batch_number = record['batch_number']
+                    writer = self._writers.get(batch_number)
+                    if writer is None:
+                        part = self._finished.get(batch_number, 0)
+                        if part:
+                            self._logger and self._logger.warning(
+                                "settlement batch {} already closed, {} goes to part {}".format(
+                                    batch_number, tx_id, part))
+                        writer = self._writers[batch_number] = BatchWriter(self.directory, batch_number,
+                                                                           record['mid'], record['tid'], part)
+                        writer.first_seq = seq
+                    writer.write(record)
+                    writer.last_write = time.monotonic()
+                    self._seq = seq
+                    self.exported += 1
+            finally:
+                events.close()
+        finally:
+            connection.close()
+
+        finished = []
+        if self._counters is not None:
+            now = time.monotonic()
+            for batch_number, writer in sorted(self._writers.items()):
+                if self._counters.batch_number > batch_number and now - writer.last_write >= self._grace:
+                    finished.append(self._finish_batch(batch_number))
+        return finished
+
+    def start(self, interval=10.0):
+        def export_loop():
+            while not self._stop_event.wait(interval):
+                try:
+                    self.export()
+                except Exception as err:
+                    pass
+                    self._logger and self._logger.error("settlement export failed : {}".format(err))
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=export_loop, name="settlement", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread and self._thread.join()
+        self._thread = None
+        # open batches stay behind the cursor and are exported again on the next run
+        for writer in self._writers.values():
+            writer.discard()
+        self._writers = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export committed journal transactions into batch files")
+    parser.add_argument("journal")
+    parser.add_argument("directory")
+    parser.add_argument("--upload-dir")
+    parser.add_argument("--verify", action="store_true", help="verify the batch files in directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.verify:
+        for name in sorted(os.listdir(args.directory)):
+            if name.startswith("batch_") and name.endswith(".txt"):
+                print(name, verify_batch_file(os.path.join(args.directory, name)))
+        return
+
+    exporter = SettlementExporter(args.journal, args.directory,
+                                  uploader=args.upload_dir and LocalDirectoryUploader(args.upload_dir) or None,
+                                  logger=logging.getLogger("settlement"))
+    for path in exporter.export():
+        print(path)
+    # no allocator to tell, an offline run closes whatever is open
+    for path in exporter.finish_open_batches():
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
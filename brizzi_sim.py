@@ -0,0 +1,735 @@
+'''
+hardware free pc/sc simulator for BrizziProcessor
+
+simulated SAM and Brizzi PICC behind the CardConnection.transmit interface, a RPi.GPIO stub and a load driver
+
+    python brizzi_sim.py --taps 5000 --picc-latency 6 --sam-latency 4 --fault DC:0.01
+'''
+import argparse
+import hashlib
+import importlib.util
+import random
+import sys
+import threading
+import time
+import types
+
+
+def install_gpio_stub():
+    '''
+    register a RPi.GPIO stand in, outputs are kept in GPIO.levels and GPIO.history
+    '''
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = 11
+    gpio.BOARD = 10
+    gpio.OUT = 0
+    gpio.IN = 1
+    gpio.LOW = 0
+    gpio.HIGH = 1
+    gpio.levels = {}
+    gpio.history = []
+
+    def output(pin, value):
+        gpio.levels[pin] = value
+        gpio.history.append((time.monotonic(), pin, value))
+
+    def cleanup(*args):
+        gpio.levels.clear()
+
+    gpio.setwarnings = lambda flag: None
+    gpio.setmode = lambda mode: None
+    gpio.setup = lambda pin, mode, *args, **kwargs: gpio.levels.setdefault(pin, 0)
+    gpio.output = output
+    gpio.cleanup = cleanup
+
+    package = sys.modules.get("RPi") or types.ModuleType("RPi")
+    package.GPIO = gpio
+    sys.modules["RPi"] = package
+    sys.modules["RPi.GPIO"] = gpio
+    return gpio
+
+
+# only looked up, RPi.GPIO itself is imported by brizzi.gpio_backend on first use
+if importlib.util.find_spec("RPi") is None:
+    install_gpio_stub()
+
+
+class SimulatedCardError(Exception):
+    '''
+    raised by transmit for injected transport faults, like CardConnectionException from pyscard
+    '''
+    pass
+
+
+class FaultPlan:
+    '''
+    fault injection rules, each rule is (command prefix hex, probability, response)
+    response is a (data, sw1, sw2) tuple, or None to raise SimulatedCardError
+    '''
+
+    def __init__(self, rules=(), seed=0):
+        self._rules = [(bytes.fromhex(prefix), probability, response) for prefix, probability, response in rules]
+        self._random = random.Random(seed)
+        self.injected = 0
+
+    def check(self, apdu):
+        for prefix, probability, response in self._rules:
+            if apdu[:len(prefix)] == prefix and self._random.random() < probability:
+                self.injected += 1
+                if response is None:
+                    raise SimulatedCardError("injected fault on {}".format(apdu[:len(prefix)].hex().upper()))
+                return response
+        return None
+
+
+class SimulatedConnection:
+    '''
+    common part of the simulated connections, latency is seconds per apdu or a dict of command prefix to seconds
+    '''
+    ATR = []
+
+    def __init__(self, reader="Simulated Reader", latency=0.0, faults=None):
+        self.reader = reader
+        self.latency = latency
+        self.faults = faults
+        self.connected = False
+        self.observers = []
+        self.transmit_count = 0
+        self.control_count = 0
+        self._lock = threading.Lock()
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        self.connected = True
+
+    def reconnect(self, protocol=None, mode=None, disposition=None):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def getATR(self):
+        if not self.connected:
+            raise SimulatedCardError("not connected")
+        return list(self.ATR)
+
+    def getReader(self):
+        return self.reader
+
+    def addObserver(self, observer):
+        self.observers.append(observer)
+
+    def deleteObserver(self, observer):
+        self.observers.remove(observer)
+
+    def _delay(self, apdu):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = next((value for prefix, value in latency.items()
+                            if prefix != 'default' and apdu.hex().upper().startswith(prefix)),
+                           latency.get('default', 0.0))
+        latency and time.sleep(latency)
+
+    def transmit(self, bytes, protocol=None):
+        apdu = bytearray(bytes)
+        with self._lock:
+            self.transmit_count += 1
+            self._delay(apdu)
+            response = self.faults and self.faults.check(apdu)
+            if response:
+                data, sw1, sw2 = response
+                return list(data), sw1, sw2
+            return self.process(apdu)
+
+    def control(self, controlCode, bytes=[]):
+        self.control_count += 1
+        return []
+
+    def process(self, apdu):
+        return [], 0x6D, 0x00
+
+
+class SimulatedSam(SimulatedConnection):
+    '''
+    brizzi sam, select, key authentication and hash with 61xx get response chaining
+    on t1 a command sent with le is answered at once, as the t=1 protocol allows
+    '''
+    ATR = [0x3B, 0x68, 0x00, 0x00, 0x00, 0x73, 0xC8, 0x40, 0x13, 0x00, 0x90, 0x00]
+    SELECT = bytes.fromhex("00A4040C09A00000000000000011")
+
+    def __init__(self, reader="Simulated SAM", latency=0.0, faults=None, seed=0, t1=False):
+        SimulatedConnection.__init__(self, reader, latency, faults)
+        self.t1 = t1
+        self.selected = False
+        self.select_count = 0
+        self.hash_count = 0
+        self._pending = b''
+        self._random = random.Random(seed)
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        SimulatedConnection.connect(self)
+        # a fresh connection resets the sam
+        self.selected = False
+
+    def process(self, apdu):
+        if apdu == self.SELECT:
+            self.selected = True
+            self.select_count += 1
+            return [], 0x90, 0x00
+        if apdu[:4] == b'\x00\xC0\x00\x00':
+            # get response, 6Cxx when the length does not match
+            length = len(apdu) > 4 and apdu[4] or 256
+            if not self._pending:
+                return [], 0x69, 0x85
+            if length != len(self._pending):
+                return [], 0x6C, len(self._pending) & 0xFF
+            data, self._pending = self._pending, b''
+            return list(data), 0x90, 0x00
+        if not self.selected:
+            return [], 0x69, 0x85
+        if apdu[:2] == b'\x80\xB0':
+            # auth key, 8 byte header echo and the 16 byte random key for the card
+            self._pending = bytes(apdu[5:13]) + bytes(self._random.getrandbits(8) for _ in range(16))
+        elif apdu[:2] == b'\x80\xB4':
+            self.hash_count += 1
+            self._pending = hashlib.sha256(bytes(apdu[5:5 + apdu[4]])).digest()[:8]
+        else:
+            return [], 0x6D, 0x00
+        if self.t1 and len(apdu) == 6 + apdu[4]:
+            data, self._pending = self._pending, b''
+            return list(data), 0x90, 0x00
+        return [], 0x61, len(self._pending)
+
+
+class SimulatedBrizziCard(SimulatedConnection):
+    '''
+    brizzi desfire picc as seen through the acr reader
+    native responses of one byte come back with 9000, longer ones have their last two bytes as sw1 sw2
+    '''
+    ATR = [0x3B, 0x81, 0x80, 0x01, 0x80, 0x80]
+
+    # desfire status
+    OK = 0x00
+    NO_CHANGES = 0x0C
+    AUTHENTICATION_ERROR = 0xAE
+    ADDITIONAL_FRAME = 0xAF
+    BOUNDARY_ERROR = 0xBE
+    COMMAND_ABORTED = 0xCA
+    APPLICATION_NOT_FOUND = 0xA0
+    FILE_NOT_FOUND = 0xF0
+    ILLEGAL_COMMAND = 0x1C
+
+    # write burst escape of brizzi.burst_pack
+    BURST_ESCAPE_HEADER = b"\xE0\x00\x00\xB0"
+
+    def __init__(self, card_number="6013500601504245", uid="046B214A541F80", balance=100000, akum_debet=0,
+                 last_date="190716", blocked=False, reader="Simulated PICC", latency=0.0, faults=None, seed=0,
+                 require_auth_for_balance=True, burst=False):
+        SimulatedConnection.__init__(self, reader, latency, faults)
+        # the reader takes the write burst escape, a burst costs the latency of one exchange
+        self.burst = burst
+        self.card_number = bytes.fromhex(card_number)
+        self.uid = bytes.fromhex(uid)
+        self.balance = balance
+        self.akum_debet = akum_debet
+        self.last_date = bytes.fromhex(last_date)
+        self.blocked = blocked
+        self.require_auth_for_balance = require_auth_for_balance
+        self.records = []
+        self.commit_count = 0
+        self.abort_count = 0
+        self._random = random.Random(seed)
+        self._reset_session()
+
+    def _reset_session(self):
+        self.aid = None
+        self.auth = None
+        # frames of a record read still to be fetched with additional frame
+        self._frames = None
+        self._pending_debit = 0
+        self._pending_records = []
+        self._pending_last = None
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        SimulatedConnection.connect(self)
+        self._reset_session()
+
+    def reconnect(self, protocol=None, mode=None, disposition=None):
+        self.connect()
+
+    def _file(self, aid, file_no):
+        if aid == 1 and file_no == 0:
+            return b'\x42\x52\x49' + self.card_number + bytes.fromhex("31129901993036") + bytes(5)
+        if aid == 1 and file_no == 1:
+            return bytes(3) + (self.blocked and b'\x00\x00' or b'\x61\x61') + bytes(27)
+        if aid == 3 and file_no == 3:
+            return self.last_date + self.akum_debet.to_bytes(4, 'big')
+        return None
+
+    @staticmethod
+    def _frame(raw):
+        raw = bytes(raw)
+        if len(raw) == 1:
+            return list(raw), 0x90, 0x00
+        return list(raw[:-2]), raw[-2], raw[-1]
+
+    def control(self, controlCode, bytes=[]):
+        command = bytearray(bytes)
+        if not (self.burst and command[:4] == self.BURST_ESCAPE_HEADER):
+            return SimulatedConnection.control(self, controlCode, bytes)
+
+        response = []
+        with self._lock:
+            self.control_count += 1
+            offset = 5
+            for index in range(command[4]):
+                apdu = command[offset + 1:offset + 1 + command[offset]]
+                offset += 1 + command[offset]
+                index or self._delay(apdu)
+                answer = self.faults and self.faults.check(apdu)
+                data, sw1, sw2 = answer and (list(answer[0]), answer[1], answer[2]) or self.process(apdu)
+                response += [len(data) + 2] + data + [sw1, sw2]
+                if not (data and data[0] == self.OK and sw1 == 0x90 and sw2 == 0x00):
+                    break
+        return response
+
+    def process(self, apdu):
+        if apdu[:2] == b'\xFF\xCA':
+            # handled by the reader, does not touch the card session
+            return list(self.uid), 0x90, 0x00
+        return self._frame(self.process_native(apdu))
+
+    def _next_frame(self):
+        frame = self._frames.pop(0)
+        status = self._frames and self.ADDITIONAL_FRAME or self.OK
+        self._frames = self._frames or None
+        return [status] + list(frame)
+
+    def process_native(self, apdu):
+        ins = apdu[0]
+        if ins == 0xAF and self._frames:
+            return self._next_frame()
+        self._frames = None
+        if ins != 0xAF and self.auth == 'pending':
+            # any other command aborts a started authentication
+            self.auth = None
+            return [self.COMMAND_ABORTED]
+
+        if ins == 0x5A:
+            aid = int.from_bytes(apdu[1:4], 'little')
+            if aid not in (1, 3):
+                return [self.APPLICATION_NOT_FOUND]
+            self.aid = aid
+            self.auth = None
+            return [self.OK]
+        if ins == 0xBD:
+            data = self._file(self.aid, apdu[1])
+            if data is None:
+                return [self.FILE_NOT_FOUND]
+            if self.aid == 3 and self.auth != 'done':
+                return [self.AUTHENTICATION_ERROR]
+            offset = int.from_bytes(apdu[2:5], 'little')
+            length = int.from_bytes(apdu[5:8], 'little') or len(data) - offset
+            return [self.OK] + list(data[offset:offset + length])
+        if ins == 0x0A:
+            if self.aid != 3:
+                return [self.AUTHENTICATION_ERROR]
+            self.auth = 'pending'
+            return [self.ADDITIONAL_FRAME] + [self._random.getrandbits(8) for _ in range(8)]
+        if ins == 0xAF:
+            if self.auth != 'pending' or len(apdu) != 17:
+                self.auth = None
+                return [self.AUTHENTICATION_ERROR]
+            self.auth = 'done'
+            return [self.OK] + [self._random.getrandbits(8) for _ in range(8)]
+        if ins == 0x6C:
+            if self.aid != 3 or (self.require_auth_for_balance and self.auth != 'done'):
+                return [self.AUTHENTICATION_ERROR]
+            return [self.OK] + list((self.balance - self._pending_debit).to_bytes(4, 'little'))
+
+        # value and record changes need authentication and wait for commit
+        if self.aid != 3 or self.auth != 'done':
+            return ins in (0xDC, 0x3B, 0x3D, 0xC7, 0xA7, 0xBB) and [self.AUTHENTICATION_ERROR] or \
+                [self.ILLEGAL_COMMAND]
+        if ins == 0xBB:
+            # log records newest first, offset and count in records, count 0 for all, 59 bytes per frame
+            if apdu[1] != 1:
+                return [self.FILE_NOT_FOUND]
+            offset = int.from_bytes(apdu[2:5], 'little')
+            count = int.from_bytes(apdu[5:8], 'little') or len(self.records) - offset
+            if count <= 0 or offset + count > len(self.records):
+                return [self.BOUNDARY_ERROR]
+            raw = b"".join(self.records[offset:offset + count])
+            self._frames = [raw[index:index + 59] for index in range(0, len(raw), 59)]
+            return self._next_frame()
+        if ins == 0xDC:
+            value = int.from_bytes(apdu[2:6], 'little')
+            if value > self.balance - self._pending_debit:
+                return [self.BOUNDARY_ERROR]
+            self._pending_debit += value
+            return [self.OK]
+        if ins == 0x3B:
+            self._pending_records.append(bytes(apdu[8:]))
+            return [self.OK]
+        if ins == 0x3D:
+            self._pending_last = bytes(apdu[8:15])
+            return [self.OK]
+        if ins == 0xC7:
+            if not (self._pending_debit or self._pending_records or self._pending_last):
+                return [self.NO_CHANGES]
+            self.balance -= self._pending_debit
+            self.records = (self._pending_records[::-1] + self.records)[:10]
+            if self._pending_last:
+                self.last_date = self._pending_last[:3]
+                self.akum_debet = int.from_bytes(self._pending_last[3:], 'big')
+            self.commit_count += 1
+            self._pending_debit, self._pending_records, self._pending_last = 0, [], None
+            return [self.OK]
+        if ins == 0xA7:
+            self.abort_count += 1
+            self._pending_debit, self._pending_records, self._pending_last = 0, [], None
+            return [self.OK]
+        return [self.ILLEGAL_COMMAND]
+
+
+class SimulatedCard:
+    '''
+    stand in for smartcard.Card.Card as delivered to CardObserver.update
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.reader = connection.reader
+        self.atr = list(connection.ATR)
+
+    def createConnection(self):
+        return self.connection
+
+
+class SimulatedReader:
+    '''
+    picc reader whose connections reach whichever card is in the field, like a pc/sc reader handle
+    context_latency is paid by every new connection, connect_latency by every connect and reconnect
+    replug invalidates the connections made so far, as unplugging the reader does
+    '''
+
+    def __init__(self, name="Simulated Reader", connect_latency=0.0, context_latency=0.0):
+        self.name = name
+        self.connect_latency = connect_latency
+        self.context_latency = context_latency
+        self.card = None
+        self.generation = 0
+        self.contexts = 0
+        self.connects = 0
+
+    def present(self, card):
+        '''
+        put card in the field, returns the card event a CardObserver would get
+        '''
+        self.card = card
+        return SimulatedReaderCard(self)
+
+    def replug(self):
+        self.generation += 1
+
+    def remove(self):
+        self.card = None
+
+    def createConnection(self):
+        return SimulatedReaderConnection(self)
+
+    def __str__(self):
+        return self.name
+
+
+class SimulatedSamReader:
+    '''
+    reader holding a sam, as listed by smartcard.System.readers, connect_latency is paid by the first connect
+    '''
+
+    def __init__(self, sam, connect_latency=0.0):
+        self.sam = sam
+        self.connect_latency = connect_latency
+
+    def createConnection(self):
+        self.connect_latency and time.sleep(self.connect_latency)
+        return self.sam
+
+    def __str__(self):
+        return self.sam.reader
+
+
+class SimulatedPcsc:
+    '''
+    the SCard functions brizzi.PresenceMonitor waits on, over SimulatedReader objects
+    insert and remove change the card in the field of a reader and wake up the waits on it
+    '''
+    SCARD_S_SUCCESS = 0
+    SCARD_E_CANCELLED = 0x80100002
+    SCARD_E_UNKNOWN_READER = 0x80100009
+    SCARD_E_TIMEOUT = 0x8010000A
+    SCARD_SCOPE_USER = 0
+    SCARD_STATE_UNAWARE = 0x0
+    SCARD_STATE_CHANGED = 0x2
+    SCARD_STATE_EMPTY = 0x10
+    SCARD_STATE_PRESENT = 0x20
+
+    def __init__(self, readers=()):
+        self.readers = dict((reader.name, reader) for reader in readers)
+        self._cond = threading.Condition()
+        self._cancelled = set()
+        self._next_context = 0
+        self.waits = 0
+
+    def insert(self, reader_name, card):
+        with self._cond:
+            event = self.readers[reader_name].present(card)
+            self._cond.notify_all()
+        return event
+
+    def remove(self, reader_name):
+        with self._cond:
+            self.readers[reader_name].remove()
+            self._cond.notify_all()
+
+    def SCardEstablishContext(self, scope):
+        with self._cond:
+            self._next_context += 1
+            return self.SCARD_S_SUCCESS, self._next_context
+
+    def SCardReleaseContext(self, context):
+        with self._cond:
+            self._cancelled.discard(context)
+        return self.SCARD_S_SUCCESS
+
+    def SCardCancel(self, context):
+        with self._cond:
+            self._cancelled.add(context)
+            self._cond.notify_all()
+        return self.SCARD_S_SUCCESS
+
+    def SCardGetErrorMessage(self, hresult):
+        return "simulated pc/sc error 0x{:08X}".format(hresult)
+
+    def SCardGetStatusChange(self, context, timeout, reader_states):
+        '''
+        waits up to timeout milliseconds for the first reader to differ from its current state
+        '''
+        reader_name, current = reader_states[0][:2]
+        deadline = time.monotonic() + timeout / 1000.0
+        with self._cond:
+            self.waits += 1
+            while True:
+                if context in self._cancelled:
+                    self._cancelled.discard(context)
+                    return self.SCARD_E_CANCELLED, []
+                reader = self.readers.get(reader_name)
+                if reader is None:
+                    return self.SCARD_E_UNKNOWN_READER, []
+                state = reader.card is None and self.SCARD_STATE_EMPTY or self.SCARD_STATE_PRESENT
+                if state != current & ~self.SCARD_STATE_CHANGED:
+                    atr = reader.card is not None and list(reader.card.ATR) or []
+                    return self.SCARD_S_SUCCESS, [(reader_name, state | self.SCARD_STATE_CHANGED, atr)]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self.SCARD_E_TIMEOUT, []
+                self._cond.wait(remaining)
+
+
+class SimulatedReaderConnection:
+    '''
+    connection of a SimulatedReader, transmit goes to the card in the field
+    '''
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.generation = reader.generation
+        self.connected = False
+        reader.contexts += 1
+        reader.context_latency and time.sleep(reader.context_latency)
+
+    def _card(self):
+        if self.generation != self.reader.generation:
+            raise SimulatedCardError("reader unavailable")
+        if self.reader.card is None:
+            raise SimulatedCardError("no card")
+        return self.reader.card
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        card = self._card()
+        self.reader.connects += 1
+        self.reader.connect_latency and time.sleep(self.reader.connect_latency)
+        card.connect(protocol)
+        self.connected = True
+
+    def reconnect(self, protocol=None, mode=None, disposition=None):
+        self.connect(protocol)
+
+    def disconnect(self):
+        self.connected = False
+
+    def getATR(self):
+        return self._card().getATR()
+
+    def getReader(self):
+        return self.reader.name
+
+    def addObserver(self, observer):
+        pass
+
+    def deleteObserver(self, observer):
+        pass
+
+    def transmit(self, bytes, protocol=None):
+        if not self.connected:
+            raise SimulatedCardError("not connected")
+        return self._card().transmit(bytes, protocol)
+
+    def control(self, controlCode, bytes=[]):
+        return self._card().control(controlCode, bytes)
+
+
+class SimulatedReaderCard:
+    '''
+    stand in for smartcard.Card.Card on a SimulatedReader, every createConnection is a new context
+    '''
+
+    def __init__(self, reader):
+        self.reader = reader.name
+        self.atr = list(reader.card.ATR)
+        self._reader = reader
+
+    def createConnection(self):
+        return SimulatedReaderConnection(self._reader)
+
+
+def make_card_population(count, seed=0, balance=100000):
+    generator = random.Random(seed)
+    return [SimulatedBrizziCard(card_number="601350%010d" % generator.randrange(10 ** 10),
+                                uid="04" + "".join("%02X" % generator.getrandbits(8) for _ in range(6)),
+                                balance=balance, seed=generator.getrandbits(32))
+            for _ in range(count)]
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_load(taps=1000, cards=100, amount=1, sam_latency=0.0, picc_latency=0.0, faults=(), seed=0,
+             pipelined=True, logger=None, write_burst=None, sam_t1=False, reuse_connections=False,
+             connect_latency=0.0, context_latency=0.0):
+    '''
+    replay taps against simulated cards, return throughput, latency percentiles in ms and picc exchanges per tap
+    write_burst is None, "transmit" or "escape" as in brizzi.LaneConfig, sam_t1 answers sam commands sent with le at once
+    the cards are presented on one SimulatedReader, reuse_connections keeps its connection in a
+    brizzi.ReaderConnectionManager instead of a new connection per tap
+    '''
+    import brizzi
+
+    generator = random.Random(seed)
+    population = make_card_population(cards, seed)
+    fault_plan = FaultPlan(faults, seed)
+    for card in population:
+        card.latency = picc_latency
+        card.faults = fault_plan
+        card.burst = write_burst == "escape"
+    options = brizzi.LaneConfig("load", "", write_burst=write_burst).processor_options()
+
+    sam_pool = brizzi.SamSessionPool(logger)
+    sam_pool.add_connection(SimulatedSam(latency=sam_latency, faults=fault_plan, seed=seed, t1=sam_t1),
+                            "Simulated SAM")
+
+    reader = SimulatedReader(connect_latency=connect_latency, context_latency=context_latency)
+    connections = reuse_connections and brizzi.ReaderConnectionManager(logger, metrics=False) or None
+
+    # failed taps dump their apdu trace to logger, nothing without one
+    trace = brizzi.ApduTrace(logger)
+    processors = brizzi.ReaderProcessors(logger=logger, sam_pool=sam_pool, pipelined=pipelined,
+                                         write_burst=options['write_burst'],
+                                         burst_control_code=options['burst_control_code'],
+                                         sam_le=0x00 if sam_t1 else None, trace=trace)
+    latencies = []
+    connect_ms = []
+    succeeded = 0
+    failed_steps = {}
+    failure_reasons = {}
+    started = time.perf_counter()
+    for _ in range(taps):
+        event = reader.present(generator.choice(population))
+        tap_start = time.perf_counter()
+        picc_connection, picc_setup = connections and connections.acquire(event) or (event.createConnection(), None)
+        with processors.tap(str(event.reader), picc_connection, picc_setup) as processor:
+            result = processor.transaction_debet_card(amount)
+        connections and connections.release(picc_connection, result)
+        latencies.append((time.perf_counter() - tap_start) * 1000)
+        connect_ms.append(result['connect_ms'])
+        if result['status']:
+            succeeded += 1
+        else:
+            failed_steps[result.get('failed_step')] = failed_steps.get(result.get('failed_step'), 0) + 1
+            failure_reasons[result.get('failure_reason')] = failure_reasons.get(result.get('failure_reason'), 0) + 1
+    elapsed = time.perf_counter() - started
+    processors.close()
+    sam_pool.close()
+    connections and connections.close()
+    exchanges = sum(card.transmit_count + card.control_count for card in population)
+
+    latencies.sort()
+    connect_ms.sort()
+    return {
+        'taps': taps,
+        'succeeded': succeeded,
+        'failed': taps - succeeded,
+        'failed_steps': failed_steps,
+        'failure_reasons': failure_reasons,
+        'faults_injected': fault_plan.injected,
+        'elapsed_s': round(elapsed, 3),
+        'taps_per_s': round(taps / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies and latencies[-1] or 0.0, 3),
+        'picc_per_tap': round(exchanges / taps, 2),
+        'connect_p50_ms': round(percentile(connect_ms, 50), 3),
+        'contexts': reader.contexts
+    }
+
+
+def parse_fault(text):
+    # PREFIX:PROBABILITY[:SW1SW2], without sw the fault is a transport error
+    parts = text.split(":")
+    response = None
+    if len(parts) > 2:
+        response = ([], int(parts[2][:2], 16), int(parts[2][2:4], 16))
+    return parts[0], float(parts[1]), response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BrizziProcessor load test against simulated cards")
+    parser.add_argument("--taps", type=int, default=1000)
+    parser.add_argument("--cards", type=int, default=100)
+    parser.add_argument("--amount", type=int, default=1)
+    parser.add_argument("--sam-latency", type=float, default=0.0, help="ms per sam apdu")
+    parser.add_argument("--picc-latency", type=float, default=0.0, help="ms per picc apdu")
+    parser.add_argument("--fault", action="append", default=[], help="PREFIX:PROBABILITY[:SW1SW2]")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sequential", action="store_true", help="disable the pipelined engine")
+    parser.add_argument("--write-burst", choices=("transmit", "escape"), help="fold the card writes into one step")
+    parser.add_argument("--sam-t1", action="store_true", help="t=1 sam, its commands are sent with le")
+    parser.add_argument("--reuse-connections", action="store_true", help="keep the picc reader connection across taps")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="ms per picc connect or reconnect")
+    parser.add_argument("--context-latency", type=float, default=0.0, help="ms per new picc connection")
+    args = parser.parse_args()
+
+    report = run_load(args.taps, args.cards, args.amount, args.sam_latency / 1000, args.picc_latency / 1000,
+                      [parse_fault(fault) for fault in args.fault], args.seed, not args.sequential,
+                      write_burst=args.write_burst, sam_t1=args.sam_t1, reuse_connections=args.reuse_connections,
+                      connect_latency=args.connect_latency / 1000, context_latency=args.context_latency / 1000)
+    for key, value in report.items():
+        print("{:<16} {}".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
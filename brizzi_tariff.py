@@ -0,0 +1,202 @@
+'''
+tariff engine
+
+fare rules by weekday, time of day and lane from a json file, compiled into one table per lane holding the fare
+of every minute of the week, a tap only indexes its table and applies the monthly cap of the card
+the file is reloaded when it changes, a replay charges the committed taps of a journal with a new tariff
+
+    {"fare": 3500, "monthly_cap": 150000,
+     "rules": [{"name": "peak", "lanes": ["lane-1"], "days": [0, 1, 2, 3, 4], "start": "06:00", "end": "09:00",
+                "fare": 5000},
+               {"name": "night", "start": "22:00", "end": "05:00", "fare": 2000}]}
+
+    python brizzi_tariff.py tariff.json --replay brizzi_journal.sqlite3
+'''
+import argparse
+import array
+import json
+import os
+import sqlite3
+import threading
+import time
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def parse_minute(text):
+    hour, minute = text.split(":")
+    return int(hour) * 60 + int(minute)
+
+
+def minute_of_week(when):
+    return when.tm_wday * MINUTES_PER_DAY + when.tm_hour * 60 + when.tm_min
+
+
+class CompiledTariff:
+    '''
+    fare and rule of every minute of the week per lane, lanes no rule names share the table of None
+    the first rule matching a minute decides its fare, days are 0 for monday to 6, a rule ending before its start
+    runs past midnight into the next day
+    '''
+
+    def __init__(self, config):
+        self.fare_default = config.get('fare', 1)
+        self.monthly_cap = config.get('monthly_cap')
+        self.rules = config.get('rules', [])
+        self.rule_names = [rule.get('name') or "rule-{}".format(index) for index, rule in enumerate(self.rules)]
+        lanes = sorted(set(lane for rule in self.rules for lane in rule.get('lanes', ())))
+        self.tables = dict((lane, self._compile(lane)) for lane in [None] + lanes)
+
+    def _compile(self, lane):
+        fares = array.array('i', [self.fare_default]) * MINUTES_PER_WEEK
+        rules = array.array('h', [-1]) * MINUTES_PER_WEEK
+        # written last to first, so the first matching rule is the one left in a bucket
+        for index in reversed(range(len(self.rules))):
+            rule = self.rules[index]
+            if 'lanes' in rule and lane not in rule['lanes']:
+                continue
+            start = parse_minute(rule.get('start', "00:00"))
+            end = parse_minute(rule.get('end', "24:00"))
+            spans = [(start, end)]
+            if end <= start:
+                spans = [(start, MINUTES_PER_DAY), (MINUTES_PER_DAY, MINUTES_PER_DAY + end)]
+            for day in rule.get('days', range(7)):
+                for span_start, span_end in spans:
+                    for first, last in self._week_spans(day * MINUTES_PER_DAY + span_start,
+                                                        day * MINUTES_PER_DAY + span_end):
+                        fares[first:last] = array.array('i', [rule['fare']]) * (last - first)
+                        rules[first:last] = array.array('h', [index]) * (last - first)
+        return fares, rules
+
+    @staticmethod
+    def _week_spans(first, last):
+        # sunday night runs over into monday morning
+        if last <= MINUTES_PER_WEEK:
+            return [(first, last)]
+        return [(first, MINUTES_PER_WEEK), (0, last - MINUTES_PER_WEEK)]
+
+    def fare(self, lane, minute, month_total=0):
+        '''
+        (fare, rule name) of a tap on lane at minute of the week, month_total is what the card paid this month
+        '''
+        fares, rules = self.tables.get(lane) or self.tables[None]
+        fare = fares[minute]
+        rule = rules[minute]
+        if self.monthly_cap is not None and month_total + fare > self.monthly_cap:
+            return max(0, self.monthly_cap - month_total), "monthly_cap"
+        return fare, rule >= 0 and self.rule_names[rule] or None
+
+
+def load_tariff(path):
+    with open(path) as tariff_file:
+        return CompiledTariff(json.load(tariff_file))
+
+
+class TariffEngine:
+    '''
+    compiled tariff of a json file, reloaded when its mtime changed, checked at most every check_interval seconds
+    a file that does not load keeps the tariff in use
+    '''
+
+    def __init__(self, path, check_interval=5.0, logger=None):
+        self.path = path
+        self._check_interval = check_interval
+        self._logger = logger
+        self._tariff = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.reload()
+        if self._tariff is None:
+            raise ValueError("tariff {} not loaded".format(path))
+
+    def fare(self, lane=None, when=None, month_total=0):
+        '''
+        (fare, rule name) of a tap on lane at the struct_time when, local time now by default
+        '''
+        now = time.monotonic()
+        if now - self._checked >= self._check_interval:
+            self._checked = now
+            self.reload()
+        return self._tariff.fare(lane, minute_of_week(when or time.localtime()), month_total)
+
+    def reload(self, force=False):
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime and not force:
+                    return False
+                tariff = load_tariff(self.path)
+                # swapped whole, a tap never sees a half compiled tariff
+                self._tariff = tariff
+                self._mtime = mtime
+                self.reloads += 1
+                self._logger and self._logger.info("Tariff loaded, {} rules over {} lane tables".format(
+                    len(tariff.rules), len(tariff.tables)))
+                return True
+            except Exception as err:
+                pass
+                self._logger and self._logger.error("Tariff {} not loaded : {}".format(self.path, err))
+                return False
+
+
+def replay(tariff, journal_path):
+    '''
+    charge the committed taps of a journal with tariff, the month totals are the ones the new fares add up to
+    '''
+    connection = sqlite3.connect(journal_path)
+    transactions = {}
+    try:
+        for tx_id, ts, event, data in connection.execute("SELECT tx_id, ts, event, data FROM journal ORDER BY seq"):
+            transaction = transactions.setdefault(tx_id, {'ts': ts})
+            data = data and json.loads(data) or {}
+            if event == "debit":
+                transaction['card_number'] = data.get('card_number')
+                transaction['amount'] = data.get('amount', 0)
+            elif event == "commit":
+                transaction['committed'] = True
+            elif event == "actuator":
+                transaction['lane'] = data.get('lane')
+    finally:
+        connection.close()
+
+    month_totals = {}
+    report = {'taps': 0, 'charged': 0, 'replayed': 0, 'capped': 0, 'by_rule': {}}
+    for transaction in transactions.values():
+        if not transaction.get('committed'):
+            continue
+        when = time.localtime(transaction['ts'])
+        month = (transaction.get('card_number'), when.tm_year, when.tm_mon)
+        fare, rule = tariff.fare(transaction.get('lane'), minute_of_week(when), month_totals.get(month, 0))
+        month_totals[month] = month_totals.get(month, 0) + fare
+        report['taps'] += 1
+        report['charged'] += transaction.get('amount', 0)
+        report['replayed'] += fare
+        report['capped'] += rule == "monthly_cap"
+        by_rule = report['by_rule'].setdefault(rule or "default", {'taps': 0, 'amount': 0})
+        by_rule['taps'] += 1
+        by_rule['amount'] += fare
+    report['difference'] = report['replayed'] - report['charged']
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check a tariff file, or replay a journal against it")
+    parser.add_argument("tariff")
+    parser.add_argument("--replay", help="journal whose committed taps are charged again with the tariff")
+    parser.add_argument("--lane", help="lane of the fare shown without --replay")
+    args = parser.parse_args()
+
+    tariff = load_tariff(args.tariff)
+    if args.replay:
+        print(json.dumps(replay(tariff, args.replay), indent=2))
+        return
+    now = time.localtime()
+    print("lanes", [lane for lane in tariff.tables if lane is not None])
+    print("fare now", tariff.fare(args.lane, minute_of_week(now)))
+
+
+if __name__ == '__main__':
+    main()
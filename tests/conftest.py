@@ -0,0 +1,42 @@
+'''
+the tests import the modules from the repo root, the cards and the sam are the ones of brizzi_sim
+'''
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import brizzi
+import brizzi_sim
+
+
+@pytest.fixture(autouse=True)
+def quiet_logger():
+    level = brizzi.LOGGER_MAIN.level
+    brizzi.LOGGER_MAIN.setLevel(logging.CRITICAL)
+    yield
+    brizzi.LOGGER_MAIN.setLevel(level)
+
+
+@pytest.fixture
+def sam_pool():
+    pool = brizzi.SamSessionPool()
+    pool.add_connection(brizzi_sim.SimulatedSam(), "S")
+    return pool
+
+
+@pytest.fixture
+def tap(sam_pool):
+    '''
+    one debit of amount on card, keyword arguments go to the BrizziProcessor
+    '''
+    def run(card, amount=1, **kwargs):
+        kwargs.setdefault('sam_pool', sam_pool)
+        with brizzi.BrizziProcessor(picc_connection=card, debug_mode=False, picc_setup=0.0,
+                                    **kwargs) as processor:
+            return processor.transaction_debet_card(amount)
+
+    return run
@@ -0,0 +1,91 @@
+import sqlite3
+
+import brizzi_journal
+import brizzi_sim
+from brizzi_journal import (EVENT_ABORT, EVENT_ACTUATOR, EVENT_COMMIT, EVENT_COMMIT_FAILED, EVENT_DEBIT, EVENT_HASH,
+                            RECOVERY_ACTUATOR_UNKNOWN, RECOVERY_COMMIT_UNCONFIRMED, RECOVERY_DEBIT_IN_FLIGHT)
+
+
+def journal_with(path, *transactions):
+    journal = brizzi_journal.TransactionJournal(path)
+    tx_ids = []
+    for events in transactions:
+        tx_id = journal.begin({'amount': 1})
+        for event in events:
+            journal.record(tx_id, event, {})
+        tx_ids.append(tx_id)
+    journal.flush()
+    return journal, tx_ids
+
+
+def test_recover(tmp_path):
+    journal, (debit, failed, unknown, complete, aborted, intent) = journal_with(
+        str(tmp_path / "journal.sqlite3"),
+        [EVENT_DEBIT],
+        [EVENT_DEBIT, EVENT_HASH, EVENT_COMMIT_FAILED],
+        [EVENT_DEBIT, EVENT_HASH, EVENT_COMMIT],
+        [EVENT_DEBIT, EVENT_HASH, EVENT_COMMIT, EVENT_ACTUATOR],
+        [EVENT_DEBIT, EVENT_ABORT],
+        [])
+    try:
+        flagged = dict((tx_id, (reason, last_event)) for tx_id, reason, last_event in journal.recover())
+        assert flagged == {
+            debit: (RECOVERY_DEBIT_IN_FLIGHT, EVENT_DEBIT),
+            failed: (RECOVERY_COMMIT_UNCONFIRMED, EVENT_COMMIT_FAILED),
+            unknown: (RECOVERY_ACTUATOR_UNKNOWN, EVENT_COMMIT),
+        }
+        # flagged once, a second recovery only sees what happened since
+        assert journal.recover() == []
+        assert sorted(row[0] for row in journal.pending_settlement()) == sorted(flagged)
+        journal.mark_settled(debit)
+        assert debit not in [row[0] for row in journal.pending_settlement()]
+    finally:
+        journal.close()
+
+
+def test_recover_after_reopen(tmp_path):
+    path = str(tmp_path / "journal.sqlite3")
+    journal, (debit,) = journal_with(path, [EVENT_DEBIT])
+    journal.close()
+
+    journal = brizzi_journal.TransactionJournal(path)
+    try:
+        assert journal.recover() == [(debit, RECOVERY_DEBIT_IN_FLIGHT, EVENT_DEBIT)]
+    finally:
+        journal.close()
+
+
+def test_durable_record(tmp_path):
+    # a durable event is on disk when record returns, not a group window later
+    path = str(tmp_path / "journal.sqlite3")
+    journal = brizzi_journal.TransactionJournal(path, group_window=60.0)
+    try:
+        tx_id = journal.begin()
+        journal.record(tx_id, EVENT_DEBIT, {'card_number': "6013500601504245"}, durable=True)
+        connection = sqlite3.connect(path)
+        try:
+            assert connection.execute("SELECT event FROM journal WHERE tx_id = ? ORDER BY seq DESC",
+                                      (tx_id,)).fetchone() == (EVENT_DEBIT,)
+        finally:
+            connection.close()
+    finally:
+        journal.close()
+
+
+def test_processor_debit_journal(tmp_path, tap):
+    journal = brizzi_journal.TransactionJournal(str(tmp_path / "journal.sqlite3"))
+    try:
+        card = brizzi_sim.SimulatedBrizziCard()
+        result = tap(card, 100, journal=journal)
+        failed = tap(brizzi_sim.SimulatedBrizziCard(faults=brizzi_sim.FaultPlan([("C7", 1.0, None)])), 100,
+                     journal=journal)
+        assert result['status'] and not failed['status']
+        journal.flush()
+        events = [event for _, event, _ in journal.events(result['tx_id'])]
+        assert events.index(EVENT_DEBIT) < events.index(EVENT_HASH) < events.index(EVENT_COMMIT)
+        # the gate never reported an outcome for the first tap, the second may hold a committed debit
+        flagged = dict((tx_id, reason) for tx_id, reason, _ in journal.recover())
+        assert flagged == {result['tx_id']: RECOVERY_ACTUATOR_UNKNOWN,
+                           failed['tx_id']: RECOVERY_COMMIT_UNCONFIRMED}
+    finally:
+        journal.close()
@@ -0,0 +1,94 @@
+import threading
+
+import brizzi_ledger
+from brizzi_ledger import ANOMALY_BALANCE_BELOW, ANOMALY_STALE_CARD, BalanceLedger
+
+
+def card_number(index):
+    return "{:016d}".format(6013500600000000 + index * 7919)
+
+
+def test_ledger_key():
+    assert brizzi_ledger.ledger_key("6013500601504245") == 6013500601504245
+    assert brizzi_ledger.ledger_key("9" * 19) == int("9" * 19)
+    assert brizzi_ledger.ledger_key("6013500601504245") != brizzi_ledger.ledger_key("6013500601504246")
+
+
+def test_record_and_check(tmp_path):
+    ledger = BalanceLedger(str(tmp_path / "ledger"))
+    try:
+        number = card_number(1)
+        assert ledger.lookup(number) is None and ledger.check(number, 100000) is None
+        ledger.record(number, 100000, 96500, 3500, 240131, 3500, ts=1000)
+        ledger.record(number, 96500, 93000, 3500, 240131, 7000, ts=1001)
+        entry = ledger.lookup(number)
+        assert (entry.balance, entry.akum_debet, entry.date, entry.debits) == (93000, 7000, 240131, 2)
+        assert ledger.history(number) == [(1001, 96500, 93000, 3500), (1000, 100000, 96500, 3500)]
+        assert ledger.history(number, limit=1) == [(1001, 96500, 93000, 3500)]
+
+        assert ledger.check(number, 93000, 240131, 7000) is None
+        # debited later on another gate
+        assert ledger.check(number, 89500, 240201, 3500) is None
+        assert ledger.check(number, 96500, 240130, 3500) == ANOMALY_STALE_CARD
+        assert ledger.check(number, 90000, 240131, 7000) == ANOMALY_BALANCE_BELOW
+        assert ledger.lookup(number).anomalies == 2 and ledger.anomalies == 2
+    finally:
+        ledger.close()
+
+
+def test_grow(tmp_path):
+    path = str(tmp_path / "ledger")
+    ledger = BalanceLedger(path, capacity=16)
+    count = 1000
+    try:
+        for index in range(count):
+            ledger.record(card_number(index), 100000, 100000 - index, index, 240131, index, ts=index)
+        # a second debit of every card after the table grew
+        for index in range(count):
+            ledger.record(card_number(index), 100000 - index, 99000 - index, 1000, 240131, index + 1000, ts=index)
+        stats = ledger.stats()
+        assert stats['cards'] == count and stats['history_records'] == 2 * count
+        assert stats['capacity'] >= count / brizzi_ledger.MAX_LOAD
+        for index in range(count):
+            entry = ledger.lookup(card_number(index))
+            assert (entry.balance, entry.akum_debet, entry.debits) == (99000 - index, index + 1000, 2)
+            assert [amount for _, _, _, amount in ledger.history(card_number(index))] == [1000, index]
+    finally:
+        ledger.close()
+
+    # the grown table and the history are there after a reopen
+    ledger = BalanceLedger(path, capacity=16)
+    try:
+        assert ledger.stats()['cards'] == count
+        assert ledger.lookup(card_number(count - 1)).balance == 99000 - (count - 1)
+        assert len(ledger.history(card_number(0))) == 2
+    finally:
+        ledger.close()
+
+
+def test_grow_concurrent(tmp_path):
+    # debits and checks of other threads while the writer rehashes the table, none is lost
+    ledger = BalanceLedger(str(tmp_path / "ledger"), capacity=16)
+    threads_count, per_thread = 4, 300
+    errors = []
+
+    def debit(thread):
+        try:
+            for index in range(thread, threads_count * per_thread, threads_count):
+                ledger.record(card_number(index), 100000, 100000 - index, index, 240131, index)
+                ledger.check(card_number(index), 100000 - index, 240131, index)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=debit, args=(thread,)) for thread in range(threads_count)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert ledger.stats()['cards'] == threads_count * per_thread and ledger.anomalies == 0
+        for index in range(threads_count * per_thread):
+            assert ledger.lookup(card_number(index)).balance == 100000 - index
+    finally:
+        ledger.close()
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+import brizzi
+import brizzi_journal
+import brizzi_settlement
+import brizzi_sim
+from brizzi_settlement import RECORD_LENGTH, BatchWriter, SettlementCounters, SettlementExporter
+
+
+def record(ref_number, amount, hash="0123456789ABCDEF"):
+    return {
+        'ref_number': ref_number,
+        'batch_number': 7,
+        'card_number': "6013500601504245",
+        'amount': amount,
+        'balance_before': 100000,
+        'balance_after': 100000 - amount,
+        'date': "20240131",
+        'time': "235959",
+        'mid': "1122334455667788",
+        'tid': "AABBCCDDEEFF0000",
+        'hash': hash
+    }
+
+
+def sam_pool(faults=None):
+    pool = brizzi.SamSessionPool()
+    pool.add_connection(brizzi_sim.SimulatedSam(faults=faults), "S")
+    return pool
+
+
+def test_detail_line():
+    line = brizzi_settlement.detail_line(record(1, 3500, "AB" * 19))
+    assert len(line) == RECORD_LENGTH and line.endswith("AB" * 19 + "\n")
+    assert line.startswith("D000000000001000007" + "6013500601504245" + "0000003500")
+    # cut short the host could not verify the hash
+    with pytest.raises(ValueError):
+        brizzi_settlement.detail_line(record(1, 3500, "AB" * 20))
+
+
+def test_batch_file(tmp_path):
+    writer = BatchWriter(str(tmp_path), 7, "1122334455667788", "AABBCCDDEEFF0000")
+    for ref_number, amount in ((1, 3500), (2, 5000), (3, 2000)):
+        writer.write(record(ref_number, amount))
+    path = writer.close()
+    assert os.path.basename(path) == "batch_000007.txt"
+    assert not os.path.exists(path + ".part")
+
+    trailer = brizzi_settlement.verify_batch_file(path)
+    assert trailer == {'count': 3, 'total': 10500, 'crc': "{:08X}".format(writer.crc)}
+    with open(path, "rb") as batch_file:
+        lines = batch_file.read().split(b"\n")[:-1]
+    assert [line[:1] for line in lines] == [b"H", b"D", b"D", b"D", b"T"]
+    assert all(len(line) + 1 == RECORD_LENGTH for line in lines)
+
+
+@pytest.mark.parametrize("offset, byte", [(RECORD_LENGTH + 40, b"9"), (2 * RECORD_LENGTH + 140, b"F")])
+def test_batch_file_tampered(tmp_path, offset, byte):
+    writer = BatchWriter(str(tmp_path), 7)
+    writer.write(record(1, 3500))
+    writer.write(record(2, 5000))
+    path = writer.close()
+    with open(path, "r+b") as batch_file:
+        batch_file.seek(offset)
+        batch_file.write(byte)
+    with pytest.raises(ValueError):
+        brizzi_settlement.verify_batch_file(path)
+
+
+def test_batch_file_cut_short(tmp_path):
+    writer = BatchWriter(str(tmp_path), 7)
+    writer.write(record(1, 3500))
+    path = writer.close()
+    with open(path, "r+b") as batch_file:
+        batch_file.truncate(2 * RECORD_LENGTH)
+    with pytest.raises(ValueError):
+        brizzi_settlement.verify_batch_file(path)
+
+
+def test_counters(tmp_path):
+    path = str(tmp_path / "counters.json")
+    counters = SettlementCounters(path, ref_block=10, batch_max_count=3)
+    assert [counters.allocate() for _ in range(4)] == [(1, 1), (2, 1), (3, 1), (4, 2)]
+    # only the last number handed out goes back
+    assert not counters.release(3, 1)
+    assert counters.release(4, 2)
+    assert counters.allocate() == (4, 2)
+
+    # a restart continues past the reserved block in a new batch, no number is handed out twice
+    counters = SettlementCounters(path, ref_block=10, batch_max_count=3)
+    ref_number, batch_number = counters.allocate()
+    assert ref_number > 4 and batch_number > 2
+
+
+def test_export(tmp_path, tap):
+    journal_path = str(tmp_path / "journal.sqlite3")
+    journal = brizzi_journal.TransactionJournal(journal_path)
+    counters = SettlementCounters(str(tmp_path / "counters.json"))
+    try:
+        results = [tap(brizzi_sim.SimulatedBrizziCard(card_number="60135006015042{:02d}".format(index)), 100 * index,
+                       journal=journal, settlement=counters) for index in range(1, 4)]
+        # a declined tap and a failed hash take no number
+        deny_path = tmp_path / "denylist.txt"
+        deny_path.write_text("6013500601504201\n")
+        declined = tap(brizzi_sim.SimulatedBrizziCard(card_number="6013500601504201"), 100, journal=journal,
+                       settlement=counters, denylist=brizzi.CardDenylist(str(deny_path)))
+        failed = tap(brizzi_sim.SimulatedBrizziCard(), 100, journal=journal, settlement=counters,
+                     sam_pool=sam_pool(brizzi_sim.FaultPlan([("80B4", 1.0, ([], 0x6A, 0x80))])))
+        journal.flush()
+    finally:
+        journal.close()
+    assert all(result['status'] for result in results)
+    assert [result['ref_number'] for result in results] == [1, 2, 3]
+    assert declined['declined'] == "denylisted"
+    assert failed['failed_step'] == "sam_create_hash"
+    assert counters.ref_number == 3
+
+    exporter = SettlementExporter(journal_path, str(tmp_path / "settlement"), counters)
+    assert exporter.export() == []
+    paths = exporter.finish_open_batches()
+    assert exporter.exported == 3 and exporter.rejected == 0 and len(paths) == 1
+    assert brizzi_settlement.verify_batch_file(paths[0])['count'] == 3
+    assert brizzi_settlement.verify_batch_file(paths[0])['total'] == 600
+
+    # the cursor moved past the batch, a second exporter finds nothing new
+    exporter = SettlementExporter(journal_path, str(tmp_path / "settlement"), counters)
+    exporter.export()
+    assert exporter.exported == 0 and exporter.finish_open_batches() == []
@@ -0,0 +1,73 @@
+import brizzi
+import brizzi_sim
+
+
+def test_sw_reason():
+    assert brizzi.sw_reason(0x6A82) == "file_not_found"
+    assert brizzi.sw_reason(0x6A88) == "wrong_parameters"
+    assert brizzi.sw_reason(0x91AE) == "authentication_error"
+    assert brizzi.sw_reason(0x91CA) == "command_aborted"
+    assert brizzi.sw_reason(0x9100) == "sw_9100"
+    assert brizzi.sw_reason(0x9000) == "sw_9000"
+
+
+def test_step_failure_reason():
+    assert brizzi.step_failure_reason(0x9000, 0xAE) == "authentication_error"
+    assert brizzi.step_failure_reason(0x6982, None) == "security_not_satisfied"
+    assert brizzi.step_failure_reason(None, None, "transport_error") == "transport_error"
+    assert brizzi.step_failure_reason(0x6982, None, declined="denylisted") == "denylisted"
+    assert brizzi.step_failure_reason(None, None) == "no_exchange"
+    assert brizzi.step_failure_reason(0x9000, 0x00) == "rejected"
+
+
+def test_picc_ok():
+    assert brizzi.picc_ok([0x00], 0x90, 0x00)
+    assert not brizzi.picc_ok([], 0x90, 0x00)
+    assert not brizzi.picc_ok([0xAE], 0x90, 0x00)
+    assert not brizzi.picc_ok([0x00], 0x91, 0x00)
+
+
+def test_picc_exchange():
+    exchange = [None, None, None]
+    brizzi.BrizziProcessor._picc_exchange(exchange, [0xAE], 0x90, 0x00)
+    assert exchange == [0x9000, 0xAE, None]
+
+    exchange = [None, None, None]
+    brizzi.BrizziProcessor._picc_exchange(exchange, [0x00, 0x01, 0x02], 0x04, 0x00)
+    assert exchange == [None, 0x00, None]
+
+    for sw1, sw2 in ((0x90, 0x00), (0x91, 0x00)):
+        exchange = [None, None, None]
+        brizzi.BrizziProcessor._picc_exchange(exchange, [], sw1, sw2)
+        assert exchange == [sw1 << 8 | sw2, None, "short_response"]
+
+
+def test_committed_debit(tap):
+    card = brizzi_sim.SimulatedBrizziCard(balance=5000)
+    result = tap(card, 100)
+    assert result['status'] and result['failure_reason'] is None
+    assert card.balance == 4900
+
+
+def test_short_debit_response(tap):
+    # a 9100 without the desfire status byte is no ok, the debit is not committed
+    card = brizzi_sim.SimulatedBrizziCard(balance=5000,
+                                          faults=brizzi_sim.FaultPlan([("DC", 1.0, ([], 0x91, 0x00))]))
+    result = tap(card, 100)
+    assert not result['status']
+    assert result['failure_reason'] == "short_response"
+    assert card.balance == 5000
+
+
+def test_desfire_status_failure(tap):
+    card = brizzi_sim.SimulatedBrizziCard(faults=brizzi_sim.FaultPlan([("DC", 1.0, ([0xBE], 0x90, 0x00))]))
+    result = tap(card, 100)
+    assert not result['status']
+    assert result['failure_reason'] == "boundary_error"
+
+
+def test_transport_error(tap):
+    card = brizzi_sim.SimulatedBrizziCard(faults=brizzi_sim.FaultPlan([("DC", 1.0, None)]))
+    result = tap(card, 100)
+    assert not result['status']
+    assert result['failure_reason'] == "transport_error"
@@ -0,0 +1,69 @@
+import json
+import time
+
+import brizzi
+import brizzi_sim
+import brizzi_tariff
+from brizzi_tariff import MINUTES_PER_DAY, CompiledTariff
+
+CONFIG = {
+    "fare": 3500, "monthly_cap": 10000,
+    "rules": [{"name": "peak", "lanes": ["lane-1"], "days": [0, 1, 2, 3, 4], "start": "06:00", "end": "09:00",
+               "fare": 5000},
+              {"name": "night", "start": "22:00", "end": "05:00", "fare": 2000}]
+}
+
+
+def test_fare():
+    tariff = CompiledTariff(CONFIG)
+    monday = 0
+    assert tariff.fare(None, monday + 7 * 60) == (3500, None)
+    assert tariff.fare("lane-1", monday + 7 * 60) == (5000, "peak")
+    assert tariff.fare("lane-1", 5 * MINUTES_PER_DAY + 7 * 60) == (3500, None)
+    assert tariff.fare("lane-2", 23 * 60) == (2000, "night")
+    # sunday night runs into monday morning
+    assert tariff.fare(None, 6 * MINUTES_PER_DAY + 23 * 60) == (2000, "night")
+    assert tariff.fare(None, 4 * 60 + 59) == (2000, "night")
+    assert tariff.fare(None, 5 * 60) == (3500, None)
+
+
+def test_monthly_cap():
+    tariff = CompiledTariff(CONFIG)
+    assert tariff.fare(None, 12 * 60, 6500) == (3500, None)
+    assert tariff.fare(None, 12 * 60, 9000) == (1000, "monthly_cap")
+    assert tariff.fare(None, 12 * 60, 10000) == (0, "monthly_cap")
+    assert tariff.fare(None, 12 * 60, 12000) == (0, "monthly_cap")
+    assert CompiledTariff(dict(CONFIG, monthly_cap=None)).fare(None, 12 * 60, 12000) == (3500, None)
+
+
+def test_month_total():
+    local = time.strptime("2024-03-15", "%Y-%m-%d")
+    total = brizzi.BrizziProcessor._akum_debet_total
+    assert total(time.strptime("2024-03-01", "%Y-%m-%d"), 7000, 3500, local) == 10500
+    assert total(time.strptime("2024-02-29", "%Y-%m-%d"), 7000, 3500, local) == 3500
+    # the same month a year earlier is another month
+    assert total(time.strptime("2023-03-20", "%Y-%m-%d"), 7000, 3500, local) == 3500
+
+
+def test_capped_debit(tmp_path, tap):
+    path = tmp_path / "tariff.json"
+    path.write_text(json.dumps(dict(CONFIG, rules=[])))
+    tariff = brizzi_tariff.TariffEngine(str(path))
+    now = time.localtime()
+
+    # 9000 paid this month leaves 1000 to the cap
+    card = brizzi_sim.SimulatedBrizziCard(balance=50000, akum_debet=9000, last_date=time.strftime("%y%m01", now))
+    result = tap(card, 1, tariff=tariff)
+    assert result['status'] and (result['amount'], result['fare_rule']) == (1000, "monthly_cap")
+    assert (card.balance, card.akum_debet) == (49000, 10000)
+
+    # the cap is reached, the tap is free
+    result = tap(card, 1, tariff=tariff)
+    assert (result['amount'], result['fare_rule']) == (0, "monthly_cap") and card.balance == 49000
+
+    # the total of the same month last year does not count
+    card = brizzi_sim.SimulatedBrizziCard(balance=50000, akum_debet=9000,
+                                          last_date="{:02d}{:02d}01".format((now.tm_year - 1) % 100, now.tm_mon))
+    result = tap(card, 1, tariff=tariff)
+    assert (result['amount'], result['fare_rule']) == (3500, None)
+    assert (card.balance, card.akum_debet) == (46500, 3500)